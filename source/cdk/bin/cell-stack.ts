@@ -6,6 +6,7 @@ import {
     aws_ecs_patterns as ecsPatterns,
     aws_iam as iam,
     aws_kinesis as kinesis,
+    aws_s3 as s3,
     Stack,
     StackProps
 } from 'aws-cdk-lib';
@@ -43,6 +44,20 @@ export class CellStack extends Stack {
             kinesisStream: datalakeStream,
         })
 
+        // Values too large for the table (see blobs.py in the cell container).
+        const blob_bucket = new s3.Bucket(this, 'Cell-Blobs', {
+            encryption: s3.BucketEncryption.S3_MANAGED,
+            blockPublicAccess: s3.BlockPublicAccess.BLOCK_ALL,
+            enforceSSL: true,
+            removalPolicy: cdk.RemovalPolicy.DESTROY,
+            autoDeleteObjects: true,
+            lifecycleRules: [{abortIncompleteMultipartUploadAfter: cdk.Duration.days(1)}],
+        });
+
+        new cdk.CfnOutput(this, 'blobBucketName', {
+            value: blob_bucket.bucketName,
+        });
+
         new cdk.CfnOutput(this, 'ddbTableName', {
             value: ddb_table.tableName,
             //exportName: 'ddbTableName'
@@ -56,7 +71,7 @@ export class CellStack extends Stack {
         // Uncomment this to simulate a bad deployment.
         // this.create_denyNacls(vpc)
 
-        const service = this.ecs_service(vpc, cell_id, image_uri, ddb_table);
+        const service = this.ecs_service(vpc, cell_id, image_uri, ddb_table, blob_bucket);
 
         this.create_canary(cell_id, service)
     }
@@ -99,7 +114,8 @@ export class CellStack extends Stack {
         });
     }
 
-    ecs_service(vpc: ec2.Vpc, cell_id: cdk.CfnParameter, image_uri: cdk.CfnParameter, ddb_table: dynamodb.Table)
+    ecs_service(vpc: ec2.Vpc, cell_id: cdk.CfnParameter, image_uri: cdk.CfnParameter, ddb_table: dynamodb.Table,
+                blob_bucket: s3.Bucket)
         : ecsPatterns.ApplicationLoadBalancedFargateService {
 
         const taskRole = new iam.Role(this, 'CellularRouterTaskRole', {
@@ -120,6 +136,14 @@ export class CellStack extends Stack {
                             "dynamodb:PutItem"
                         ],
                         resources: ['arn:aws:dynamodb:*:*:table/' + ddb_table.tableName],
+                    }), new iam.PolicyStatement({
+                        actions: [
+                            "s3:GetObject",
+                            "s3:PutObject",
+                            "s3:DeleteObject",
+                            "s3:AbortMultipartUpload"
+                        ],
+                        resources: [blob_bucket.arnForObjects('*')],
                     })],
                 })
             }
@@ -160,6 +184,10 @@ export class CellStack extends Stack {
                         cellId: cell_id.valueAsString,
                         tableName: ddb_table.tableName,
                         tableArn: ddb_table.tableArn,
+                        blobStore: 's3://' + blob_bucket.bucketName + '/',
+                        // Two gunicorn workers for the 0.5 vCPU of the task;
+                        // the container may not see the task's CPU limit.
+                        workers: '2',
                     },
                     containerPort: 8080,
                     taskRole: taskRole,
@@ -168,6 +196,7 @@ export class CellStack extends Stack {
                 openListener: false,
             });
         service.targetGroup.setAttribute('deregistration_delay.timeout_seconds', '10');
+        service.targetGroup.configureHealthCheck({path: '/health'});
 
         const lbSecurityGroup = new ec2.SecurityGroup(this, 'lb-security-group', {
             vpc,
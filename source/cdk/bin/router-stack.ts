@@ -49,11 +49,11 @@ export class RouterStack extends Stack {
 
         const bucket = this.bucket();
 
-        const updateCellsSm = this.createAndUpdateStatemachines()
+        const checkCanarySm = this.checkcanaryStatemachine()
 
-        this.ecsService(vpc, image_uri, cells_table, users_table)
+        const updateCellsSm = this.createAndUpdateStatemachines(checkCanarySm)
 
-        const checkCanarySm = this.checkcanaryStatemachine()
+        this.ecsService(vpc, image_uri, cells_table, users_table)
 
         const pipelineLambda = this.pipelineLambda(cells_table, bucket, updateCellsSm)
 
@@ -134,6 +134,9 @@ export class RouterStack extends Stack {
         });
 
 
+        // Points per cell on the hash ring (routingMode=hash); cellularctl
+        // reads the stack output to map users to cells like the router.
+        const hashVnodes = '100';
         const cluster = new ecs.Cluster(this, 'Cell-Cluster', {
             vpc: vpc,
             clusterName: 'Cell-Router',
@@ -151,6 +154,10 @@ export class RouterStack extends Stack {
                     environment: {
                         cellsTableName: cells_table.tableName,
                         usersTableName: users_table.tableName,
+                        hashVnodes,
+                        // Two gunicorn workers for the 0.5 vCPU of the task;
+                        // the container may not see the task's CPU limit.
+                        workers: '2',
                     },
                     containerPort: 8080,
                     executionRole,
@@ -168,6 +175,7 @@ export class RouterStack extends Stack {
             ec2.Peer.prefixList(cdk.Fn.importValue('cellsInboundPrefixListId')),
             ec2.Port.tcp(80));
         service.targetGroup.setAttribute('deregistration_delay.timeout_seconds', '10');
+        service.targetGroup.configureHealthCheck({path: '/health'});
         service.loadBalancer.addSecurityGroup(lbSecurityGroup)
 
         new cdk.CfnOutput(this, 'serviceName', {
@@ -179,6 +187,9 @@ export class RouterStack extends Stack {
         new cdk.CfnOutput(this, 'dnsName', {
             value: service.loadBalancer.loadBalancerDnsName,
         });
+        new cdk.CfnOutput(this, 'hashVnodes', {
+            value: hashVnodes,
+        });
 
         return service;
     }
@@ -304,11 +315,18 @@ export class RouterStack extends Stack {
                 'templateUrl': 'https://' + bucket.bucketRegionalDomainName + '/template_cell.yaml',
                 'updateCellsFunctionArn': updateCellsFunction.stateMachineArn,
                 'templateBucketName': bucket.bucketRegionalDomainName,
+                // Rollout to the other cells: one cell first, then waves
+                // of 25% of the cells, each checked by its canaries after
+                // baking for 360 seconds.
+                'firstWave': '1',
+                'wavePercent': '25',
+                'waveConcurrency': '0',
+                'bakeSeconds': '360',
             }
         });
     }
 
-    createAndUpdateStatemachines(): sfn.StateMachine {
+    createAndUpdateStatemachines(checkCanarySm: sfn.StateMachine): sfn.StateMachine {
         const deploymentRole = new iam.Role(this, 'CellularRouterSfnRole', {
             assumedBy: new iam.ServicePrincipal('states.amazonaws.com'),
             roleName: 'CellBasedSfnRole',
@@ -332,6 +350,10 @@ export class RouterStack extends Stack {
                             "kinesis:*",
                             "codepipeline:PutJobSuccessResult",
                             "codepipeline:PutJobFailureResult",
+                            // startExecution.sync of the canary check
+                            "events:PutTargets",
+                            "events:PutRule",
+                            "events:DescribeRule",
                         ],
                         resources: ['*'],
                     })],
@@ -352,7 +374,8 @@ export class RouterStack extends Stack {
             'UpdateCellsSfn',
             'Cellular-Update-Cells',
             'sfn_update_cell.asl.json',
-            deploymentRole);
+            deploymentRole,
+            {'CheckCanaryStateMachineArn': checkCanarySm.stateMachineArn});
 
         new cdk.CfnOutput(this, 'update-cells-function', {
             value: updateStatemachine.stateMachineArn,
@@ -395,7 +418,7 @@ export class RouterStack extends Stack {
     }
 
     create_statemachine(constructName: string, sfnName: string, fileName: string,
-                                role: iam.Role) {
+                                role: iam.Role, substitutions?: {[key: string]: string}) {
         const file = fs.readFileSync('./statemachines/' + fileName);
         const statemachine = new sfn.StateMachine(this, constructName, {
             stateMachineName: sfnName,
@@ -404,6 +427,9 @@ export class RouterStack extends Stack {
         });
         const cfnStatemachine = statemachine.node.defaultChild as sfn.CfnStateMachine;
         cfnStatemachine.definitionString = file.toString();
+        if (substitutions) {
+            cfnStatemachine.definitionSubstitutions = substitutions;
+        }
         return statemachine;
     }
 
@@ -1,20 +1,121 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort
 import os
+import json
+import uuid
+import base64
+import binascii
+from decimal import Decimal
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from flask_httpauth import HTTPTokenAuth
+import batch
+import blobs
+import cache
+import encoding
+import metrics
+import tokens
 
 app = Flask(__name__)
 auth = HTTPTokenAuth(scheme='Bearer')
 
 table_name = os.environ.get('tableName')
 cell_id = os.environ.get('cellId')
-dynamodb = boto3.resource('dynamodb')
-ddb_table = dynamodb.Table(table_name)
+# Size of the HTTP connection pool to DynamoDB. gunicorn.conf.py sets it to
+# the number of threads per worker.
+max_pool_connections = int(os.environ.get('maxPoolConnections', 10))
+
+
+# Request and DynamoDB metrics of this process, served on /metrics.
+registry = metrics.Registry({'cellId': cell_id})
+
+
+# Optional object store for large values (blobStore, see blobs.py). /put
+# stores values whose JSON encoding is larger than blobThreshold bytes there.
+blob_store = blobs.from_env()
+blob_threshold = int(os.environ.get('blobThreshold', 64 * 1024))
+
+# Optional compression of values before they are written to the table
+# (valueCompression, see encoding.py).
+value_compression = encoding.from_env()
+
+
+def init_clients(session=None):
+    """Creates the boto3 clients of this process, from session if given
+    (e.g. one served by the stand-in in source/standin). Called again in
+    each gunicorn worker, as clients must not be shared between processes."""
+    global dynamodb, ddb_table
+    session = session or boto3.session.Session()
+    config = Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+    dynamodb = session.resource('dynamodb', config=config)
+    ddb_table = dynamodb.Table(table_name)
+    metrics.instrument_client(dynamodb.meta.client, registry)
+    if blob_store is not None:
+        blob_store.connect(session, config, registry)
+
+
+init_clients()
+# Maximum number of keys in one /batch/* request.
+max_batch_size = int(os.environ.get('maxBatchSize', 1000))
+# Largest value /batch/put writes, leaving room in DynamoDB's 400 KB item
+# for the other attributes. Batch writes never offload values.
+max_batch_value_size = 400 * 1024 - 1024
+# Maximum page size of /list.
+max_page_size = int(os.environ.get('maxPageSize', 1000))
+
+# Optional read cache of items (readCache, see cache.py).
+read_cache = cache.from_env(registry, cell_id or '')
+
+# Keys to verify the tokens the router issues at login (see tokens.py).
+# Without tokenKeyFile the token is the plain username.
+keyring = tokens.from_env()
+
 
 @auth.verify_token
 def verify_token(token):
-    # Token is the user name. For a production environment, replace this with an authorisation mechanism such as JWT
-    return token
+    if keyring is None:
+        # Token is the user name. Set tokenKeyFile to use signed tokens.
+        return token
+    payload = tokens.verify(keyring, token, cell_id)
+    return payload['u'] if payload else None
+
+
+def current_user():
+    try:
+        return auth.current_user()
+    except Exception:
+        return None
+
+
+# Latency per route, in-flight requests and sampled request logs
+# (logSampleRate, emfInterval).
+metrics.instrument_flask(app, metrics.from_env(registry), current_user)
+
+# Bodies in JSON, msgpack or CBOR, and compressed responses
+# (wireCompression, see encoding.py).
+wire_encodings, wire_min_size = encoding.wire_from_env()
+encoding.instrument_flask(app, wire_encodings, wire_min_size)
+
+
+def decode_body(data, media_type, content_encoding):
+    """A request body, which must be an object. Raises encoding.Error."""
+    r = encoding.loads(encoding.decompress(data, content_encoding), media_type)
+    if not isinstance(r, dict):
+        raise encoding.Error('The body must be an object' if r is not None else 'Missing request body')
+    return r
+
+
+def body(silent=False):
+    """The request body, decoded as its Content-Type and Content-Encoding
+    say. Errors abort the request, or return None if silent."""
+    try:
+        return decode_body(request.get_data(), request.mimetype, request.headers.get('Content-Encoding'))
+    except encoding.Error as e:
+        if silent:
+            return None
+        abort(app.response_class(str(e), e.status))
 
 
 @app.route('/')
@@ -22,48 +123,662 @@ def hello_world():
     return 'Hey, we have Flask in a Docker container! (V2)'
 
 
+@app.route('/health')
+def health():
+    return 'OK'
+
+
+@app.route('/stats')
+def stats():
+    """Hit ratio, saved read capacity units and size of this worker's read
+    cache, or null if there is none."""
+    return jsonify({
+        'readCache': read_cache.stats() if read_cache else None,
+    })
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+# Every write gives the item a new opaque version, returned as the ETag of
+# /get and of the write. Writes with an If-Match header only succeed if the
+# item still has one of the given versions, so a read-modify-write can
+# detect that another client wrote the item in between. Items written
+# before versions were added have version LEGACY_VERSION.
+LEGACY_VERSION = '0'
+
+deserializer = TypeDeserializer()
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def etag(version):
+    return '"{}"'.format(version)
+
+
+def precondition(headers):
+    """Condition of a write from its If-Match and If-None-Match headers.
+    Returns (condition or None, error)."""
+    condition = None
+    if_match = headers.get('If-Match', '').strip()
+    if if_match == '*':
+        condition = Attr('key').exists()
+    elif if_match:
+        tags = [t.strip() for t in if_match.split(',')]
+        if not all(len(t) > 2 and t[0] == t[-1] == '"' for t in tags):
+            return None, ('Invalid If-Match header', 400)
+        for version in (t[1:-1] for t in tags):
+            if version == LEGACY_VERSION:
+                match = Attr('key').exists() & Attr('version').not_exists()
+            else:
+                match = Attr('version').eq(version)
+            condition = match if condition is None else condition | match
+    if_none_match = headers.get('If-None-Match', '').strip()
+    if if_none_match == '*':
+        absent = Attr('key').not_exists()
+        condition = absent if condition is None else condition & absent
+    elif if_none_match:
+        return None, ('Only "If-None-Match: *" is supported', 400)
+    return condition, None
+
+
+def conditional(condition):
+    """Arguments of a conditional write. When the condition fails, the
+    error carries the current item."""
+    if condition is None:
+        return {}
+    return {'ConditionExpression': condition, 'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'}
+
+
+def plain(value):
+    """Numbers are read from DynamoDB as Decimals; JSON has ints and floats."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    return value
+
+
+def stored(value):
+    """DynamoDB takes numbers as Decimals, not floats."""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, list):
+        return [stored(v) for v in value]
+    if isinstance(value, dict):
+        return {k: stored(v) for k, v in value.items()}
+    return value
+
+
+JSON = encoding.JSON
+
+
+def item_value(item):
+    """The value of an item, uncompressed if it has a codec, with JSON
+    numbers."""
+    if 'codec' in item:
+        return encoding.unpack(bytes(item['value']), item['codec'])
+    return plain(item['value'])
+
+
+def value_attributes(value):
+    """Attributes of an item holding value, compressed if
+    valueCompression is set and it pays off."""
+    packed = value_compression.pack(value) if value_compression else None
+    if packed is None:
+        return {'value': stored(value)}
+    data, codec = packed
+    return {'value': data, 'codec': codec}
+
+
+def cache_entry(item):
+    """Entry of the read cache for an item: its value or, if the value is
+    in the object store, its blob {'ref', 'size', 'contentType'}."""
+    if 'Item' not in item:
+        return {}
+    entry = {'version': item['Item'].get('version', LEGACY_VERSION)}
+    if 'blob' in item['Item']:
+        entry['blob'] = plain(item['Item']['blob'])
+    else:
+        entry['value'] = item_value(item['Item'])
+    return entry
+
+
+def json_value(chunks):
+    """Body of /get for a value whose JSON encoding is in the object store."""
+    yield b'{"value": '
+    yield from chunks
+    yield b'}'
+
+
+def item_response(entry, status=200):
+    """Body, status and headers of a response with an item (a cache entry).
+    The body of an item in the object store is streamed from it."""
+    if not entry:
+        return ('Item not found', 404, {}) if status == 200 else ('Precondition failed', status, {})
+    headers = {'ETag': etag(entry['version'])}
+    if 'value' in entry:
+        return {'value': entry['value']}, status, headers
+    if status != 200:
+        # Too large to return; the client reads it again with the ETag.
+        return {'status': 'offloaded', 'size': int(entry['blob']['size'])}, status, headers
+    if entry['blob']['contentType'] != JSON:
+        return 'The value is not JSON, read it with /stream/get', 409, headers
+    return json_value(blob_store.open(entry['blob']['ref'])), status, dict(headers, **{'Content-Type': JSON})
+
+
+def stream_response(entry):
+    """Response of /stream/get: the value as it was uploaded, or the JSON
+    encoding of a value stored by /put."""
+    if not entry:
+        return 'Item not found', 404, {}
+    headers = {'ETag': etag(entry['version'])}
+    if 'value' in entry:
+        return json.dumps(entry['value']).encode(), 200, dict(headers, **{'Content-Type': JSON})
+    blob = entry['blob']
+    return blob_store.open(blob['ref']), 200, dict(headers, **{
+        'Content-Type': blob['contentType'], 'Content-Length': str(blob['size'])})
+
+
+def failed_write(e, update=False):
+    """Response to a write that DynamoDB rejected: 412 with the current
+    item if the condition failed, 409 if the stored value has the wrong
+    type for an update. None for other errors."""
+    error = e.response.get('Error', {})
+    if error.get('Code') == 'ConditionalCheckFailedException':
+        item = e.response.get('Item')
+        if not item:
+            return 'Precondition failed', 412, {}
+        if update and ('blob' in item or 'codec' in item):
+            return 'The stored value has the wrong type for this update', 409, {}
+        entry = cache_entry({'Item': {k: deserializer.deserialize(v) for k, v in item.items()}})
+        return item_response(entry, 412)
+    if error.get('Code') == 'ValidationException' and 'incorrect data type' in error.get('Message', ''):
+        return 'The stored value has the wrong type for this update', 409, {}
+    return None
+
+
+def increment_update(r):
+    """Adds "by" (default 1) to a number, starting from 0. Returns
+    (UpdateItem arguments, error)."""
+    by = r.get('by', 1)
+    if isinstance(by, bool) or not isinstance(by, (int, float)):
+        return None, ('"by" must be a number', 400)
+    return {'UpdateExpression': 'ADD #v :by SET #ver = :ver',
+            'ExpressionAttributeValues': {':by': stored(by)}}, None
+
+
+def append_update(r):
+    """Appends "values" to a list, starting from an empty one. Returns
+    (UpdateItem arguments, error)."""
+    values = r.get('values')
+    if not isinstance(values, list):
+        return None, ('"values" must be a list', 400)
+    return {'UpdateExpression': 'SET #v = list_append(if_not_exists(#v, :empty), :values), #ver = :ver',
+            'ExpressionAttributeValues': {':empty': [], ':values': stored(values)}}, None
+
+
+def update_args(username, key, update, condition):
+    """UpdateItem arguments of /increment and /append, which also give the
+    item a new version. Values in the object store or compressed can't be
+    updated."""
+    inline = Attr('blob').not_exists() & Attr('codec').not_exists()
+    return dict(
+        update,
+        Key={'username': username, 'key': key},
+        ExpressionAttributeNames={'#v': 'value', '#ver': 'version'},
+        ExpressionAttributeValues=dict(update['ExpressionAttributeValues'], **{':ver': new_version()}),
+        ReturnValues='ALL_NEW',
+        **conditional(inline if condition is None else condition & inline),
+    )
+
+
+def write_args(condition):
+    """Arguments of PutItem and DeleteItem. With an object store, they
+    return the old item, whose object is deleted once it is replaced."""
+    args = conditional(condition)
+    if blob_store is not None:
+        args['ReturnValues'] = 'ALL_OLD'
+    return args
+
+
+def delete_replaced(res):
+    old = res.get('Attributes', {}).get('blob')
+    if old:
+        blob_store.delete(old['ref'])
+
+
+def value_size(value, attributes):
+    """Approximate size of value in its item attributes."""
+    return len(attributes['value']) if 'codec' in attributes else len(json.dumps(value).encode())
+
+
+def offload(value, attributes):
+    """True if the value is to be stored in the object store rather than
+    in the item attributes."""
+    if blob_store is None:
+        return False
+    return value_size(value, attributes) > blob_threshold
+
+
+def upload_blob(username, chunks, content_type):
+    """Writes chunks to a new object. Returns the blob of the item."""
+    ref = blobs.new_ref(username)
+    writer = blob_store.writer(ref)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        size = writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return {'ref': ref, 'size': size, 'contentType': content_type}
+
+
+def put_item(username, key, attributes, condition):
+    """Writes the item of /put and /stream/put with a new version."""
+    version = new_version()
+    item = dict(attributes, username=username, key=key, version=version)
+    try:
+        res = ddb_table.put_item(Item=item, **write_args(condition))
+    except ClientError as e:
+        if 'blob' in item:
+            blob_store.delete(item['blob']['ref'])
+        response = failed_write(e)
+        if response is None:
+            raise
+        if read_cache:
+            read_cache.invalidate(username, key)
+        return response
+    delete_replaced(res)
+    if read_cache:
+        read_cache.set(username, key, cache_entry({'Item': item}))
+    return "Success", 200, {'ETag': etag(version)}
+
+
+def read_entry(username, key, fresh=False):
+    """The item as a cache entry, from the read cache unless fresh."""
+    entry = read_cache.get(username, key) if read_cache and not fresh else None
+    if entry is None:
+        if read_cache and fresh:
+            read_cache.invalidate(username, key)
+        entry = cache_entry(ddb_table.get_item(Key={'username': username, 'key': key}))
+        if read_cache:
+            read_cache.fill(username, key, entry)
+    return entry
+
+
+def read_response(username, key, respond):
+    try:
+        return respond(read_entry(username, key))
+    except blobs.NotFound:
+        # The value was replaced after its item was read.
+        return respond(read_entry(username, key, fresh=True))
+
+
 @app.route('/put', methods=['POST'])
 @auth.login_required
 def put():
-    print(request.get_data(), flush=True)
-    r = request.get_json()
-    print(r, flush=True)
-    ddb_table.put_item(
-        Item={
-            'username': auth.current_user(),
-            'key': r['key'],
-            'value': r['value'],
-        }
-    )
-    return "Success"
+    """Stores "value" at "key". Honours If-Match and If-None-Match: *."""
+    r = body()
+    username = auth.current_user()
+    condition, error = precondition(request.headers)
+    if error:
+        return error
+    attributes = value_attributes(r['value'])
+    if offload(r['value'], attributes):
+        attributes = {'blob': upload_blob(username, [json.dumps(r['value']).encode()], JSON)}
+    return put_item(username, r['key'], attributes, condition)
 
 
 @app.route('/get', methods=['POST'])
 @auth.login_required
 def get():
-    r = request.get_json()
-    item = ddb_table.get_item(Key={
-        'username': auth.current_user(),
-        'key': r['key'],
-    })
-    if 'Item' not in item:
-        return 'Item not found', 404
-    return jsonify({
-        'value': item['Item']['value']
-    })
+    """Returns the value at "key", with its version as the ETag."""
+    r = body()
+    return read_response(auth.current_user(), r['key'], item_response)
 
 
 @app.route('/delete', methods=['POST'])
 @auth.login_required
 def delete():
-    r = request.get_json()
-    ddb_table.delete_item(Key={
-        'username': auth.current_user(),
-        'key': r['key'],
-    })
+    """Deletes "key". Honours If-Match."""
+    r = body()
+    condition, error = precondition(request.headers)
+    if error:
+        return error
+    try:
+        res = ddb_table.delete_item(Key={
+            'username': auth.current_user(),
+            'key': r['key'],
+        }, **write_args(condition))
+    except ClientError as e:
+        response = failed_write(e)
+        if response is None:
+            raise
+        if read_cache:
+            read_cache.invalidate(auth.current_user(), r['key'])
+        return response
+    delete_replaced(res)
+    if read_cache:
+        read_cache.delete(auth.current_user(), r['key'])
     return "Success"
 
 
+def stream_key(args):
+    """The key of a /stream/* request, or an error."""
+    if blob_store is None:
+        return None, ('blobStore is not configured', 501)
+    if not args.get('key'):
+        return None, ('"key" is required', 400)
+    return args['key'], None
+
+
+@app.route('/stream/put', methods=['POST'])
+@auth.login_required
+def stream_put():
+    """Stores the request body at ?key= in the object store. The body is
+    read and uploaded in chunks. Honours If-Match and If-None-Match: *."""
+    key, error = stream_key(request.args)
+    if error:
+        return error
+    condition, error = precondition(request.headers)
+    if error:
+        return error
+    chunks = iter(lambda: request.stream.read(blobs.CHUNK_SIZE), b'')
+    blob = upload_blob(auth.current_user(), chunks, request.mimetype or 'application/octet-stream')
+    return put_item(auth.current_user(), key, {'blob': blob}, condition)
+
+
+@app.route('/stream/get', methods=['GET', 'POST'])
+@auth.login_required
+def stream_get():
+    """Streams the value at ?key= in chunks."""
+    key, error = stream_key(request.args)
+    if error:
+        return error
+    return read_response(auth.current_user(), key, stream_response)
+
+
+def update_item(update_fn):
+    """/increment and /append: one UpdateItem, so concurrent updates of the
+    same key are all applied. Return the new value and version."""
+    r = body()
+    username = auth.current_user()
+    condition, error = precondition(request.headers)
+    if error:
+        return error
+    update, error = update_fn(r)
+    if error:
+        return error
+    try:
+        res = ddb_table.update_item(**update_args(username, r['key'], update, condition))
+    except ClientError as e:
+        response = failed_write(e, update=True)
+        if response is None:
+            raise
+        if read_cache:
+            read_cache.invalidate(username, r['key'])
+        return response
+    entry = cache_entry({'Item': res['Attributes']})
+    if read_cache:
+        read_cache.set(username, r['key'], entry)
+    return item_response(entry)
+
+
+@app.route('/increment', methods=['POST'])
+@auth.login_required
+def increment():
+    return update_item(increment_update)
+
+
+@app.route('/append', methods=['POST'])
+@auth.login_required
+def append():
+    return update_item(append_update)
+
+
+def encode_token(last_key):
+    return base64.urlsafe_b64encode(json.dumps(last_key).encode()).decode()
+
+
+def decode_token(token, username):
+    try:
+        last_key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(last_key, dict) or last_key.get('username') != username:
+        return None
+    return last_key
+
+
+def list_query(r, username):
+    """Builds the Query for a /list request. Returns (kwargs, error)."""
+    try:
+        limit = min(int(r.get('limit', 100)), max_page_size)
+    except (TypeError, ValueError):
+        return None, ('"limit" must be a number', 400)
+    if limit < 1:
+        return None, ('"limit" must be positive', 400)
+    condition = Key('username').eq(username)
+    if r.get('prefix'):
+        condition = condition & Key('key').begins_with(r['prefix'])
+    kwargs = {'KeyConditionExpression': condition, 'Limit': limit}
+    if r.get('keysOnly'):
+        kwargs['ProjectionExpression'] = '#k'
+        kwargs['ExpressionAttributeNames'] = {'#k': 'key'}
+    if r.get('token'):
+        kwargs['ExclusiveStartKey'] = decode_token(r['token'], username)
+        if kwargs['ExclusiveStartKey'] is None:
+            return None, ('Invalid token', 400)
+    return kwargs, None
+
+
+def list_page(res):
+    items = [{'key': i['key'], 'value': item_value(i)} if 'value' in i else
+             {'key': i['key'], 'size': int(i['blob']['size'])} if 'blob' in i else {'key': i['key']}
+             for i in res['Items']]
+    return {
+        'items': items,
+        'token': encode_token(res['LastEvaluatedKey']) if 'LastEvaluatedKey' in res else None,
+    }
+
+
+@app.route('/list', methods=['POST'])
+@auth.login_required
+def list_items():
+    """Lists the user's items whose key starts with "prefix", in key order.
+    Pass the returned "token" to get the next page; it is null on the last
+    page."""
+    kwargs, error = list_query(body(silent=True) or {}, auth.current_user())
+    if error:
+        return error
+    return jsonify(list_page(ddb_table.query(**kwargs)))
+
+
+BATCH_GET_PROJECTION = {
+    'ProjectionExpression': '#k, #v, #ver, #b, #c',
+    'ExpressionAttributeNames': {'#k': 'key', '#v': 'value', '#ver': 'version', '#b': 'blob', '#c': 'codec'},
+}
+BLOB_PROJECTION = {
+    'ProjectionExpression': '#k, #b',
+    'ExpressionAttributeNames': {'#k': 'key', '#b': 'blob'},
+}
+
+
+def batch_keys(r, field):
+    """Returns the list in the request body, or an error response."""
+    keys = r.get(field) if isinstance(r, dict) else None
+    if not isinstance(keys, list):
+        return None, ('"{}" must be a list'.format(field), 400)
+    if len(keys) > max_batch_size:
+        return None, ('At most {} keys per request'.format(max_batch_size), 413)
+    return keys, None
+
+
+def batch_put_attributes(items):
+    """Returns the value attributes of the items of /batch/put by key, or
+    an error response."""
+    values = {}
+    for i in items:
+        if not isinstance(i, dict) or not isinstance(i.get('key'), str) or 'value' not in i:
+            return None, ('Each item must be an object with a "key" string and a "value"', 400)
+        attributes = value_attributes(i['value'])
+        if value_size(i['value'], attributes) > max_batch_value_size:
+            return None, ('Value of "{}" is too large for a batch; write it with /put'.format(i['key']), 413)
+        # A batch must not write the same key twice; the last value wins.
+        values[i['key']] = attributes
+    return values, None
+
+
+def batch_put_requests(username, values):
+    return list(values), [
+        {'PutRequest': {'Item': dict(attributes, username=username, key=k, version=new_version())}}
+        for k, attributes in values.items()
+    ]
+
+
+def batch_delete_requests(username, keys):
+    keys = list(dict.fromkeys(keys))
+    return keys, [{'DeleteRequest': {'Key': {'username': username, 'key': k}}} for k in keys]
+
+
+def cache_batch_write(username, requests, failed_keys):
+    """Writes the outcome of a batch write through the read cache. Failed
+    keys are dropped, as the table may or may not have been written."""
+    failed = {k for _, k in failed_keys}
+    for request in requests:
+        _, key = batch.key_of(request)
+        if key in failed:
+            read_cache.invalidate(username, key)
+        elif 'PutRequest' in request:
+            read_cache.set(username, key, cache_entry({'Item': request['PutRequest']['Item']}))
+        else:
+            read_cache.delete(username, key)
+
+
+def cached_batch_get(username, keys):
+    """Splits keys into the items found in the read cache and the keys to
+    read from the table."""
+    items, missing = [], []
+    for k in keys:
+        entry = read_cache.get(username, k)
+        if entry is None:
+            missing.append(k)
+        elif entry:
+            items.append(dict(entry, key=k))
+    return items, missing
+
+
+def fill_batch_get(username, keys, items, failed_keys):
+    values = {i['key']: i for i in items}
+    failed = {f['key'] for f in failed_keys}
+    for k in keys:
+        if k not in failed:
+            read_cache.fill(username, k, cache_entry({'Item': values[k]} if k in values else {}))
+
+
+def blob_refs(items):
+    return {i['key']: i['blob']['ref'] for i in items if 'blob' in i}
+
+
+def replaced_blobs(username, keys):
+    """Objects of the items that a batch write is about to replace or
+    delete, by key."""
+    if blob_store is None:
+        return {}
+    items, _ = batch.get(dynamodb, table_name, [{'username': username, 'key': k} for k in keys],
+                         BLOB_PROJECTION)
+    return blob_refs(items)
+
+
+def delete_blobs(refs, failed_keys):
+    """Deletes the objects of the keys a batch write replaced or deleted."""
+    failed = {k for _, k in failed_keys}
+    for key, ref in refs.items():
+        if key not in failed:
+            blob_store.delete(ref)
+
+
+def batch_results(keys, failed_keys):
+    failed = {k for _, k in failed_keys}
+    return {
+        'results': [{'key': k, 'status': 'failed' if k in failed else 'ok'} for k in keys],
+    }
+
+
+def batch_get_results(keys, items, failed_keys):
+    values = {i['key']: i for i in items}
+    failed = {f['key'] for f in failed_keys}
+    results = []
+    for k in keys:
+        if k in values and 'blob' in values[k]:
+            # Too large for a batch; read it with /get or /stream/get.
+            results.append({'key': k, 'status': 'offloaded', 'size': int(values[k]['blob']['size']),
+                            'version': values[k].get('version', LEGACY_VERSION)})
+        elif k in values:
+            results.append({'key': k, 'status': 'ok', 'value': item_value(values[k]),
+                            'version': values[k].get('version', LEGACY_VERSION)})
+        else:
+            results.append({'key': k, 'status': 'failed' if k in failed else 'not_found'})
+    return {'results': results}
+
+
+@app.route('/batch/put', methods=['POST'])
+@auth.login_required
+def batch_put():
+    items, error = batch_keys(body(), 'items')
+    if error:
+        return error
+    values, error = batch_put_attributes(items)
+    if error:
+        return error
+    keys, requests = batch_put_requests(auth.current_user(), values)
+    refs = replaced_blobs(auth.current_user(), keys)
+    failed = batch.write(dynamodb, table_name, requests)
+    delete_blobs(refs, failed)
+    if read_cache:
+        cache_batch_write(auth.current_user(), requests, failed)
+    return jsonify(batch_results(keys, failed))
+
+
+@app.route('/batch/get', methods=['POST'])
+@auth.login_required
+def batch_get():
+    keys, error = batch_keys(body(), 'keys')
+    if error:
+        return error
+    username = auth.current_user()
+    keys = list(dict.fromkeys(keys))
+    cached, missing = cached_batch_get(username, keys) if read_cache else ([], keys)
+    items, failed = batch.get(dynamodb, table_name, [{'username': username, 'key': k} for k in missing],
+                              BATCH_GET_PROJECTION)
+    if read_cache:
+        fill_batch_get(username, missing, items, failed)
+    return jsonify(batch_get_results(keys, cached + items, failed))
+
+
+@app.route('/batch/delete', methods=['POST'])
+@auth.login_required
+def batch_delete():
+    keys, error = batch_keys(body(), 'keys')
+    if error:
+        return error
+    keys, requests = batch_delete_requests(auth.current_user(), keys)
+    refs = replaced_blobs(auth.current_user(), keys)
+    failed = batch.write(dynamodb, table_name, requests)
+    delete_blobs(refs, failed)
+    if read_cache:
+        cache_batch_write(auth.current_user(), requests, failed)
+    return jsonify(batch_results(keys, failed))
+
+
 @app.route('/validate', methods=['POST', 'GET'])
 @auth.login_required
 def validate():
@@ -0,0 +1,435 @@
+"""Async (ASGI) serving mode of the cell container.
+
+Serves the same routes with the same bearer-token auth as app.py, but the
+DynamoDB calls are non-blocking (aioboto3) and share one connection pool
+per worker. At most maxConcurrency DynamoDB calls are in flight per worker;
+limit the number of open requests with uvicorn's --limit-concurrency.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+import os
+import json
+import asyncio
+import contextlib
+import contextvars
+import aioboto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+import app as flask_app
+import batch
+import blobs
+import encoding
+import metrics
+
+max_concurrency = int(os.environ.get('maxConcurrency', 64))
+
+
+class AWS:
+    """aioboto3 resources of one worker. Attributes that are already set,
+    e.g. by tests or benchmarks, are not replaced on startup."""
+
+    def __init__(self):
+        self.dynamodb = None
+        self.table = None
+        self.limit = None
+        self._stack = None
+
+    async def open(self):
+        self.limit = asyncio.Semaphore(max_concurrency)
+        if self.table is not None:
+            return
+        self._stack = contextlib.AsyncExitStack()
+        config = Config(max_pool_connections=max_concurrency, tcp_keepalive=True)
+        self.dynamodb = await self._stack.enter_async_context(
+            aioboto3.Session().resource('dynamodb', config=config))
+        self.table = await self.dynamodb.Table(flask_app.table_name)
+        metrics.instrument_client(self.dynamodb.meta.client, flask_app.registry)
+
+    async def close(self):
+        if self._stack is not None:
+            await self._stack.aclose()
+            self._stack = None
+            self.dynamodb = self.table = None
+
+    async def call(self, fn, **kwargs):
+        async with self.limit:
+            return await fn(**kwargs)
+
+
+aws = AWS()
+
+# Media type of the response bodies of the current request (see encoding.py).
+accepted = contextvars.ContextVar('accepted', default=encoding.JSON)
+
+
+async def cached(fn, *args):
+    """Calls a read cache method; off the event loop if the cache is remote."""
+    if flask_app.read_cache.backend.remote:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def unauthorized():
+    return PlainTextResponse('Unauthorized Access', 401,
+                             headers={'WWW-Authenticate': 'Bearer realm="Authentication Required"'})
+
+
+def login_required(f):
+    """Same semantics as HTTPTokenAuth(scheme='Bearer').login_required."""
+    async def wrapper(request):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = flask_app.verify_token(token.strip() if scheme.lower() == 'bearer' else '')
+        if not user:
+            return unauthorized()
+        request.state.user = user
+        accepted.set(encoding.accepted(request.headers.get('Accept')))
+        return await f(request)
+    return wrapper
+
+
+def error(e):
+    message, status = e
+    return PlainTextResponse(message, status)
+
+
+def encoded(content, status=200, headers=None):
+    """As JSONResponse, in the format the request accepts."""
+    media_type = accepted.get()
+    if media_type == encoding.JSON:
+        response = JSONResponse(content, status, headers=headers)
+    else:
+        response = Response(encoding.dumps(content, media_type), status, headers=headers, media_type=media_type)
+    response.headers.append('Vary', 'Accept')
+    return response
+
+
+def respond(response):
+    """Response of a (body, status, headers) tuple built by app.py."""
+    body, status, headers = response
+    if isinstance(body, dict):
+        return encoded(body, status, headers)
+    if isinstance(body, bytes):
+        return Response(body, status, headers=headers)
+    if not isinstance(body, str):
+        # Streamed from an object, in the thread pool.
+        return StreamingResponse(body, status, headers=headers)
+    return PlainTextResponse(body, status, headers=headers)
+
+
+async def body(request, silent=False):
+    """As app.body: a body without Content-Type is answered with 415."""
+    media_type = request.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    try:
+        return flask_app.decode_body(await request.body(), media_type, request.headers.get('Content-Encoding'))
+    except encoding.Error as e:
+        if silent:
+            return None
+        raise HTTPException(e.status, str(e))
+
+
+async def hello_world(request):
+    return PlainTextResponse('Hey, we have Flask in a Docker container! (V2)')
+
+
+async def health(request):
+    return PlainTextResponse('OK')
+
+
+async def failed_write(e, username, key, update=False):
+    response = flask_app.failed_write(e, update)
+    if response is None:
+        raise e
+    if flask_app.read_cache:
+        await cached(flask_app.read_cache.invalidate, username, key)
+    return respond(response)
+
+
+async def one_chunk(data):
+    yield data
+
+
+async def upload_blob(username, chunks, content_type):
+    """app.upload_blob for an async iterable of chunks. The object store is
+    called in threads."""
+    ref = blobs.new_ref(username)
+    writer = await asyncio.to_thread(flask_app.blob_store.writer, ref)
+    try:
+        async for chunk in chunks:
+            if chunk:
+                await asyncio.to_thread(writer.write, chunk)
+        size = await asyncio.to_thread(writer.close)
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
+    return {'ref': ref, 'size': size, 'contentType': content_type}
+
+
+async def delete_replaced(res):
+    old = res.get('Attributes', {}).get('blob')
+    if old:
+        await asyncio.to_thread(flask_app.blob_store.delete, old['ref'])
+
+
+async def put_item(username, key, attributes, condition):
+    """As app.put_item."""
+    version = flask_app.new_version()
+    item = dict(attributes, username=username, key=key, version=version)
+    try:
+        res = await aws.call(aws.table.put_item, Item=item, **flask_app.write_args(condition))
+    except ClientError as exc:
+        if 'blob' in item:
+            await asyncio.to_thread(flask_app.blob_store.delete, item['blob']['ref'])
+        return await failed_write(exc, username, key)
+    await delete_replaced(res)
+    if flask_app.read_cache:
+        await cached(flask_app.read_cache.set, username, key, flask_app.cache_entry({'Item': item}))
+    return PlainTextResponse('Success', headers={'ETag': flask_app.etag(version)})
+
+
+async def read_entry(username, key, fresh=False):
+    """As app.read_entry."""
+    read_cache = flask_app.read_cache
+    entry = await cached(read_cache.get, username, key) if read_cache and not fresh else None
+    if entry is None:
+        if read_cache and fresh:
+            await cached(read_cache.invalidate, username, key)
+        entry = flask_app.cache_entry(await aws.call(aws.table.get_item, Key={
+            'username': username,
+            'key': key,
+        }))
+        if read_cache:
+            await cached(read_cache.fill, username, key, entry)
+    return entry
+
+
+async def read_response(username, key, respond_with):
+    """As app.read_response. Objects are opened in a thread and streamed
+    from the thread pool."""
+    for fresh in (False, True):
+        entry = await read_entry(username, key, fresh)
+        try:
+            if 'blob' in entry:
+                return respond(await asyncio.to_thread(respond_with, entry))
+            return respond(respond_with(entry))
+        except blobs.NotFound:
+            if fresh:
+                raise
+
+
+@login_required
+async def put(request):
+    r = await body(request)
+    username = request.state.user
+    condition, e = flask_app.precondition(request.headers)
+    if e:
+        return error(e)
+    attributes = flask_app.value_attributes(r['value'])
+    if flask_app.offload(r['value'], attributes):
+        data = json.dumps(r['value']).encode()
+        attributes = {'blob': await upload_blob(username, one_chunk(data), flask_app.JSON)}
+    return await put_item(username, r['key'], attributes, condition)
+
+
+@login_required
+async def get(request):
+    r = await body(request)
+    return await read_response(request.state.user, r['key'], flask_app.item_response)
+
+
+@login_required
+async def delete(request):
+    r = await body(request)
+    condition, e = flask_app.precondition(request.headers)
+    if e:
+        return error(e)
+    try:
+        res = await aws.call(aws.table.delete_item, Key={
+            'username': request.state.user,
+            'key': r['key'],
+        }, **flask_app.write_args(condition))
+    except ClientError as exc:
+        return await failed_write(exc, request.state.user, r['key'])
+    await delete_replaced(res)
+    if flask_app.read_cache:
+        await cached(flask_app.read_cache.delete, request.state.user, r['key'])
+    return PlainTextResponse('Success')
+
+
+@login_required
+async def stream_put(request):
+    key, e = flask_app.stream_key(request.query_params)
+    if e:
+        return error(e)
+    condition, e = flask_app.precondition(request.headers)
+    if e:
+        return error(e)
+    content_type = request.headers.get('Content-Type', '').split(';')[0].strip()
+    blob = await upload_blob(request.state.user, request.stream(), content_type or 'application/octet-stream')
+    return await put_item(request.state.user, key, {'blob': blob}, condition)
+
+
+@login_required
+async def stream_get(request):
+    key, e = flask_app.stream_key(request.query_params)
+    if e:
+        return error(e)
+    return await read_response(request.state.user, key, flask_app.stream_response)
+
+
+def update_route(update_fn):
+    """/increment and /append, as in app.update_item."""
+    @login_required
+    async def update_item(request):
+        r = await body(request)
+        username = request.state.user
+        condition, e = flask_app.precondition(request.headers)
+        if e:
+            return error(e)
+        update, e = update_fn(r)
+        if e:
+            return error(e)
+        try:
+            res = await aws.call(aws.table.update_item,
+                                 **flask_app.update_args(username, r['key'], update, condition))
+        except ClientError as exc:
+            return await failed_write(exc, username, r['key'], update=True)
+        entry = flask_app.cache_entry({'Item': res['Attributes']})
+        if flask_app.read_cache:
+            await cached(flask_app.read_cache.set, username, r['key'], entry)
+        return respond(flask_app.item_response(entry))
+    return update_item
+
+
+@login_required
+async def list_items(request):
+    kwargs, e = flask_app.list_query(await body(request, silent=True) or {}, request.state.user)
+    if e:
+        return error(e)
+    return encoded(flask_app.list_page(await aws.call(aws.table.query, **kwargs)))
+
+
+async def replaced_blobs(username, keys):
+    """As app.replaced_blobs."""
+    if flask_app.blob_store is None:
+        return {}
+    async with aws.limit:
+        items, _ = await batch.aget(aws.dynamodb, flask_app.table_name,
+                                    [{'username': username, 'key': k} for k in keys], flask_app.BLOB_PROJECTION)
+    return flask_app.blob_refs(items)
+
+
+@login_required
+async def batch_put(request):
+    items, e = flask_app.batch_keys(await body(request), 'items')
+    if e:
+        return error(e)
+    values, e = flask_app.batch_put_attributes(items)
+    if e:
+        return error(e)
+    keys, requests = flask_app.batch_put_requests(request.state.user, values)
+    refs = await replaced_blobs(request.state.user, keys)
+    async with aws.limit:
+        failed = await batch.awrite(aws.dynamodb, flask_app.table_name, requests)
+    if refs:
+        await asyncio.to_thread(flask_app.delete_blobs, refs, failed)
+    if flask_app.read_cache:
+        await cached(flask_app.cache_batch_write, request.state.user, requests, failed)
+    return encoded(flask_app.batch_results(keys, failed))
+
+
+@login_required
+async def batch_get(request):
+    keys, e = flask_app.batch_keys(await body(request), 'keys')
+    if e:
+        return error(e)
+    keys = list(dict.fromkeys(keys))
+    username = request.state.user
+    read_cache = flask_app.read_cache
+    cached_items, missing = await cached(flask_app.cached_batch_get, username, keys) if read_cache else ([], keys)
+    async with aws.limit:
+        items, failed = await batch.aget(
+            aws.dynamodb, flask_app.table_name,
+            [{'username': username, 'key': k} for k in missing], flask_app.BATCH_GET_PROJECTION)
+    if read_cache:
+        await cached(flask_app.fill_batch_get, username, missing, items, failed)
+    return encoded(flask_app.batch_get_results(keys, cached_items + items, failed))
+
+
+@login_required
+async def batch_delete(request):
+    keys, e = flask_app.batch_keys(await body(request), 'keys')
+    if e:
+        return error(e)
+    keys, requests = flask_app.batch_delete_requests(request.state.user, keys)
+    refs = await replaced_blobs(request.state.user, keys)
+    async with aws.limit:
+        failed = await batch.awrite(aws.dynamodb, flask_app.table_name, requests)
+    if refs:
+        await asyncio.to_thread(flask_app.delete_blobs, refs, failed)
+    if flask_app.read_cache:
+        await cached(flask_app.cache_batch_write, request.state.user, requests, failed)
+    return encoded(flask_app.batch_results(keys, failed))
+
+
+@login_required
+async def validate(request):
+    return encoded({
+        'username': request.state.user,
+        'cellid': flask_app.cell_id,
+    })
+
+
+async def env(request):
+    return PlainTextResponse(flask_app.table_name)
+
+
+async def stats(request):
+    return JSONResponse({
+        'readCache': flask_app.read_cache.stats() if flask_app.read_cache else None,
+    })
+
+
+async def metrics_endpoint(request):
+    return Response(flask_app.registry.render(), media_type='text/plain; version=0.0.4')
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await aws.open()
+    try:
+        yield
+    finally:
+        await aws.close()
+
+
+routes = [
+    Route('/', hello_world),
+    Route('/health', health),
+    Route('/put', put, methods=['POST']),
+    Route('/get', get, methods=['POST']),
+    Route('/delete', delete, methods=['POST']),
+    Route('/stream/put', stream_put, methods=['POST']),
+    Route('/stream/get', stream_get, methods=['GET', 'POST']),
+    Route('/increment', update_route(flask_app.increment_update), methods=['POST']),
+    Route('/append', update_route(flask_app.append_update), methods=['POST']),
+    Route('/list', list_items, methods=['POST']),
+    Route('/batch/put', batch_put, methods=['POST']),
+    Route('/batch/get', batch_get, methods=['POST']),
+    Route('/batch/delete', batch_delete, methods=['POST']),
+    Route('/validate', validate, methods=['POST', 'GET']),
+    Route('/env', env),
+    Route('/stats', stats),
+    Route('/metrics', metrics_endpoint),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[
+    Middleware(metrics.AsgiMetrics, timer=metrics.from_env(flask_app.registry),
+               paths=[r.path for r in routes],
+               current_user=lambda scope: scope.get('state', {}).get('user')),
+    Middleware(encoding.AsgiCompression, encodings=flask_app.wire_encodings, min_size=flask_app.wire_min_size),
+])
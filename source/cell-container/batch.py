@@ -0,0 +1,113 @@
+"""DynamoDB batch helpers for the cell's key-value table.
+
+Requests are split into chunks that fit the BatchWriteItem (25 items) and
+BatchGetItem (100 keys) limits. Unprocessed items are retried with
+exponential backoff and jitter; whatever is still unprocessed after the
+last attempt is reported as failed instead of raising.
+"""
+import asyncio
+import random
+import time
+
+WRITE_CHUNK = 25
+GET_CHUNK = 100
+MAX_ATTEMPTS = 6
+BASE_DELAY = 0.05
+MAX_DELAY = 2.0
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def delay(attempt):
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def backoff(attempt):
+    time.sleep(delay(attempt))
+
+
+def key_of(request):
+    if 'PutRequest' in request:
+        item = request['PutRequest']['Item']
+        return item['username'], item['key']
+    key = request['DeleteRequest']['Key']
+    return key['username'], key['key']
+
+
+def write(dynamodb, table_name, requests):
+    """Runs PutRequest/DeleteRequest entries through BatchWriteItem.
+    Returns the (username, key) pairs that could not be written."""
+    failed = []
+    for chunk in chunks(requests, WRITE_CHUNK):
+        pending = chunk
+        for attempt in range(MAX_ATTEMPTS):
+            res = dynamodb.batch_write_item(RequestItems={table_name: pending})
+            pending = res.get('UnprocessedItems', {}).get(table_name, [])
+            if not pending:
+                break
+            if attempt < MAX_ATTEMPTS - 1:
+                backoff(attempt)
+        failed.extend(key_of(r) for r in pending)
+    return failed
+
+
+def get(dynamodb, table_name, keys, projection=None):
+    """Reads keys ({'username': ..., 'key': ...}) with BatchGetItem.
+    Returns (items, failed keys)."""
+    items = []
+    failed = []
+    for chunk in chunks(keys, GET_CHUNK):
+        pending = {'Keys': chunk}
+        if projection:
+            pending.update(projection)
+        for attempt in range(MAX_ATTEMPTS):
+            res = dynamodb.batch_get_item(RequestItems={table_name: pending})
+            items.extend(res['Responses'].get(table_name, []))
+            pending = res.get('UnprocessedKeys', {}).get(table_name)
+            if not pending:
+                break
+            if attempt < MAX_ATTEMPTS - 1:
+                backoff(attempt)
+        if pending:
+            failed.extend(pending['Keys'])
+    return items, failed
+
+
+async def awrite(dynamodb, table_name, requests):
+    """write() for an aioboto3 DynamoDB resource."""
+    failed = []
+    for chunk in chunks(requests, WRITE_CHUNK):
+        pending = chunk
+        for attempt in range(MAX_ATTEMPTS):
+            res = await dynamodb.batch_write_item(RequestItems={table_name: pending})
+            pending = res.get('UnprocessedItems', {}).get(table_name, [])
+            if not pending:
+                break
+            if attempt < MAX_ATTEMPTS - 1:
+                await asyncio.sleep(delay(attempt))
+        failed.extend(key_of(r) for r in pending)
+    return failed
+
+
+async def aget(dynamodb, table_name, keys, projection=None):
+    """get() for an aioboto3 DynamoDB resource."""
+    items = []
+    failed = []
+    for chunk in chunks(keys, GET_CHUNK):
+        pending = {'Keys': chunk}
+        if projection:
+            pending.update(projection)
+        for attempt in range(MAX_ATTEMPTS):
+            res = await dynamodb.batch_get_item(RequestItems={table_name: pending})
+            items.extend(res['Responses'].get(table_name, []))
+            pending = res.get('UnprocessedKeys', {}).get(table_name)
+            if not pending:
+                break
+            if attempt < MAX_ATTEMPTS - 1:
+                await asyncio.sleep(delay(attempt))
+        if pending:
+            failed.extend(pending['Keys'])
+    return items, failed
@@ -0,0 +1,85 @@
+"""Hit ratio and cost of the cell's read cache (cache.py) under a Zipfian
+key workload.
+
+Replays --requests reads over --keys keys, drawn with probability
+proportional to 1 / rank ** s, against the local backend with LRU and with
+TinyLFU at several cache sizes. With --scan, that fraction of the reads are
+keys read only once (e.g. a client paging through old data). Reports the
+hit ratio, the read capacity units saved per million reads and the cost
+of a lookup, and with --memcached the cost of a lookup on the memcached
+stand-in.
+
+Usage: python3 bench_cache.py --keys 100000 --requests 1000000 --s 0.99 --scan 0.1
+"""
+import sys
+import time
+import random
+import bisect
+import argparse
+from pathlib import Path
+import cache
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+
+
+def zipf_keys(n, s, count, scan, rng):
+    cumulative = []
+    total = 0
+    for i in range(n):
+        total += 1 / (i + 1) ** s
+        cumulative.append(total)
+    once = n
+    keys = []
+    for _ in range(count):
+        if rng.random() < scan:
+            keys.append('once{}'.format(once))
+            once += 1
+        else:
+            keys.append('k{}'.format(bisect.bisect_left(cumulative, rng.random() * total)))
+    return keys
+
+
+def replay(read_cache, keys):
+    start = time.perf_counter()
+    for k in keys:
+        if read_cache.get('user1', k) is None:
+            read_cache.fill('user1', k, {'value': 'x' * 100})
+    elapsed = time.perf_counter() - start
+    return read_cache.stats(), elapsed / len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=1000000)
+    parser.add_argument('--s', type=float, default=0.99, help='Zipf exponent')
+    parser.add_argument('--scan', type=float, default=0.0, help='fraction of one-off reads')
+    parser.add_argument('--sizes', default='0.1,1,10', help='cache sizes in percent of --keys')
+    parser.add_argument('--memcached', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    keys = zipf_keys(args.keys, args.s, args.requests, args.scan, random.Random(args.seed))
+    print('{} reads over {} keys, s={}, {:.0%} one-off reads'.format(
+        args.requests, args.keys, args.s, args.scan))
+    print('{:<8} {:>8} {:>9} {:>14} {:>9}'.format('policy', 'size', 'hit ratio', 'RCU saved/1M', 'us/read'))
+    for percent in (float(p) for p in args.sizes.split(',')):
+        size = max(1, int(args.keys * percent / 100))
+        for policy in ('lru', 'tinylfu'):
+            stats, per_read = replay(cache.ReadCache(cache.LocalBackend(size, policy), ttl=3600), keys)
+            print('{:<8} {:>8} {:>9.3f} {:>14.0f} {:>9.2f}'.format(
+                policy, size, stats['hitRatio'], stats['rcuSaved'] * 1e6 / args.requests, per_read * 1e6))
+
+    if args.memcached:
+        import memcached
+        server = memcached.serve(memcached.Store(), port=0)
+        backend = cache.MemcachedBackend('127.0.0.1', server.server_address[1], 'bench')
+        n = min(len(keys), 20000)
+        stats, per_read = replay(cache.ReadCache(backend, ttl=3600), keys[:n])
+        print('{:<8} {:>8} {:>9.3f} {:>14.0f} {:>9.2f}'.format(
+            'memcached', '-', stats['hitRatio'], stats['rcuSaved'] * 1e6 / n, per_read * 1e6))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Size and CPU cost of the body formats and compression in encoding.py,
+for a few realistic values.
+
+For each value, reports:
+
+- body: the size of a /get response body in JSON, msgpack and CBOR, and
+  the time to encode and decode it;
+- wire: the size of the JSON body compressed with gzip and zstd, and the
+  time to compress it;
+- storage: the item size and write capacity units of /put against the
+  local backend, with the value stored as it is and compressed with gzip
+  and zstd, and the time to convert it to and from DynamoDB attribute
+  values (with boto3's serializer), including compression.
+
+Usage: python3 bench_encoding.py --repeat 200
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('tableName', 'Cell-bench')
+os.environ.setdefault('cellId', 'bench')
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import app
+import encoding
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+from dynamodb import item_size
+
+WORDS = ('cell', 'router', 'user', 'item', 'value', 'table', 'region', 'deploy', 'canary', 'wave',
+         'request', 'latency', 'cache', 'token', 'login', 'shard', 'stack', 'alarm', 'metric', 'health')
+
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def payloads(rng):
+    """Values like those clients store: a profile, an event log, a document
+    and a time series."""
+    return {
+        'profile': {
+            'name': text(rng, 2), 'email': 'user{}@example.com'.format(rng.randrange(10 ** 6)),
+            'settings': {k: rng.choice([True, False, rng.randrange(100), text(rng, 1)]) for k in WORDS},
+            'tags': [text(rng, 1) for _ in range(10)],
+        },
+        'events': [
+            {'time': 1700000000 + i * 60 + rng.randrange(60), 'type': rng.choice(WORDS[:5]),
+             'user': 'user{}'.format(rng.randrange(1000)), 'latency': round(rng.expovariate(1 / 20), 3),
+             'ok': rng.random() < 0.99}
+            for i in range(200)
+        ],
+        'document': {'title': text(rng, 6), 'paragraphs': [text(rng, rng.randrange(40, 120)) for _ in range(20)]},
+        'timeseries': [round(50 + rng.gauss(0, 5), 2) for _ in range(2000)],
+    }
+
+
+def timed(fn, repeat):
+    """Microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+def bench_body(name, value, repeat):
+    body = {'value': value}
+    for media_type in encoding.MEDIA_TYPES:
+        encode_us, data = timed(lambda: encoding.dumps(body, media_type), repeat)
+        decode_us, _ = timed(lambda: encoding.loads(data, media_type), repeat)
+        print('{:<11} {:<9} {:<20} {:>9} {:>10.1f} {:>10.1f}'.format(
+            name, 'body', media_type, len(data), encode_us, decode_us))
+    data = encoding.dumps(body, encoding.JSON)
+    for e in encoding.COMPRESSIONS:
+        compress_us, compressed = timed(lambda: encoding.compress(data, e), repeat)
+        decompress_us, _ = timed(lambda: encoding.decompress(compressed, e), repeat)
+        print('{:<11} {:<9} {:<20} {:>9} {:>10.1f} {:>10.1f}'.format(
+            name, 'wire', 'json+' + e, len(compressed), compress_us, decompress_us))
+
+
+def bench_storage(name, value, repeat):
+    serializer, deserializer = TypeSerializer(), TypeDeserializer()
+
+    def pack():
+        return {k: serializer.serialize(v) for k, v in app.value_attributes(value).items()}
+
+    def unpack(attributes):
+        return app.item_value({k: deserializer.deserialize(v) for k, v in attributes.items()})
+
+    for compression in (None,) + encoding.COMPRESSIONS:
+        app.value_compression = compression and encoding.ValueCompression(compression)
+        pack_us, _ = timed(pack, repeat)
+        attributes = app.value_attributes(value)
+        unpack_us, _ = timed(lambda: unpack(pack()), repeat)
+        item = dict(attributes, username='user1', key=name, version=app.new_version())
+        res = app.ddb_table.put_item(Item=item, ReturnConsumedCapacity='TOTAL')
+        codec = attributes.get('codec', 'native' if compression is None else 'native, small')
+        print('{:<11} {:<9} {:<20} {:>9} {:>10.1f} {:>10.1f} {:>5.0f}'.format(
+            name, 'storage', codec, item_size(item), pack_us, unpack_us - pack_us,
+            res['ConsumedCapacity']['CapacityUnits']))
+    app.value_compression = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    backend = standin.Backend()
+    standin.seed(backend, {'bench': 'cell.local'})
+    app.init_clients(standin.session(backend))
+    print('{:<11} {:<9} {:<20} {:>9} {:>10} {:>10} {:>5}'.format(
+        'value', 'where', 'encoding', 'bytes', 'enc us', 'dec us', 'WCU'))
+    for name, value in payloads(random.Random(args.seed)).items():
+        bench_body(name, value, args.repeat)
+        bench_storage(name, value, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Local load benchmark of the sync (Flask) and async (ASGI) serving modes.
+
+Both apps run in-process against a stubbed DynamoDB table that answers
+every call after a fixed latency. A closed-loop load generator keeps
+--concurrency requests in flight (half /put, half /get) and reports
+throughput and latency percentiles per mode.
+
+Usage: python3 bench_serving.py --latency 10 --concurrency 64 --requests 5000
+"""
+import os
+import json
+import time
+import http.client
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('tableName', 'Cell-bench')
+os.environ.setdefault('cellId', 'bench')
+
+import uvicorn
+from werkzeug.serving import make_server
+import app
+import asgi
+
+
+class Table:
+    def __init__(self, latency):
+        self.latency = latency
+        self.items = {}
+
+    def put_item(self, Item):
+        time.sleep(self.latency)
+        self.items[(Item['username'], Item['key'])] = Item
+        return {}
+
+    def get_item(self, Key):
+        time.sleep(self.latency)
+        item = self.items.get((Key['username'], Key['key']))
+        return {'Item': item} if item else {}
+
+
+class AsyncTable(Table):
+    async def put_item(self, Item):
+        await asyncio.sleep(self.latency)
+        self.items[(Item['username'], Item['key'])] = Item
+        return {}
+
+    async def get_item(self, Key):
+        await asyncio.sleep(self.latency)
+        item = self.items.get((Key['username'], Key['key']))
+        return {'Item': item} if item else {}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def prefilled(table, users):
+    for w in range(users):
+        table.items[('user{}'.format(w), 'k')] = {'username': 'user{}'.format(w), 'key': 'k', 'value': 'v'}
+    return table
+
+
+def start_sync(latency, users):
+    app.ddb_table = prefilled(Table(latency), users)
+    server = make_server('127.0.0.1', free_port(), app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port), server.shutdown
+
+
+def start_async(latency, users):
+    asgi.aws.table = prefilled(AsyncTable(latency), users)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+    return 'http://127.0.0.1:{}'.format(port), stop
+
+
+def load(base_url, concurrency, total):
+    """Runs `total` requests from `concurrency` threads, each with its own
+    keep-alive connection."""
+    latencies = []
+    errors = []
+    counter = iter(range(total))
+    host, port = base_url.split('//')[1].split(':')
+
+    def worker(w):
+        conn = http.client.HTTPConnection(host, int(port), timeout=30)
+        headers = {'Authorization': 'Bearer user{}'.format(w), 'Content-Type': 'application/json'}
+        for i in counter:
+            uri, data = ('/put', {'key': 'k', 'value': 'v'}) if i % 2 == 0 else ('/get', {'key': 'k'})
+            start = time.perf_counter()
+            conn.request('POST', uri, json.dumps(data), headers)
+            r = conn.getresponse()
+            r.read()
+            latencies.append(time.perf_counter() - start)
+            if r.status != 200:
+                errors.append(r.status)
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - start, len(errors)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=10, help='DynamoDB latency in ms')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    print('{} requests, concurrency {}, DynamoDB latency {} ms'.format(
+        args.requests, args.concurrency, args.latency))
+    print('{:<6} {:>10} {:>9} {:>9} {:>7}'.format('mode', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for mode, start in (('sync', start_sync), ('async', start_async)):
+        base_url, stop = start(args.latency / 1000, args.concurrency)
+        try:
+            latencies, elapsed, errors = load(base_url, args.concurrency, args.requests)
+        finally:
+            stop()
+        print('{:<6} {:>10.0f} {:>9.1f} {:>9.1f} {:>7}'.format(
+            mode, len(latencies) / elapsed, percentile(latencies, 50) * 1e3,
+            percentile(latencies, 99) * 1e3, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Microbenchmarks for signed routing tokens (tokens.py).
+
+Reports the cost of issuing and verifying a token, and the time to reject
+signatures that differ in the first or in the last byte, which should be
+the same since signatures are compared in constant time.
+
+Usage: python3 bench_tokens.py --n 100000
+"""
+import os
+import json
+import base64
+import argparse
+import tempfile
+import timeit
+import tokens
+
+
+def forge(token, position):
+    message, signature = token.rsplit('.', 1)
+    raw = bytearray(tokens.b64decode(signature))
+    raw[position] ^= 1
+    return message + '.' + tokens.b64encode(bytes(raw))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n', type=int, default=100000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'current': 'k1', 'keys': {'k1': base64.b64encode(os.urandom(32)).decode()}}, f)
+    try:
+        keyring = tokens.KeyRing(path)
+        token = tokens.issue(keyring, 'user@example.com', 'cell1', 3600)
+        cases = [
+            ('issue', lambda: tokens.issue(keyring, 'user@example.com', 'cell1', 3600)),
+            ('verify', lambda: tokens.verify(keyring, token, 'cell1')),
+            ('reject first byte', lambda t=forge(token, 0): tokens.verify(keyring, t, 'cell1')),
+            ('reject last byte', lambda t=forge(token, -1): tokens.verify(keyring, t, 'cell1')),
+        ]
+        print('token: {} bytes'.format(len(token)))
+        for name, fn in cases:
+            best = min(timeit.repeat(fn, number=args.n, repeat=5)) / args.n
+            print('{:<18} {:7.2f} us/op'.format(name, best * 1e6))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Object store for values too large to keep in the cell table.
+
+A large value is written to a new object, and its item only keeps a
+pointer to it: {'ref', 'size', 'contentType'}. Objects are never
+overwritten. A write creates a new object and deletes the one it
+replaced once the item points to the new one, so a reader never sees a
+partly written value.
+
+Stores:
+
+- S3Store (blobStore=s3://bucket/prefix): uploads in parts of PART_SIZE,
+  so a writer holds at most one part in memory.
+- FileStore (blobStore=file:///path): a directory, the local stand-in for
+  S3.
+
+Both read and write in chunks, so the memory used per request does not
+depend on the size of the value.
+"""
+import os
+import uuid
+import hashlib
+from botocore.exceptions import ClientError
+import metrics
+
+# Size of the chunks read from requests and objects.
+CHUNK_SIZE = 64 * 1024
+# Size of the parts of an S3 multipart upload (S3's minimum is 5 MiB).
+PART_SIZE = 8 * 1024 * 1024
+
+
+class NotFound(Exception):
+    pass
+
+
+def new_ref(username):
+    """Name of a new object of the user. The username is hashed so that it
+    can hold any character."""
+    return '{}/{}'.format(hashlib.sha256(username.encode()).hexdigest()[:16], uuid.uuid4().hex)
+
+
+def chunks(f, size=CHUNK_SIZE):
+    """Yields the contents of a binary file object and closes it."""
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+
+class FileStore:
+    def __init__(self, root):
+        self.root = root
+
+    def connect(self, session=None, config=None, registry=None):
+        pass
+
+    def path(self, ref):
+        return os.path.join(self.root, *ref.split('/'))
+
+    def writer(self, ref):
+        return FileWriter(self.path(ref))
+
+    def open(self, ref):
+        try:
+            return chunks(open(self.path(ref), 'rb'))
+        except FileNotFoundError:
+            raise NotFound(ref)
+
+    def delete(self, ref):
+        try:
+            os.remove(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+
+class FileWriter:
+    """Writes to a temporary file that is renamed into place on close."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.tmp = '{}.{}.part'.format(path, uuid.uuid4().hex)
+        self.file = open(self.tmp, 'wb')
+        self.size = 0
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        """Returns the size of the object."""
+        self.file.close()
+        os.replace(self.tmp, self.path)
+        return self.size
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp)
+
+
+class S3Store:
+    """The S3 client is created by connect, called again in each gunicorn
+    worker like app.init_clients."""
+
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = None
+
+    def connect(self, session, config=None, registry=None):
+        self.client = session.client('s3', config=config)
+        if registry is not None:
+            metrics.instrument_client(self.client, registry)
+
+    def key(self, ref):
+        return self.prefix + ref
+
+    def writer(self, ref):
+        return S3Writer(self.client, self.bucket, self.key(ref))
+
+    def open(self, ref):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key(ref))['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise NotFound(ref)
+            raise
+        return chunks(body)
+
+    def delete(self, ref):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(ref))
+
+
+class S3Writer:
+    """Writes an object with one PutObject if it is smaller than PART_SIZE,
+    otherwise with a multipart upload."""
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def write(self, chunk):
+        self.buffer += chunk
+        self.size += len(chunk)
+        while len(self.buffer) >= PART_SIZE:
+            self._upload_part(bytes(self.buffer[:PART_SIZE]))
+            del self.buffer[:PART_SIZE]
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        res = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                      PartNumber=number, Body=data)
+        self.parts.append({'PartNumber': number, 'ETag': res['ETag']})
+
+    def close(self):
+        """Returns the size of the object."""
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        return self.size
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def from_env():
+    """Store configured by blobStore, or None if it is not set."""
+    url = os.environ.get('blobStore', '')
+    if not url:
+        return None
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        return S3Store(bucket, prefix)
+    if url.startswith('file://'):
+        return FileStore(url[len('file://'):])
+    raise ValueError('Unknown blobStore "{}"'.format(url))
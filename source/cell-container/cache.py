@@ -0,0 +1,276 @@
+"""Read cache of the cell's items, keyed by (username, key).
+
+/get reads through the cache. /put, /delete and the batch routes write the
+new value, or a tombstone for a deleted key, through it. Reads only add
+entries that are absent, so a read that raced with a write can't put back
+the value it read before the write. Entries expire after ttl seconds,
+which also bounds how stale the cache of another worker can be.
+
+Backends:
+
+- LocalBackend: in the process, bounded by the number of entries, with LRU
+  eviction or TinyLFU admission (a key read less often than the LRU victim
+  does not replace it). Each gunicorn worker has its own.
+- MemcachedBackend: a memcached server shared by all workers, e.g.
+  ElastiCache or the stand-in in source/standin/memcached.py.
+
+Configured with readCache ('' for off, 'local' or memcached://host:port),
+readCacheSize (entries), readCacheTtl (seconds) and readCachePolicy
+(tinylfu or lru).
+"""
+import os
+import json
+import math
+import time
+import socket
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Read capacity units of an eventually consistent read of up to 4 KB.
+RCU_PER_4KB = 0.5
+
+
+class FrequencySketch:
+    """Count-min sketch of how often keys were read recently, with 4-bit
+    counters that are halved every 10 * maxsize reads (TinyLFU)."""
+    DEPTH = 4
+
+    def __init__(self, maxsize):
+        self.width = 1 << max(6, (4 * maxsize - 1).bit_length())
+        self.rows = [bytearray(self.width) for _ in range(self.DEPTH)]
+        self.sample = 10 * maxsize
+        self.additions = 0
+
+    def indexes(self, key):
+        h = hash(key)
+        return [hash((h, i)) & (self.width - 1) for i in range(self.DEPTH)]
+
+    def increment(self, key):
+        added = False
+        for row, i in zip(self.rows, self.indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample:
+                self.rows = [bytearray(c >> 1 for c in row) for row in self.rows]
+                self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self.indexes(key)))
+
+
+class LocalBackend:
+    remote = False
+
+    def __init__(self, maxsize=10000, policy='tinylfu', clock=time.monotonic):
+        if policy not in ('tinylfu', 'lru'):
+            raise ValueError('Unknown readCachePolicy "{}"'.format(policy))
+        self.maxsize = maxsize
+        self.clock = clock
+        self.sketch = FrequencySketch(maxsize) if policy == 'tinylfu' else None
+        self.evictions = 0
+        self.rejections = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, username, key):
+        return username, key
+
+    def get(self, key):
+        with self._lock:
+            if self.sketch is not None:
+                self.sketch.increment(key)
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= self.clock():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        """Writes value; if the cache is full it replaces the LRU entry."""
+        with self._lock:
+            self._store(key, value, ttl, admit=False)
+
+    def add(self, key, value, ttl):
+        """Writes value unless the key has an entry. Returns True if written."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > self.clock():
+                return False
+            return self._store(key, value, ttl, admit=True)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _store(self, key, value, ttl, admit):
+        if key not in self._data and len(self._data) >= self.maxsize:
+            victim = next(iter(self._data))
+            if admit and self.sketch is not None and \
+                    self.sketch.estimate(key) <= self.sketch.estimate(victim):
+                self.rejections += 1
+                return False
+            del self._data[victim]
+            self.evictions += 1
+        self._data[key] = (value, self.clock() + ttl)
+        self._data.move_to_end(key)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize,
+                    'evictions': self.evictions, 'rejections': self.rejections}
+
+
+class MemcachedBackend:
+    """Client of the memcached text protocol with one connection per
+    thread. Errors are counted and make the cache miss; they never fail a
+    request."""
+    remote = True
+
+    def __init__(self, host, port=11211, namespace='', timeout=0.5):
+        self.address = (host, port)
+        self.namespace = namespace
+        self.timeout = timeout
+        self.errors = 0
+        self._local = threading.local()
+
+    def key(self, username, key):
+        digest = hashlib.sha256(json.dumps([username, key]).encode()).hexdigest()
+        return 'cell:{}:{}'.format(self.namespace, digest)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = sock.makefile('rwb')
+        return conn
+
+    def _call(self, command, data=None):
+        try:
+            conn = self._conn()
+            conn.write(command.encode() + b'\r\n')
+            if data is not None:
+                conn.write(data + b'\r\n')
+            conn.flush()
+            line = conn.readline()
+            if not line:
+                raise ConnectionError('Connection closed')
+            if not line.startswith(b'VALUE '):
+                return line.strip(), None
+            value = conn.read(int(line.split()[3]) + 2)[:-2]
+            conn.readline()  # END
+            return b'VALUE', value
+        except (OSError, ValueError, IndexError):
+            self.errors += 1
+            conn = getattr(self._local, 'conn', None)
+            self._local.conn = None
+            if conn is not None:
+                conn.close()
+            return None, None
+
+    def get(self, key):
+        status, value = self._call('get ' + key)
+        return json.loads(value) if status == b'VALUE' else None
+
+    def _store(self, command, key, value, ttl):
+        data = json.dumps(value, default=str).encode()
+        status, _ = self._call('{} {} 0 {} {}'.format(command, key, max(1, math.ceil(ttl)), len(data)), data)
+        return status == b'STORED'
+
+    def set(self, key, value, ttl):
+        self._store('set', key, value, ttl)
+
+    def add(self, key, value, ttl):
+        return self._store('add', key, value, ttl)
+
+    def delete(self, key):
+        self._call('delete ' + key)
+
+    def stats(self):
+        return {'server': '{}:{}'.format(*self.address), 'errors': self.errors}
+
+
+class ReadCache:
+    """Entries are {'value': value, 'version': version}, {'blob': blob,
+    'version': version} for a value in the object store (see blobs.py), or
+    {} for a key that does not exist."""
+
+    def __init__(self, backend, ttl=5, registry=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.registry = registry
+        self.hits = 0
+        self.misses = 0
+        self.rcu_saved = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, username, key):
+        entry = self.backend.get(self.backend.key(username, key))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                saved = read_units(username, key, entry)
+                self.hits += 1
+                self.rcu_saved += saved
+        if self.registry is not None:
+            self.registry.inc('read_cache_requests_total', {'result': 'miss' if entry is None else 'hit'})
+            if entry is not None:
+                self.registry.inc('read_cache_rcu_saved_total', value=saved)
+        return entry
+
+    def fill(self, username, key, entry):
+        """Caches what was read from the table, unless it was written since."""
+        return self.backend.add(self.backend.key(username, key), entry, self.ttl)
+
+    def set(self, username, key, entry):
+        self.backend.set(self.backend.key(username, key), entry, self.ttl)
+
+    def put(self, username, key, value, version):
+        self.set(username, key, {'value': value, 'version': version})
+
+    def delete(self, username, key):
+        self.backend.set(self.backend.key(username, key), {}, self.ttl)
+
+    def invalidate(self, username, key):
+        """For writes with an unknown outcome."""
+        self.backend.delete(self.backend.key(username, key))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {'hits': self.hits, 'misses': self.misses,
+                     'hitRatio': self.hits / lookups if lookups else 0.0,
+                     'rcuSaved': self.rcu_saved}
+        stats.update(self.backend.stats())
+        return stats
+
+
+def read_units(username, key, entry):
+    size = len(username) + len(key) + len(str(entry.get('value', '')))
+    return RCU_PER_4KB * max(1, math.ceil(size / 4096))
+
+
+def from_env(registry=None, namespace=''):
+    """ReadCache configured by readCache, readCacheSize, readCacheTtl and
+    readCachePolicy, or None if readCache is not set."""
+    kind = os.environ.get('readCache', '')
+    if not kind:
+        return None
+    if kind == 'local':
+        backend = LocalBackend(int(os.environ.get('readCacheSize', 10000)),
+                               os.environ.get('readCachePolicy', 'tinylfu'))
+    elif kind.startswith('memcached://'):
+        host, _, port = kind[len('memcached://'):].partition(':')
+        backend = MemcachedBackend(host, int(port or 11211), namespace)
+    else:
+        raise ValueError('Unknown readCache "{}"'.format(kind))
+    return ReadCache(backend, float(os.environ.get('readCacheTtl', 5)), registry)
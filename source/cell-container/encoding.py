@@ -0,0 +1,301 @@
+"""Body formats and compression of the cell routes, and of stored values.
+
+Request bodies can be JSON, msgpack or CBOR, as given by their
+Content-Type, and compressed with gzip or zstd (Content-Encoding). The
+format of response bodies is chosen by the Accept header, JSON by default.
+Responses of at least wireCompressionMinSize bytes (default 1024) are
+compressed with the first encoding of wireCompression (default zstd,gzip)
+that the client accepts. Streamed responses are sent as they are.
+
+Values can be compressed before they are written to the table: with
+valueCompression (zstd or gzip) set, a value whose msgpack encoding is at
+least valueCompressionThreshold bytes (default 1024) is stored as binary
+with a codec tag, e.g. 'msgpack+zstd', if that makes it smaller. Items
+without a tag hold the value as it is, so the setting can be changed at
+any time.
+"""
+import os
+import json
+import zlib
+import gzip
+from decimal import Decimal
+import cbor2
+import msgpack
+import zstandard
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+MEDIA_TYPES = (JSON, MSGPACK, CBOR)
+ALIASES = {'application/x-msgpack': MSGPACK, 'application/vnd.msgpack': MSGPACK}
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+COMPRESSIONS = (ZSTD, GZIP)
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Largest request body accepted after decompression.
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+
+class Error(ValueError):
+    status = 400
+
+
+class Unsupported(Error):
+    status = 415
+
+
+class TooLarge(Error):
+    status = 413
+
+
+def negotiate(header, offers):
+    """The offer the Accept or Accept-Encoding header prefers (by q, then
+    in the order of offers), or None."""
+    weights = {}
+    for part in (header or '').split(','):
+        name, *params = part.split(';')
+        q = 1.0
+        for param in params:
+            k, _, v = param.strip().partition('=')
+            if k == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for offer in offers:
+        group = offer.split('/')[0] + '/*'
+        q = weights.get(offer, weights.get(group, weights.get('*/*', weights.get('*', 0.0))))
+        if q > best_q:
+            best, best_q = offer, q
+    return best
+
+
+def accepted(header):
+    """Media type of a response to a request with this Accept header."""
+    return negotiate(header, MEDIA_TYPES) or JSON
+
+
+def _plain(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError('{} is not serializable'.format(type(value).__name__))
+
+
+def _plain_numbers(value):
+    """cbor2 encodes Decimals as decimal fractions, which JSON clients
+    don't expect."""
+    if isinstance(value, Decimal):
+        return _plain(value)
+    if isinstance(value, list):
+        return [_plain_numbers(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain_numbers(v) for k, v in value.items()}
+    return value
+
+
+def dumps(obj, media_type):
+    if media_type == MSGPACK:
+        return msgpack.packb(obj, default=_plain)
+    if media_type == CBOR:
+        return cbor2.dumps(_plain_numbers(obj))
+    return json.dumps(obj, default=_plain).encode()
+
+
+JSON_SCALARS = {str, int, float, bool, type(None), Decimal}
+CONTAINERS = {dict, list}
+
+
+def _check_json(value):
+    """msgpack and CBOR have types that JSON doesn't; values must be JSON.
+    Checks the types of each container's members at once, as it runs on
+    every msgpack and CBOR body."""
+    if type(value) not in CONTAINERS:
+        value = [value]
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if type(value) is dict:
+            if set(map(type, value)) - {str}:
+                raise Error('Map keys must be strings')
+            value = value.values()
+        kinds = set(map(type, value)) - JSON_SCALARS
+        if kinds - CONTAINERS:
+            raise Error('Unsupported type {}'.format(next(iter(kinds - CONTAINERS)).__name__))
+        if kinds:
+            stack.extend(v for v in value if type(v) in CONTAINERS)
+
+
+def loads(data, media_type):
+    """Decodes a request body; an empty body is None."""
+    media_type = ALIASES.get(media_type, media_type)
+    if media_type not in MEDIA_TYPES:
+        raise Unsupported('Content-Type must be one of {}'.format(', '.join(MEDIA_TYPES)))
+    if not data:
+        return None
+    try:
+        if media_type == JSON:
+            return json.loads(data)
+        value = msgpack.unpackb(data) if media_type == MSGPACK else cbor2.loads(data)
+    except Exception as e:
+        raise Error('Invalid {} body: {}'.format(media_type, e))
+    _check_json(value)
+    return value
+
+
+def compress(data, encoding):
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == GZIP:
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    raise Unsupported('Unknown encoding "{}"'.format(encoding))
+
+
+def decompress(data, encoding, limit=MAX_BODY_SIZE):
+    """Decompresses data with the encoding of a Content-Encoding header, to
+    at most limit bytes (None for no limit)."""
+    encoding = (encoding or 'identity').strip().lower()
+    try:
+        if encoding == 'identity':
+            out = data
+        elif encoding == GZIP:
+            out = zlib.decompressobj(wbits=31).decompress(data, 0 if limit is None else limit + 1)
+        elif encoding == ZSTD and limit is None:
+            # Frames written by compress() have their size in the header.
+            out = zstandard.ZstdDecompressor().decompress(data)
+        elif encoding == ZSTD:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                out = reader.read(limit + 1)
+        else:
+            raise Unsupported('Content-Encoding must be one of identity, {}'.format(', '.join(COMPRESSIONS)))
+    except (zlib.error, zstandard.ZstdError) as e:
+        raise Error('Invalid {} body: {}'.format(encoding, e))
+    if limit is not None and len(out) > limit:
+        raise TooLarge('The body is larger than {} bytes'.format(limit))
+    return out
+
+
+# Stored values
+
+class ValueCompression:
+    def __init__(self, compression=ZSTD, threshold=1024):
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown valueCompression "{}"'.format(compression))
+        self.compression = compression
+        self.threshold = threshold
+
+    def pack(self, value):
+        """(data, codec) of the value, or None to store it as it is."""
+        data = msgpack.packb(value, default=_plain)
+        if len(data) < self.threshold:
+            return None
+        packed = compress(data, self.compression)
+        if len(packed) >= len(data):
+            return None
+        return packed, 'msgpack+' + self.compression
+
+
+def unpack(data, codec):
+    """The value stored by ValueCompression.pack."""
+    fmt, _, compression = codec.partition('+')
+    if fmt != 'msgpack':
+        raise ValueError('Unknown codec "{}"'.format(codec))
+    return msgpack.unpackb(decompress(data, compression, limit=None))
+
+
+def from_env():
+    """ValueCompression configured by valueCompression and
+    valueCompressionThreshold, or None if valueCompression is not set."""
+    compression = os.environ.get('valueCompression', '')
+    if not compression:
+        return None
+    return ValueCompression(compression, int(os.environ.get('valueCompressionThreshold', 1024)))
+
+
+def wire_from_env():
+    """(encodings, min_size) of response compression, from wireCompression
+    ('' for none) and wireCompressionMinSize."""
+    encodings = [e.strip() for e in os.environ.get('wireCompression', 'zstd,gzip').split(',') if e.strip()]
+    for e in encodings:
+        if e not in COMPRESSIONS:
+            raise ValueError('Unknown wireCompression "{}"'.format(e))
+    return encodings, int(os.environ.get('wireCompressionMinSize', 1024))
+
+
+# Frameworks
+
+def instrument_flask(app, encodings, min_size):
+    """Encodes the responses of app built from dicts (and jsonify) in the
+    accepted format, and compresses responses."""
+    from flask import request
+    from flask.json.provider import DefaultJSONProvider
+
+    class Provider(DefaultJSONProvider):
+        def response(self, *args, **kwargs):
+            media_type = accepted(request.headers.get('Accept'))
+            if media_type == JSON:
+                response = super().response(*args, **kwargs)
+            else:
+                obj = args[0] if len(args) == 1 else args or kwargs
+                response = app.response_class(dumps(obj, media_type), mimetype=media_type)
+            response.vary.add('Accept')
+            return response
+
+    app.json = Provider(app)
+
+    @app.after_request
+    def compress_response(response):
+        if not encodings or response.is_streamed or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.headers.get('Accept-Encoding'), encodings)
+        if encoding is None or 'Content-Encoding' in response.headers or \
+                response.content_length is None or response.content_length < min_size:
+            return response
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+class AsgiCompression:
+    """ASGI middleware compressing responses as instrument_flask does.
+    Responses sent in more than one body message are streamed; they are
+    sent as they are."""
+
+    def __init__(self, app, encodings, min_size):
+        self.app = app
+        self.encodings = encodings
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.encodings:
+            return await self.app(scope, receive, send)
+        header = dict(scope['headers']).get(b'accept-encoding', b'').decode('latin-1')
+        encoding = negotiate(header, self.encodings)
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if start is None:
+                return await send(message)
+            headers = [(k, v) for k, v in start['headers'] if k.lower() != b'vary']
+            vary = [v for k, v in start['headers'] if k.lower() == b'vary']
+            headers.append((b'vary', b', '.join(vary + [b'Accept-Encoding'])))
+            body = message.get('body', b'')
+            if encoding is not None and not message.get('more_body') and len(body) >= self.min_size \
+                    and not any(k.lower() == b'content-encoding' for k, _ in headers):
+                body = compress(body, encoding)
+                headers = [(k, v) for k, v in headers if k.lower() != b'content-length']
+                headers += [(b'content-encoding', encoding.encode()), (b'content-length', str(len(body)).encode())]
+                message = dict(message, body=body)
+            await send(dict(start, headers=headers))
+            start = None
+            await send(message)
+        await self.app(scope, receive, send_compressed)
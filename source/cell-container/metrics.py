@@ -0,0 +1,301 @@
+"""Request and downstream call metrics.
+
+Keeps counters, gauges and latency histograms in memory per process,
+renders them in the Prometheus text format for /metrics and, if enabled,
+writes them periodically to stdout as CloudWatch Embedded Metric Format
+(EMF) records. Also samples one structured log line per request instead of
+logging every request body.
+
+Shared by the router and the cell container; keep both copies identical
+(cell-container/test_metrics.py checks).
+"""
+import os
+import json
+import time
+import random
+import threading
+
+# Histogram buckets in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Raw observations per series and EMF interval; CloudWatch computes
+# percentiles from them.
+EMF_SAMPLES = 100
+THROTTLE_CODES = {'ProvisionedThroughputExceededException', 'ThrottlingException',
+                  'Throttling', 'RequestLimitExceeded', 'TooManyRequestsException'}
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests by route, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'Request latency by route and method.'),
+    'http_requests_in_flight': ('gauge', 'Requests being served.'),
+    'aws_calls_total': ('counter', 'AWS API calls by service, operation and outcome.'),
+    'aws_call_duration_seconds': ('histogram', 'AWS API call latency, retries included.'),
+    'aws_throttles_total': ('counter', 'Throttled AWS API call attempts.'),
+    'dynamodb_unprocessed_items_total': ('counter', 'Items a batch call left unprocessed.'),
+    'read_cache_requests_total': ('counter', 'Read cache lookups by result (hit or miss).'),
+    'read_cache_rcu_saved_total': ('counter', 'Read capacity units not consumed thanks to cache hits.'),
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.samples = []
+        # Observations since the samples were last emitted.
+        self.sampled = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+        self.sampled += 1
+        # Reservoir sample of this EMF interval.
+        if len(self.samples) < EMF_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            j = random.randrange(self.sampled)
+            if j < EMF_SAMPLES:
+                self.samples[j] = seconds
+
+
+class Registry:
+    """Metric series keyed by name and labels. labels are added to every
+    series, e.g. {'cellId': 'cell1'}."""
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.lock = threading.Lock()
+        self.series = {}
+        self.emitted = {}
+        self._emf_pid = None
+
+    def key(self, name, labels):
+        return name, tuple(sorted(dict(self.labels, **(labels or {})).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = self.key(name, labels)
+        with self.lock:
+            h = self.series.get(key)
+            if h is None:
+                h = self.series[key] = Histogram()
+            h.observe(seconds)
+
+    def value(self, name, labels=None):
+        """Current value of a counter or gauge (tests, /stats)."""
+        with self.lock:
+            return self.series.get(self.key(name, labels), 0)
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            by_name = {}
+            for (name, labels), value in sorted(self.series.items(), key=lambda s: s[0]):
+                by_name.setdefault(name, []).append((labels, value))
+            for name, series in by_name.items():
+                kind, text = HELP.get(name, ('untyped', name))
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in series:
+                    if isinstance(value, Histogram):
+                        cumulative = 0
+                        for bound, count in zip(BUCKETS + ('+Inf',), value.counts):
+                            cumulative += count
+                            lines.append('{}_bucket{} {}'.format(
+                                name, label_text(labels + (('le', str(bound)),)), cumulative))
+                        lines.append('{}_sum{} {}'.format(name, label_text(labels), value.sum))
+                        lines.append('{}_count{} {}'.format(name, label_text(labels), value.count))
+                    else:
+                        lines.append('{}{} {}'.format(name, label_text(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def emf_records(self, namespace='Cellular', now=None):
+        """EMF records with what changed since the previous call: counter
+        deltas and latency samples, one record per series."""
+        timestamp = int((now or time.time()) * 1000)
+        records = []
+        with self.lock:
+            for (name, labels), value in sorted(self.series.items(), key=lambda s: s[0]):
+                kind = HELP.get(name, ('untyped',))[0]
+                if isinstance(value, Histogram):
+                    if not value.samples:
+                        continue
+                    metric, unit = name, 'Milliseconds'
+                    data = [round(s * 1000, 3) for s in value.samples]
+                    value.samples, value.sampled = [], 0
+                elif kind == 'counter':
+                    delta = value - self.emitted.get((name, labels), 0)
+                    self.emitted[(name, labels)] = value
+                    if not delta:
+                        continue
+                    metric, unit, data = name, 'Count', delta
+                else:
+                    metric, unit, data = name, 'None', value
+                record = dict(labels)
+                record[metric] = data
+                record['_aws'] = {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [[k for k, _ in labels]],
+                        'Metrics': [{'Name': metric, 'Unit': unit}],
+                    }],
+                }
+                records.append(record)
+        return records
+
+    def start_emf(self, interval, namespace='Cellular', out=None):
+        """Writes EMF records every interval seconds from a daemon thread.
+        Safe to call on every request: starts one thread per process, also
+        after a fork."""
+        if self._emf_pid == os.getpid():
+            return
+        self._emf_pid = os.getpid()
+        out = out or (lambda line: print(line, flush=True))
+
+        def flush():
+            while True:
+                time.sleep(interval)
+                for record in self.emf_records(namespace):
+                    out(json.dumps(record))
+        threading.Thread(target=flush, daemon=True).start()
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def instrument_client(client, registry):
+    """Records latency, outcome and throttled attempts of every call of a
+    botocore (or aiobotocore) client."""
+    service = client.meta.service_model.service_name
+
+    def before(context, model, **kwargs):
+        context['metricsStart'] = time.perf_counter()
+
+    def after(context, model, http_response=None, parsed=None, **kwargs):
+        # Also fired for error responses, before botocore raises ClientError.
+        failed = 'Error' in (parsed or {}) or (http_response is not None and http_response.status_code >= 300)
+        record(context, model.name, 'error' if failed else 'ok')
+        unprocessed = (parsed or {}).get('UnprocessedItems') or (parsed or {}).get('UnprocessedKeys')
+        if unprocessed:
+            count = sum(len(v) if isinstance(v, list) else len(v.get('Keys', []))
+                        for v in unprocessed.values())
+            registry.inc('dynamodb_unprocessed_items_total', {'operation': model.name}, count)
+
+    def after_error(context, event_name, **kwargs):
+        # after-call-error.<service>.<operation>, without the model.
+        record(context, event_name.rsplit('.', 1)[-1], 'error')
+
+    def record(context, operation, outcome):
+        start = context.get('metricsStart')
+        labels = {'service': service, 'operation': operation}
+        registry.inc('aws_calls_total', dict(labels, outcome=outcome))
+        if start is not None:
+            registry.observe('aws_call_duration_seconds', labels, time.perf_counter() - start)
+
+    def needs_retry(response, operation, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            registry.inc('aws_throttles_total', {'service': service, 'operation': operation.name})
+
+    events = client.meta.events
+    events.register('before-call', before)
+    events.register('after-call', after)
+    events.register('after-call-error', after_error)
+    # Registered first so it runs before the retry handler decides.
+    events.register_first('needs-retry', needs_retry)
+    return client
+
+
+class RequestTimer:
+    """Per-request bookkeeping shared by the Flask and ASGI middlewares."""
+
+    def __init__(self, registry, sample_rate=0.0, emf_interval=0, out=None):
+        self.registry = registry
+        self.sample_rate = sample_rate
+        self.emf_interval = emf_interval
+        self.out = out or (lambda line: print(line, flush=True))
+
+    def start(self):
+        if self.emf_interval:
+            self.registry.start_emf(self.emf_interval)
+        self.registry.inc('http_requests_in_flight')
+        return time.perf_counter()
+
+    def finish(self, start, route, method, status, user=None):
+        seconds = time.perf_counter() - start
+        self.registry.inc('http_requests_in_flight', value=-1)
+        self.registry.inc('http_requests_total', {'route': route, 'method': method, 'status': str(status)})
+        self.registry.observe('http_request_duration_seconds', {'route': route, 'method': method}, seconds)
+        if self.sample_rate and random.random() < self.sample_rate:
+            self.out(json.dumps(dict(self.registry.labels, route=route, method=method, status=status,
+                                     latencyMs=round(seconds * 1000, 3), user=user)))
+
+
+def from_env(registry):
+    """RequestTimer configured by logSampleRate (fraction of requests logged,
+    default 0.01) and emfInterval (seconds, 0 disables EMF)."""
+    return RequestTimer(registry,
+                        sample_rate=float(os.environ.get('logSampleRate', 0.01)),
+                        emf_interval=float(os.environ.get('emfInterval', 0)))
+
+
+def instrument_flask(app, timer, current_user=lambda: None):
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = timer.start()
+
+    @app.after_request
+    def keep_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def stop_timer(exc):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = 500 if exc is not None else g.pop('metrics_status', 500)
+        timer.finish(start, route, request.method, status, current_user())
+
+
+class AsgiMetrics:
+    """ASGI middleware doing what instrument_flask does. paths are the
+    routes of the app; other paths are recorded as 'unmatched'."""
+
+    def __init__(self, app, timer, paths, current_user=lambda scope: None):
+        self.app = app
+        self.timer = timer
+        self.paths = set(paths)
+        self.current_user = current_user
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = self.timer.start()
+        status = [500]
+
+        async def send_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope['path'] if scope['path'] in self.paths else 'unmatched'
+            self.timer.finish(start, route, scope['method'], status[0], self.current_user(scope))
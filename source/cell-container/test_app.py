@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import base64
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('tableName', 'Cell-test')
+os.environ.setdefault('cellId', 'test')
+
+from botocore.stub import Stubber, ANY
+import app
+import batch
+import metrics
+import tokens
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+batch.BASE_DELAY = 0
+TABLE = 'Cell-test'
+
+
+def put_request(key, value):
+    return {'PutRequest': {'Item': {'username': 'user1', 'key': key, 'value': value, 'version': ANY}}}
+
+
+def ddb_put_request(key, value):
+    return {'PutRequest': {'Item': {'username': {'S': 'user1'}, 'key': {'S': key}, 'value': {'S': value},
+                                    'version': {'S': 'v1'}}}}
+
+
+class CellTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+        self.ddb = Stubber(app.dynamodb.meta.client)
+        self.ddb.activate()
+
+    def tearDown(self):
+        self.ddb.assert_no_pending_responses()
+        self.ddb.deactivate()
+
+    def post(self, uri, json, username='user1'):
+        return self.client.post(uri, json=json, headers={'Authorization': 'Bearer ' + username})
+
+
+class TestBatch(CellTestCase):
+    def test_put_chunks_and_retries_unprocessed(self):
+        items = [{'key': 'k{}'.format(i), 'value': 'v'} for i in range(30)]
+        first = [put_request(i['key'], 'v') for i in items[:25]]
+        self.ddb.add_response('batch_write_item',
+                              {'UnprocessedItems': {TABLE: [ddb_put_request('k3', 'v')]}},
+                              {'RequestItems': {TABLE: first}})
+        self.ddb.add_response('batch_write_item', {'UnprocessedItems': {}},
+                              {'RequestItems': {TABLE: [put_request('k3', 'v')]}})
+        self.ddb.add_response('batch_write_item', {'UnprocessedItems': {}},
+                              {'RequestItems': {TABLE: [put_request(i['key'], 'v') for i in items[25:]]}})
+        r = self.post('/batch/put', {'items': items})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual({x['status'] for x in r.json['results']}, {'ok'})
+
+    def test_put_reports_failed_keys(self):
+        for _ in range(batch.MAX_ATTEMPTS):
+            self.ddb.add_response('batch_write_item',
+                                  {'UnprocessedItems': {TABLE: [ddb_put_request('k1', 'v')]}})
+        r = self.post('/batch/put', {'items': [{'key': 'k1', 'value': 'v'}, {'key': 'k2', 'value': 'v'}]})
+        self.assertEqual(r.json['results'], [{'key': 'k1', 'status': 'failed'}, {'key': 'k2', 'status': 'ok'}])
+
+    def test_put_rejects_bad_items(self):
+        for items in [['k1'], [{'key': 'k1'}], [{'value': 'v'}], [{'key': ['k1'], 'value': 'v'}]]:
+            self.assertEqual(self.post('/batch/put', {'items': items}).status_code, 400, items)
+        items = [{'key': 'k1', 'value': 'v'}, {'key': 'k2', 'value': 'x' * 400 * 1024}]
+        r = self.post('/batch/put', {'items': items})
+        self.assertEqual(r.status_code, 413)
+        self.assertIn('k2', r.get_data(as_text=True))
+
+    def test_get(self):
+        self.ddb.add_response('batch_get_item', {
+            'Responses': {TABLE: [{'key': {'S': 'k1'}, 'value': {'S': 'v1'}, 'version': {'S': 'a1'}}]},
+            'UnprocessedKeys': {},
+        }, {'RequestItems': {TABLE: {
+            'Keys': [{'username': 'user1', 'key': 'k1'}, {'username': 'user1', 'key': 'k2'}],
+            'ProjectionExpression': ANY, 'ExpressionAttributeNames': ANY,
+        }}})
+        r = self.post('/batch/get', {'keys': ['k1', 'k2', 'k1']})
+        self.assertEqual(r.json['results'], [
+            {'key': 'k1', 'status': 'ok', 'value': 'v1', 'version': 'a1'},
+            {'key': 'k2', 'status': 'not_found'},
+        ])
+
+    def test_delete(self):
+        self.ddb.add_response('batch_write_item', {}, {'RequestItems': {TABLE: [
+            {'DeleteRequest': {'Key': {'username': 'user1', 'key': 'k1'}}}]}})
+        r = self.post('/batch/delete', {'keys': ['k1']})
+        self.assertEqual(r.json['results'], [{'key': 'k1', 'status': 'ok'}])
+
+    def test_too_many_keys(self):
+        r = self.post('/batch/get', {'keys': ['k'] * (app.max_batch_size + 1)})
+        self.assertEqual(r.status_code, 413)
+
+    def test_bad_request(self):
+        r = self.post('/batch/delete', {'keys': 'k1'})
+        self.assertEqual(r.status_code, 400)
+
+
+class TestList(CellTestCase):
+    def expect_query(self, keys, last_key=None, **expected):
+        res = {'Items': [{'username': {'S': 'user1'}, 'key': {'S': k}, 'value': {'S': 'v'}} for k in keys]}
+        if last_key:
+            res['LastEvaluatedKey'] = {'username': {'S': 'user1'}, 'key': {'S': last_key}}
+        expected = dict({'TableName': TABLE, 'KeyConditionExpression': ANY}, **expected)
+        self.ddb.add_response('query', res, expected)
+
+    def test_pages(self):
+        self.expect_query(['a1', 'a2'], last_key='a2', Limit=2)
+        self.expect_query(['a3'], Limit=2, ExclusiveStartKey={'username': 'user1', 'key': 'a2'})
+        r = self.post('/list', {'prefix': 'a', 'limit': 2})
+        self.assertEqual([i['key'] for i in r.json['items']], ['a1', 'a2'])
+        r = self.post('/list', {'prefix': 'a', 'limit': 2, 'token': r.json['token']})
+        self.assertEqual(r.json, {'items': [{'key': 'a3', 'value': 'v'}], 'token': None})
+
+    def test_token_of_other_user_rejected(self):
+        token = app.encode_token({'username': 'user2', 'key': 'a'})
+        r = self.post('/list', {'token': token})
+        self.assertEqual(r.status_code, 400)
+
+    def test_garbage_token_rejected(self):
+        self.assertEqual(self.post('/list', {'token': '!!'}).status_code, 400)
+
+
+class TestSignedTokens(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'current': 'k1', 'keys': {'k1': base64.b64encode(b'a' * 32).decode()}}, f)
+        app.keyring = tokens.KeyRing(self.path)
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.keyring = None
+        os.remove(self.path)
+
+    def validate(self, token):
+        return self.client.get('/validate', headers={'Authorization': 'Bearer ' + token})
+
+    def test_token_for_this_cell(self):
+        r = self.validate(tokens.issue(app.keyring, 'user1', 'test', 60))
+        self.assertEqual(r.json, {'username': 'user1', 'cellid': 'test'})
+
+    def test_token_for_other_cell(self):
+        self.assertEqual(self.validate(tokens.issue(app.keyring, 'user1', 'other', 60)).status_code, 401)
+
+    def test_plain_username_rejected(self):
+        self.assertEqual(self.validate('user1').status_code, 401)
+
+
+class TestStandIn(unittest.TestCase):
+    """Cell end to end against the in-memory DynamoDB, with throttling."""
+
+    def setUp(self):
+        self.backend = standin.Backend(seed=1)
+        standin.seed(self.backend, {'test': 'cell.local'})
+        app.init_clients(standin.session(self.backend))
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.init_clients()
+
+    def post(self, uri, json, username='user1', **headers):
+        headers = dict(headers, Authorization='Bearer ' + username)
+        return self.client.post(uri, json=json, headers=headers)
+
+    def test_put_get_delete(self):
+        self.assertEqual(self.post('/put', {'key': 'k', 'value': 'v'}).status_code, 200)
+        self.assertEqual(self.post('/get', {'key': 'k'}).json, {'value': 'v'})
+        self.assertEqual(self.post('/get', {'key': 'k'}, username='user2').status_code, 404)
+        self.post('/delete', {'key': 'k'})
+        self.assertEqual(self.post('/get', {'key': 'k'}).status_code, 404)
+
+    def test_versions(self):
+        etag = self.post('/put', {'key': 'k', 'value': 'v1'}).headers['ETag']
+        r = self.post('/get', {'key': 'k'})
+        self.assertEqual(r.headers['ETag'], etag)
+        r = self.post('/put', {'key': 'k', 'value': 'v2'}, **{'If-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+        # The version read before the last write no longer matches; the
+        # response has the current item.
+        r = self.post('/put', {'key': 'k', 'value': 'v3'}, **{'If-Match': etag})
+        self.assertEqual((r.status_code, r.json), (412, {'value': 'v2'}))
+        r = self.post('/delete', {'key': 'k'}, **{'If-Match': r.headers['ETag']})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.post('/put', {'key': 'k', 'value': 'v'}, **{'If-Match': '*'}).status_code, 412)
+        self.assertEqual(self.post('/put', {'key': 'k', 'value': 'v'}, **{'If-None-Match': '*'}).status_code, 200)
+        self.assertEqual(self.post('/put', {'key': 'k', 'value': 'v'}, **{'If-None-Match': '*'}).status_code, 412)
+        self.assertEqual(self.post('/put', {'key': 'k', 'value': 'v'}, **{'If-Match': 'v1'}).status_code, 400)
+
+    def test_unversioned_item(self):
+        app.ddb_table.put_item(Item={'username': 'user1', 'key': 'k', 'value': 'old'})
+        r = self.post('/get', {'key': 'k'})
+        self.assertEqual(r.headers['ETag'], '"0"')
+        self.assertEqual(self.post('/delete', {'key': 'k'}, **{'If-Match': '"0"'}).status_code, 200)
+        self.assertEqual(self.post('/put', {'key': 'k', 'value': 'v'}, **{'If-Match': '"0"'}).status_code, 412)
+
+    def test_increment_and_append(self):
+        self.assertEqual(self.post('/increment', {'key': 'n'}).json, {'value': 1})
+        r = self.post('/increment', {'key': 'n', 'by': 2.5})
+        self.assertEqual(r.json, {'value': 3.5})
+        self.assertEqual(self.post('/increment', {'key': 'n', 'by': -1}, **{'If-Match': r.headers['ETag']}).json,
+                         {'value': 2.5})
+        self.assertEqual(self.post('/increment', {'key': 'n'}, **{'If-Match': r.headers['ETag']}).status_code, 412)
+        self.assertEqual(self.post('/increment', {'key': 'n', 'by': 'x'}).status_code, 400)
+        self.assertEqual(self.post('/get', {'key': 'n'}).json, {'value': 2.5})
+
+        self.post('/append', {'key': 'l', 'values': ['a']})
+        self.assertEqual(self.post('/append', {'key': 'l', 'values': ['b', 1]}).json, {'value': ['a', 'b', 1]})
+        self.assertEqual(self.post('/append', {'key': 'l', 'values': 'c'}).status_code, 400)
+        self.assertEqual(self.post('/increment', {'key': 'l'}).status_code, 409)
+        self.post('/put', {'key': 's', 'value': 'text'})
+        self.assertEqual(self.post('/append', {'key': 's', 'values': ['x']}).status_code, 409)
+
+    def test_batch_under_throttling_and_list(self):
+        self.backend.throttle = 0.3
+        items = [{'key': 'k{:03}'.format(i), 'value': str(i)} for i in range(120)]
+        r = self.post('/batch/put', {'items': items})
+        self.assertEqual({x['status'] for x in r.json['results']}, {'ok'})
+        self.assertGreater(self.backend.stats()['requests']['BatchWriteItem'], 5)
+        r = self.post('/batch/get', {'keys': ['k000', 'k119', 'nope']})
+        self.assertEqual([x['status'] for x in r.json['results']], ['ok', 'ok', 'not_found'])
+
+        self.backend.throttle = 0
+        keys, token = [], None
+        while True:
+            page = self.post('/list', {'prefix': 'k1', 'limit': 7, 'keysOnly': True, 'token': token}).json
+            keys += [i['key'] for i in page['items']]
+            token = page['token']
+            if not token:
+                break
+        self.assertEqual(keys, ['k{:03}'.format(i) for i in range(100, 120)])
+
+    def test_metrics(self):
+        app.registry.series.clear()
+        self.backend.throttle = 0.5
+        self.post('/put', {'key': 'k', 'value': 'v'})
+        self.post('/get', {'key': 'k'})
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{cellId="test",method="POST",route="/put"}', text)
+        self.assertIn('aws_calls_total{cellId="test",operation="PutItem",outcome="ok",service="dynamodb"}', text)
+        throttles = app.registry.value('aws_throttles_total', {'service': 'dynamodb', 'operation': 'PutItem'}) + \
+            app.registry.value('aws_throttles_total', {'service': 'dynamodb', 'operation': 'GetItem'})
+        self.assertGreater(throttles, 0)
+        self.assertEqual(throttles, self.backend.stats()['throttled'].get('PutItem', 0)
+                         + self.backend.stats()['throttled'].get('GetItem', 0))
+
+    def test_sampled_request_log(self):
+        lines = []
+        timer = metrics.RequestTimer(app.registry, sample_rate=1, out=lines.append)
+        start = timer.start()
+        timer.finish(start, '/put', 'POST', 200, 'user1')
+        line = json.loads(lines[0])
+        self.assertEqual((line['cellId'], line['route'], line['status'], line['user']),
+                         ('test', '/put', 200, 'user1'))
+        self.assertNotIn('value', line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import gzip
+import tempfile
+import unittest
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('tableName', 'Cell-test')
+os.environ.setdefault('cellId', 'test')
+
+import msgpack
+from starlette.testclient import TestClient
+import asgi
+import blobs
+import encoding
+
+
+class AsyncTable:
+    def __init__(self):
+        self.items = {}
+
+    async def put_item(self, Item, **kwargs):
+        self.items[(Item['username'], Item['key'])] = Item
+        return {}
+
+    async def get_item(self, Key):
+        item = self.items.get((Key['username'], Key['key']))
+        return {'Item': item} if item else {}
+
+    async def delete_item(self, Key):
+        self.items.pop((Key['username'], Key['key']), None)
+        return {}
+
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        asgi.aws.table = AsyncTable()
+        self.client = TestClient(asgi.app)
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        asgi.aws.table = None
+
+    def post(self, uri, json, token='user1'):
+        return self.client.post(uri, json=json, headers={'Authorization': 'Bearer ' + token})
+
+    def test_requires_token(self):
+        r = self.client.post('/get', json={'key': 'k1'})
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.text, 'Unauthorized Access')
+
+    def test_put_get_delete(self):
+        r = self.post('/put', {'key': 'k1', 'value': 'v1'})
+        self.assertEqual(r.text, 'Success')
+        self.assertEqual(self.post('/get', {'key': 'k1'}).json(), {'value': 'v1'})
+        self.assertEqual(self.post('/get', {'key': 'k1'}).headers['ETag'], r.headers['ETag'])
+        self.assertEqual(self.post('/get', {'key': 'k1'}, token='user2').status_code, 404)
+        self.post('/delete', {'key': 'k1'})
+        self.assertEqual(self.post('/get', {'key': 'k1'}).status_code, 404)
+
+    def test_stream(self):
+        with tempfile.TemporaryDirectory() as root:
+            asgi.flask_app.blob_store = blobs.FileStore(root)
+            try:
+                data = os.urandom(200000)
+                r = self.client.post('/stream/put?key=f', content=iter([data[:1000], data[1000:]]),
+                                     headers={'Authorization': 'Bearer user1', 'Content-Type': 'text/csv'})
+                self.assertEqual(r.status_code, 200)
+                r = self.client.get('/stream/get?key=f', headers={'Authorization': 'Bearer user1'})
+                self.assertEqual((r.content, r.headers['Content-Type']), (data, 'text/csv'))
+                self.assertEqual(self.post('/get', {'key': 'f'}).status_code, 409)
+            finally:
+                asgi.flask_app.blob_store = None
+
+    def test_encoding(self):
+        value = ['item {}'.format(i) for i in range(500)]
+        headers = {'Authorization': 'Bearer user1', 'Content-Type': encoding.MSGPACK, 'Content-Encoding': 'gzip'}
+        r = self.client.post('/put', content=gzip.compress(msgpack.packb({'key': 'k', 'value': value})),
+                             headers=headers)
+        self.assertEqual(r.text, 'Success')
+        r = self.client.post('/get', json={'key': 'k'}, headers={
+            'Authorization': 'Bearer user1', 'Accept': encoding.MSGPACK, 'Accept-Encoding': 'zstd'})
+        self.assertEqual((r.headers['Content-Type'], r.headers['Content-Encoding']), (encoding.MSGPACK, 'zstd'))
+        self.assertEqual(msgpack.unpackb(r.content), {'value': value})
+
+    def test_bad_bodies(self):
+        headers = {'Authorization': 'Bearer user1'}
+        for content, content_type, status in [(b'', encoding.JSON, 400), (b'{"key"', encoding.JSON, 400),
+                                              (b'\xc1', encoding.MSGPACK, 400), (b'[1]', encoding.JSON, 400),
+                                              (b'key=k', 'text/plain', 415)]:
+            r = self.client.post('/get', content=content, headers=dict(headers, **{'Content-Type': content_type}))
+            self.assertEqual(r.status_code, status, content)
+        # Flask, the ASGI app and the router all need a Content-Type.
+        self.assertEqual(self.client.post('/get', content=b'{"key": "k"}', headers=headers).status_code, 415)
+        r = self.client.post('/batch/get', content=b'', headers=dict(headers, **{'Content-Type': encoding.JSON}))
+        self.assertEqual((r.status_code, r.text), (400, 'Missing request body'))
+
+    def test_batch_put_rejects_bad_items(self):
+        self.assertEqual(self.post('/batch/put', {'items': [{'key': 'k1'}]}).status_code, 400)
+        self.assertEqual(self.post('/batch/put', {'items': [{'key': 'k1', 'value': 'x' * 400 * 1024}]}).status_code,
+                         413)
+
+    def test_health(self):
+        r = self.client.get('/health')
+        self.assertEqual((r.status_code, r.text), (200, 'OK'))
+        self.assertEqual(self.client.get('/stats').json(), {'readCache': None})
+
+    def test_validate(self):
+        r = self.client.get('/validate', headers={'Authorization': 'Bearer user1'})
+        self.assertEqual(r.json(), {'username': 'user1', 'cellid': 'test'})
+
+    def test_metrics(self):
+        self.post('/put', {'key': 'k1', 'value': 'v1'})
+        self.client.post('/nope')
+        text = self.client.get('/metrics').text
+        self.assertIn('http_requests_total{cellId="test",method="POST",route="/put",status="200"}', text)
+        self.assertIn('route="unmatched",status="404"', text)
+        self.assertIn('http_requests_in_flight{cellId="test"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
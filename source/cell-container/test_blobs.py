@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('tableName', 'Cell-test')
+os.environ.setdefault('cellId', 'test')
+
+import app
+import blobs
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+
+class FakeS3:
+    def __init__(self):
+        self.calls = []
+        self.objects = {}
+        self.uploads = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append('PutObject')
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append('CreateMultipartUpload')
+        self.uploads['u1'] = {}
+        return {'UploadId': 'u1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append('UploadPart')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': 'e{}'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append('CompleteMultipartUpload')
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('AbortMultipartUpload')
+        del self.uploads[UploadId]
+
+
+class Zeros(io.RawIOBase):
+    """A request body of n bytes that is never in memory at once."""
+
+    def __init__(self, n):
+        self.size = n
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.pos = offset + (self.size if whence == io.SEEK_END else self.pos if whence == io.SEEK_CUR else 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        b[:n] = bytes(n)
+        self.pos += n
+        return n
+
+
+class TestStores(unittest.TestCase):
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = blobs.FileStore(root)
+            ref = blobs.new_ref('user/1')
+            writer = store.writer(ref)
+            writer.write(b'ab')
+            writer.write(b'c')
+            self.assertEqual(writer.close(), 3)
+            self.assertEqual(b''.join(store.open(ref)), b'abc')
+            writer = store.writer(blobs.new_ref('user/1'))
+            writer.write(b'x')
+            writer.abort()
+            store.delete(ref)
+            with self.assertRaises(blobs.NotFound):
+                store.open(ref)
+            self.assertEqual([f for _, _, files in os.walk(root) for f in files], [])
+
+    def test_s3_multipart(self):
+        s3 = FakeS3()
+        part_size, blobs.PART_SIZE = blobs.PART_SIZE, 4
+        try:
+            writer = blobs.S3Writer(s3, 'bucket', 'key')
+            for chunk in (b'abc', b'defgh', b'ij'):
+                writer.write(chunk)
+            self.assertEqual(writer.close(), 10)
+            self.assertEqual(s3.objects['key'], b'abcdefghij')
+            self.assertEqual(s3.calls, ['CreateMultipartUpload'] + ['UploadPart'] * 3 + ['CompleteMultipartUpload'])
+
+            s3.calls = []
+            writer = blobs.S3Writer(s3, 'bucket', 'small')
+            writer.write(b'abc')
+            writer.close()
+            self.assertEqual(s3.calls, ['PutObject'])
+        finally:
+            blobs.PART_SIZE = part_size
+
+
+class TestApp(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'test': 'cell.local'})
+        app.init_clients(standin.session(self.backend))
+        self.dir = tempfile.TemporaryDirectory()
+        app.blob_store = blobs.FileStore(self.dir.name)
+        self.threshold, app.blob_threshold = app.blob_threshold, 100
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.blob_store = None
+        app.blob_threshold = self.threshold
+        app.init_clients()
+        self.dir.cleanup()
+
+    def post(self, uri, json=None, **kwargs):
+        headers = dict(kwargs.pop('headers', {}), Authorization='Bearer user1')
+        return self.client.post(uri, json=json, headers=headers, **kwargs)
+
+    def objects(self):
+        return [f for _, _, files in os.walk(self.dir.name) for f in files]
+
+    def item(self, key):
+        return app.ddb_table.get_item(Key={'username': 'user1', 'key': key}).get('Item')
+
+    def test_large_json_value(self):
+        value = {'text': 'x' * 500}
+        etag = self.post('/put', {'key': 'k', 'value': value}).headers['ETag']
+        self.assertEqual(self.item('k')['blob']['contentType'], 'application/json')
+        self.assertNotIn('value', self.item('k'))
+        r = self.post('/get', {'key': 'k'})
+        self.assertEqual((r.json, r.headers['ETag']), ({'value': value}, etag))
+        self.assertEqual(self.post('/stream/get?key=k').json, value)
+        self.assertEqual(len(self.objects()), 1)
+
+        # Replacing or deleting the value deletes its object.
+        self.post('/put', {'key': 'k', 'value': 'small'})
+        self.assertEqual(self.objects(), [])
+        self.post('/put', {'key': 'k', 'value': value})
+        self.assertEqual(self.post('/increment', {'key': 'k'}).status_code, 409)
+        r = self.post('/put', {'key': 'k', 'value': 1}, headers={'If-Match': '"stale"'})
+        self.assertEqual((r.status_code, r.json), (412, {'status': 'offloaded', 'size': 512}))
+        self.assertEqual(r.headers['ETag'], self.post('/get', {'key': 'k'}).headers['ETag'])
+        self.post('/delete', {'key': 'k'})
+        self.assertEqual(self.objects(), [])
+
+    def test_stream(self):
+        data = os.urandom(300000)
+        r = self.post('/stream/put?key=file', data=data, headers={'Content-Type': 'image/png'})
+        self.assertEqual(r.status_code, 200)
+        r = self.post('/stream/get?key=file')
+        self.assertEqual((r.data, r.headers['Content-Type'], r.headers['ETag']),
+                         (data, 'image/png', self.post('/stream/get?key=file').headers['ETag']))
+        self.assertEqual(self.post('/get', {'key': 'file'}).status_code, 409)
+        self.assertEqual(self.post('/stream/get?key=nope').status_code, 404)
+        self.assertEqual(self.post('/stream/get').status_code, 400)
+        self.post('/put', {'key': 'small', 'value': [1, 2]})
+        self.assertEqual(self.post('/stream/get?key=small').json, [1, 2])
+
+        r = self.post('/batch/get', {'keys': ['file', 'small']})
+        self.assertEqual([(x['status'], x.get('size')) for x in r.json['results']],
+                         [('offloaded', 300000), ('ok', None)])
+        self.assertEqual(self.post('/list', {}).json['items'][0], {'key': 'file', 'size': 300000})
+        self.post('/batch/delete', {'keys': ['file']})
+        self.assertEqual(self.objects(), [])
+
+    def test_memory_does_not_grow_with_size(self):
+        size = 32 * 1024 * 1024
+        tracemalloc.start()
+        try:
+            r = self.post('/stream/put?key=big', input_stream=Zeros(size))
+            self.assertEqual(r.status_code, 200)
+            _, upload_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            r = self.post('/stream/get?key=big', buffered=False)
+            read = sum(len(chunk) for chunk in r.response)
+            r.close()
+            _, download_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(read, size)
+        self.assertLess(upload_peak, size / 8)
+        self.assertLess(download_peak, size / 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
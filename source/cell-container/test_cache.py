@@ -0,0 +1,141 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('tableName', 'Cell-test')
+os.environ.setdefault('cellId', 'test')
+
+import app
+import cache
+import metrics
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import memcached
+import standin
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLocalBackend(unittest.TestCase):
+    def test_lru_and_ttl(self):
+        clock = Clock()
+        backend = cache.LocalBackend(2, 'lru', clock)
+        backend.set('a', 1, 10)
+        backend.set('b', 2, 10)
+        backend.get('a')
+        backend.set('c', 3, 10)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), 1)
+        clock.now = 11
+        self.assertIsNone(backend.get('a'))
+
+    def test_add_does_not_replace(self):
+        backend = cache.LocalBackend(10)
+        backend.set('a', 'new', 10)
+        self.assertFalse(backend.add('a', 'old', 10))
+        self.assertEqual(backend.get('a'), 'new')
+
+    def test_tinylfu_keeps_hot_keys(self):
+        backend = cache.LocalBackend(10, 'tinylfu')
+        for _ in range(5):
+            for k in range(10):
+                if backend.get(k) is None:
+                    backend.add(k, k, 60)
+        # A scan over keys read once does not evict the hot keys.
+        for k in range(100, 200):
+            if backend.get(k) is None:
+                backend.add(k, k, 60)
+        self.assertEqual(sum(backend.get(k) is not None for k in range(10)), 10)
+        self.assertGreater(backend.stats()['rejections'], 0)
+
+
+class TestReadCache(unittest.TestCase):
+    def test_stats(self):
+        registry = metrics.Registry()
+        read_cache = cache.ReadCache(cache.LocalBackend(10), registry=registry)
+        self.assertIsNone(read_cache.get('u', 'k'))
+        read_cache.fill('u', 'k', {'value': 'v'})
+        self.assertEqual(read_cache.get('u', 'k'), {'value': 'v'})
+        read_cache.delete('u', 'k')
+        self.assertEqual(read_cache.get('u', 'k'), {})
+        stats = read_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['rcuSaved']), (2, 1, 1.0))
+        self.assertEqual(registry.value('read_cache_requests_total', {'result': 'hit'}), 2)
+
+    def test_memcached(self):
+        server = memcached.serve(memcached.Store(), port=0)
+        try:
+            backend = cache.MemcachedBackend('127.0.0.1', server.server_address[1], 'test')
+            read_cache = cache.ReadCache(backend)
+            self.assertIsNone(read_cache.get('u', 'k k'))
+            self.assertTrue(read_cache.fill('u', 'k k', {'value': 'v'}))
+            read_cache.put('u', 'k k', {'a': [1, 2]}, 'v2')
+            self.assertFalse(read_cache.fill('u', 'k k', {'value': 'old'}))
+            self.assertEqual(read_cache.get('u', 'k k'), {'value': {'a': [1, 2]}, 'version': 'v2'})
+            read_cache.invalidate('u', 'k k')
+            self.assertIsNone(read_cache.get('u', 'k k'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        # A cache that is down is a miss, not an error.
+        down = cache.MemcachedBackend('127.0.0.1', server.server_address[1])
+        self.assertIsNone(cache.ReadCache(down).get('u', 'k'))
+        self.assertEqual(down.errors, 1)
+
+
+class TestApp(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'test': 'cell.local'})
+        app.init_clients(standin.session(self.backend))
+        app.read_cache = cache.ReadCache(cache.LocalBackend(100))
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.read_cache = None
+        app.init_clients()
+
+    def post(self, uri, json):
+        return self.client.post(uri, json=json, headers={'Authorization': 'Bearer user1'})
+
+    def reads(self, operation='GetItem'):
+        return self.backend.stats()['requests'].get(operation, 0)
+
+    def test_get_reads_through(self):
+        self.post('/put', {'key': 'k', 'value': 'v1'})
+        for _ in range(3):
+            self.assertEqual(self.post('/get', {'key': 'k'}).json, {'value': 'v1'})
+        self.assertEqual(self.reads(), 0)
+        self.post('/put', {'key': 'k', 'value': 'v2'})
+        self.assertEqual(self.post('/get', {'key': 'k'}).json, {'value': 'v2'})
+        self.post('/increment', {'key': 'n', 'by': 2})
+        self.assertEqual(self.post('/get', {'key': 'n'}).json, {'value': 2})
+        self.post('/delete', {'key': 'k'})
+        self.assertEqual(self.post('/get', {'key': 'k'}).status_code, 404)
+        self.assertEqual(self.post('/get', {'key': 'other'}).status_code, 404)
+        self.assertEqual(self.post('/get', {'key': 'other'}).status_code, 404)
+        self.assertEqual(self.reads(), 1)
+        stats = self.client.get('/stats').json['readCache']
+        self.assertEqual((stats['hits'], stats['misses'], stats['hitRatio']), (7, 1, 7 / 8))
+
+    def test_batch(self):
+        self.post('/batch/put', {'items': [{'key': 'a', 'value': '1'}, {'key': 'b', 'value': '2'}]})
+        self.post('/batch/delete', {'keys': ['b']})
+        r = self.post('/batch/get', {'keys': ['a', 'b', 'c']})
+        self.assertEqual([(x['key'], x['status']) for x in r.json['results']],
+                         [('a', 'ok'), ('b', 'not_found'), ('c', 'not_found')])
+        self.assertEqual(self.reads('BatchGetItem'), 1)
+        self.post('/batch/get', {'keys': ['a', 'b', 'c']})
+        self.assertEqual(self.reads('BatchGetItem'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
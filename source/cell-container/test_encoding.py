@@ -0,0 +1,142 @@
+import os
+import sys
+import gzip
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('tableName', 'Cell-test')
+os.environ.setdefault('cellId', 'test')
+
+import cbor2
+import msgpack
+import zstandard
+import app
+import encoding
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+
+class TestEncoding(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertEqual(encoding.accepted(None), encoding.JSON)
+        self.assertEqual(encoding.accepted('text/html, */*;q=0.8'), encoding.JSON)
+        self.assertEqual(encoding.accepted('application/cbor'), encoding.CBOR)
+        self.assertEqual(encoding.accepted('application/json;q=0.5, application/msgpack'), encoding.MSGPACK)
+        self.assertEqual(encoding.accepted('text/plain'), encoding.JSON)
+        self.assertEqual(encoding.negotiate('gzip, deflate, br, zstd', ['zstd', 'gzip']), 'zstd')
+        self.assertEqual(encoding.negotiate('gzip;q=1, zstd;q=0.5', ['zstd', 'gzip']), 'gzip')
+        self.assertEqual(encoding.negotiate('*', ['zstd', 'gzip']), 'zstd')
+        self.assertIsNone(encoding.negotiate('br, zstd;q=0', ['zstd', 'gzip']))
+
+    def test_bodies(self):
+        value = {'a': [1, 2.5, 'x', None, True], 'b': {}}
+        for media_type in encoding.MEDIA_TYPES:
+            self.assertEqual(encoding.loads(encoding.dumps(value, media_type), media_type), value)
+        self.assertEqual(encoding.loads(msgpack.packb(value), 'application/x-msgpack'), value)
+        self.assertIsNone(encoding.loads(b'', encoding.JSON))
+        with self.assertRaises(encoding.Unsupported):
+            encoding.loads(b'{}', 'text/plain')
+        for data in (msgpack.packb({'b': b'bytes'}), msgpack.packb({1: 2}), b'\xc1'):
+            with self.assertRaises(encoding.Error):
+                encoding.loads(data, encoding.MSGPACK)
+
+    def test_decompress(self):
+        data = b'x' * 10000
+        for e in encoding.COMPRESSIONS:
+            self.assertEqual(encoding.decompress(encoding.compress(data, e), e), data)
+            with self.assertRaises(encoding.TooLarge):
+                encoding.decompress(encoding.compress(data, e), e, limit=1000)
+        with self.assertRaises(encoding.Error):
+            encoding.decompress(b'not gzip', 'gzip')
+        with self.assertRaises(encoding.Unsupported):
+            encoding.decompress(data, 'br')
+
+    def test_value_compression(self):
+        compression = encoding.ValueCompression('zstd', threshold=100)
+        self.assertIsNone(compression.pack({'small': 1}))
+        value = {'text': 'hello ' * 100}
+        data, codec = compression.pack(value)
+        self.assertEqual(codec, 'msgpack+zstd')
+        self.assertLess(len(data), 100)
+        self.assertEqual(encoding.unpack(data, codec), value)
+
+
+class TestApp(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'test': 'cell.local'})
+        app.init_clients(standin.session(self.backend))
+        app.value_compression = encoding.ValueCompression('zstd', threshold=100)
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.value_compression = None
+        app.init_clients()
+
+    def post(self, uri, data, content_type=encoding.JSON, **headers):
+        headers = dict(headers, Authorization='Bearer user1')
+        return self.client.post(uri, data=data, content_type=content_type, headers=headers)
+
+    def item(self, key):
+        return app.ddb_table.get_item(Key={'username': 'user1', 'key': key})['Item']
+
+    def test_formats(self):
+        value = {'n': 1, 'f': 0.5, 'list': ['a', 'b']}
+        r = self.post('/put', msgpack.packb({'key': 'k', 'value': value}), encoding.MSGPACK)
+        self.assertEqual(r.status_code, 200)
+        r = self.post('/get', cbor2.dumps({'key': 'k'}), encoding.CBOR, Accept=encoding.CBOR)
+        self.assertEqual((r.mimetype, cbor2.loads(r.data)), (encoding.CBOR, {'value': value}))
+        r = self.post('/batch/get', b'{"keys": ["k"]}', Accept=encoding.MSGPACK)
+        self.assertEqual(msgpack.unpackb(r.data)['results'][0]['value'], value)
+        self.assertEqual(self.post('/get', b'{"key": "k"}').json, {'value': value})
+        self.assertEqual(self.post('/get', b'key=k', 'text/plain').status_code, 415)
+        self.assertEqual(self.post('/get', b'\xc1', encoding.MSGPACK).status_code, 400)
+        self.assertEqual(self.post('/get', b'').status_code, 400)
+        r = self.client.post('/get', data=b'{"key": "k"}', headers={'Authorization': 'Bearer user1'})
+        self.assertEqual(r.status_code, 415)
+        self.assertEqual(self.post('/batch/put', b'[]').status_code, 400)
+
+    def test_wire_compression(self):
+        value = ['item {}'.format(i) for i in range(500)]
+        data = zstandard.ZstdCompressor().compress(msgpack.packb({'key': 'k', 'value': value}))
+        r = self.post('/put', data, encoding.MSGPACK, **{'Content-Encoding': 'zstd'})
+        self.assertEqual(r.status_code, 200)
+        r = self.post('/get', b'{"key": "k"}', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', r.headers['Vary'])
+        self.assertEqual(app.json.loads(gzip.decompress(r.data)), {'value': value})
+        r = self.post('/get', b'{"key": "k"}', **{'Accept-Encoding': 'gzip, zstd'})
+        self.assertEqual(r.headers['Content-Encoding'], 'zstd')
+        # Small responses are sent as they are.
+        r = self.post('/put', b'{"key": "small", "value": 1}', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', r.headers)
+
+    def test_stored_values(self):
+        value = {'text': 'hello ' * 100, 'n': 3}
+        etag = self.post('/put', encoding.dumps({'key': 'big', 'value': value}, encoding.JSON)).headers['ETag']
+        item = self.item('big')
+        self.assertEqual(item['codec'], 'msgpack+zstd')
+        self.assertLess(len(item['value'].value), 100)
+        r = self.post('/get', b'{"key": "big"}')
+        self.assertEqual((r.json, r.headers['ETag']), ({'value': value}, etag))
+        self.assertEqual(self.post('/list', b'{}').json['items'], [{'key': 'big', 'value': value}])
+        self.post('/put', b'{"key": "small", "value": [1]}')
+        self.assertNotIn('codec', self.item('small'))
+        self.assertEqual(self.post('/append', b'{"key": "small", "values": [2]}').json, {'value': [1, 2]})
+        self.assertEqual(self.post('/append', b'{"key": "big", "values": [2]}').status_code, 409)
+        r = self.post('/put', b'{"key": "big", "value": 1}', **{'If-Match': '"stale"'})
+        self.assertEqual((r.status_code, r.json), (412, {'value': value}))
+
+        # Compressed items are read whatever valueCompression is now.
+        app.value_compression = None
+        self.assertEqual(self.post('/get', b'{"key": "big"}').json, {'value': value})
+        self.post('/batch/put', encoding.dumps({'items': [{'key': 'b', 'value': value}]}, encoding.JSON))
+        self.assertNotIn('codec', self.item('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError
+import metrics
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+
+class TestRouterCopy(unittest.TestCase):
+    def test_identical(self):
+        # The router has its own copy of this module.
+        here = Path(__file__).parent
+        self.assertEqual((here / 'metrics.py').read_text(),
+                         (here.parent / 'routing-container' / 'metrics.py').read_text())
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry({'cellId': 'c1'})
+
+    def test_prometheus_text(self):
+        self.registry.inc('http_requests_total', {'route': '/put', 'method': 'POST', 'status': '200'})
+        for seconds in (0.002, 0.004, 0.2):
+            self.registry.observe('http_request_duration_seconds', {'route': '/put', 'method': 'POST'}, seconds)
+        text = self.registry.render()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_requests_total{cellId="c1",method="POST",route="/put",status="200"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{cellId="c1",method="POST",route="/put",le="0.005"} 2', text)
+        self.assertIn('http_request_duration_seconds_bucket{cellId="c1",method="POST",route="/put",le="+Inf"} 3', text)
+        self.assertIn('http_request_duration_seconds_count{cellId="c1",method="POST",route="/put"} 3', text)
+
+    def test_emf_reports_deltas(self):
+        self.registry.inc('aws_throttles_total', {'service': 'dynamodb', 'operation': 'PutItem'}, 2)
+        self.registry.observe('aws_call_duration_seconds', {'service': 'dynamodb', 'operation': 'PutItem'}, 0.01)
+        records = self.registry.emf_records(now=1)
+        self.assertEqual(len(records), 2)
+        latency = next(r for r in records if 'aws_call_duration_seconds' in r)
+        self.assertEqual(latency['aws_call_duration_seconds'], [10.0])
+        self.assertEqual(latency['cellId'], 'c1')
+        spec = latency['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(spec['Dimensions'], [['cellId', 'operation', 'service']])
+        self.assertEqual(spec['Metrics'], [{'Name': 'aws_call_duration_seconds', 'Unit': 'Milliseconds'}])
+        json.dumps(records)
+        # Nothing new since the last flush.
+        self.assertEqual(self.registry.emf_records(now=2), [])
+        self.registry.inc('aws_throttles_total', {'service': 'dynamodb', 'operation': 'PutItem'})
+        self.assertEqual(self.registry.emf_records(now=3)[0]['aws_throttles_total'], 1)
+
+    def test_samples_are_bounded(self):
+        for i in range(1000):
+            self.registry.observe('http_request_duration_seconds', {}, i / 1000)
+        self.assertEqual(len(self.registry.emf_records()[0]['http_request_duration_seconds']),
+                         metrics.EMF_SAMPLES)
+
+
+    def test_samples_per_interval(self):
+        for _ in range(10000):
+            self.registry.observe('http_request_duration_seconds', {}, 0.5)
+        self.registry.emf_records()
+        for seconds in [1] * 100 + [2] * 900:
+            self.registry.observe('http_request_duration_seconds', {}, seconds)
+        samples = self.registry.emf_records()[0]['http_request_duration_seconds']
+        # About 90 of the 100 samples, not none, are from the later 900.
+        self.assertGreater(samples.count(2000), 70)
+
+class TestInstrumentClient(unittest.TestCase):
+    def setUp(self):
+        backend = standin.Backend()
+        standin.seed(backend, {'c1': 'cell.local'})
+        self.registry = metrics.Registry({})
+        self.client = standin.session(backend).client('dynamodb', config=Config(retries={'max_attempts': 1}))
+        metrics.instrument_client(self.client, self.registry)
+
+    def calls(self, outcome):
+        line = 'aws_calls_total{{operation="PutItem",outcome="{}",service="dynamodb"}} '.format(outcome)
+        return [l[len(line):] for l in self.registry.render().splitlines() if l.startswith(line)]
+
+    def put(self, **kwargs):
+        self.client.put_item(TableName='Cell-c1', Item={'username': {'S': 'u'}, 'key': {'S': 'k'}}, **kwargs)
+
+    def test_outcomes(self):
+        self.put()
+        with self.assertRaises(ClientError):
+            self.put(ConditionExpression='attribute_not_exists(#k)', ExpressionAttributeNames={'#k': 'key'})
+
+        def unreachable(**kwargs):
+            raise EndpointConnectionError(endpoint_url='http://cell.local')
+        self.client.meta.events.register_first('before-send.dynamodb.PutItem', unreachable)
+        with self.assertRaises(EndpointConnectionError):
+            self.put()
+        self.assertEqual((self.calls('ok'), self.calls('error')), (['1'], ['2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
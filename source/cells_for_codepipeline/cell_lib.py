@@ -1,10 +1,106 @@
 import boto3
 import os
 import json
+import math
+import queue
+import threading
+from functools import lru_cache
 
-dynamodb = boto3.resource('dynamodb')
-codepipeline = boto3.client('codepipeline')
-stepfunction = boto3.client('stepfunctions')
+
+# The AWS clients are created on first use: cellularctl imports this module
+# for plan_waves and scan_items and must not get clients of its own.
+@lru_cache(maxsize=None)
+def dynamodb():
+    return boto3.resource('dynamodb')
+
+
+@lru_cache(maxsize=None)
+def stepfunction():
+    return boto3.client('stepfunctions')
+
+
+def scan_items(table, attributes=None, segments=1, page_size=None):
+    """Yields the items of a DynamoDB table (a boto3 Table) page by page, so
+    that only a few pages are in memory at a time. attributes limits the
+    attributes read. With segments > 1 a parallel scan reads the segments in
+    threads and items are yielded in the order the pages arrive."""
+    kwargs = {}
+    if attributes:
+        names = {'#a{}'.format(i): a for i, a in enumerate(attributes)}
+        kwargs['ProjectionExpression'] = ', '.join(names)
+        kwargs['ExpressionAttributeNames'] = names
+    if page_size:
+        kwargs['Limit'] = page_size
+    if segments <= 1:
+        for page in scan_pages(table, kwargs):
+            yield from page
+        return
+
+    pages = queue.Queue(maxsize=2 * segments)
+    stop = threading.Event()
+
+    def put(message):
+        """False once the caller has stopped reading."""
+        while not stop.is_set():
+            try:
+                pages.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(segment):
+        try:
+            segment_kwargs = dict(kwargs, Segment=segment, TotalSegments=segments)
+            for page in scan_pages(table, segment_kwargs):
+                if not put(('page', page)):
+                    # No more Scan calls for a caller that is gone.
+                    return
+            put(('done', None))
+        except Exception as e:
+            put(('error', e))
+
+    for segment in range(segments):
+        threading.Thread(target=read, args=(segment,), daemon=True).start()
+    try:
+        running = segments
+        while running:
+            kind, value = pages.get()
+            if kind == 'page':
+                yield from value
+            elif kind == 'done':
+                running -= 1
+            else:
+                raise value
+    finally:
+        # Lets the threads finish if the caller stops early.
+        stop.set()
+
+
+def scan_pages(table, kwargs):
+    while True:
+        res = table.scan(**kwargs)
+        yield res['Items']
+        if 'LastEvaluatedKey' not in res:
+            return
+        kwargs = dict(kwargs, ExclusiveStartKey=res['LastEvaluatedKey'])
+
+
+def plan_waves(cells, first_wave=1, wave_size=0, wave_percent=0):
+    """Splits cells into the waves of a rollout: first_wave cells on their
+    own, then waves of wave_size cells or wave_percent percent of all cells.
+    Without wave_size and wave_percent the remaining cells are one wave."""
+    cells = list(cells)
+    if wave_size:
+        size = wave_size
+    elif wave_percent:
+        size = max(1, math.ceil(len(cells) * wave_percent / 100))
+    else:
+        size = max(1, len(cells))
+    waves = [cells[:first_wave]]
+    rest = cells[first_wave:]
+    waves += [rest[i:i + size] for i in range(0, len(rest), size)]
+    return [w for w in waves if w]
 
 
 class CellClient():
@@ -12,20 +108,32 @@ class CellClient():
         self.init_config()
 
     def init_config(self):
-        self.cells_table = dynamodb.Table(os.environ['cellsTable'])
+        self.cells_table = dynamodb().Table(os.environ['cellsTable'])
         self.step_function_arn = os.environ['updateCellsFunctionArn']
         self.template_bucket_name = os.environ['templateBucketName']
+        self.first_wave = int(os.environ.get('firstWave', 1))
+        self.wave_size = int(os.environ.get('waveSize', 0))
+        self.wave_percent = float(os.environ.get('wavePercent', 0))
+        self.wave_concurrency = int(os.environ.get('waveConcurrency', 0))
+        self.bake_seconds = int(os.environ.get('bakeSeconds', 0))
 
     def list_cells(self):
-        cells = self.cells_table.scan()['Items']
-        return [c['cell_id'] for c in cells if c['cell_id'] != 'Sandbox']
+        cells = scan_items(self.cells_table, ['cell_id'])
+        return [c['cell_id'] for c in cells if c['cell_id'].lower() != 'sandbox']
+
+    def plan(self, cells):
+        return {
+            'waves': plan_waves(cells, self.first_wave, self.wave_size, self.wave_percent),
+            'waveConcurrency': self.wave_concurrency,
+            'bakeSeconds': self.bake_seconds,
+        }
 
     def update_cells(self, job_id):
-        stepfunction.start_execution(
+        stepfunction().start_execution(
             stateMachineArn=self.step_function_arn,
             name='update-{}'.format(job_id),
             input=json.dumps({
-                'cellIds': self.list_cells(),
+                'plan': self.plan(sorted(self.list_cells())),
                 'templateUrl': 'https://{}/template_cell.yaml'.format(self.template_bucket_name),
                 'pipeline_id': job_id
             }),
@@ -0,0 +1,33 @@
+import os
+import unittest
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from cells_for_codepipeline.cell_lib import plan_waves
+
+
+class Test_PlanWaves(unittest.TestCase):
+    cells = ['cell{}'.format(i) for i in range(10)]
+
+    def test_one_wave(self):
+        self.assertEqual(plan_waves(self.cells, first_wave=0), [self.cells])
+
+    def test_first_wave_then_rest(self):
+        self.assertEqual(plan_waves(self.cells), [self.cells[:1], self.cells[1:]])
+
+    def test_wave_size(self):
+        waves = plan_waves(self.cells, first_wave=1, wave_size=4)
+        self.assertEqual([len(w) for w in waves], [1, 4, 4, 1])
+        self.assertEqual(sum(waves, []), self.cells)
+
+    def test_wave_percent(self):
+        waves = plan_waves(self.cells, first_wave=2, wave_percent=25)
+        self.assertEqual([len(w) for w in waves], [2, 3, 3, 2])
+
+    def test_few_cells(self):
+        self.assertEqual(plan_waves(['cell1'], first_wave=1, wave_percent=25), [['cell1']])
+        self.assertEqual(plan_waves([], wave_size=3), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,15 @@
 import sys
 import boto3
 import json
+import base64
+import secrets
 import subprocess
 import os
+import time
+import threading
 from pathlib import Path
+import fleet
+import migrate
 
 if 'AWS_REGION' in os.environ:
     region = os.environ['AWS_REGION']
@@ -17,15 +23,116 @@ else:
     docker = 'docker'
 
 
-cloudformation = boto3.client('cloudformation')
-dynamodb = boto3.resource('dynamodb')
-stepfunction = boto3.client('stepfunctions')
-s3 = boto3.client('s3')
-ecs = boto3.client('ecs')
-ec2 = boto3.client('ec2')
-aws_lambda = boto3.client('lambda')
-synthetics = boto3.client('synthetics')
-secretsmanager = boto3.client('secretsmanager')
+# Maximum number of cells (stacks, canaries, ...) acted on at once by fleet
+# commands.
+fleet_parallelism = int(os.environ.get('fleetParallelism', 10))
+
+# Stack outputs are also kept on disk between invocations for
+# stackCacheTtl seconds (0 disables). `--refresh` ignores the file.
+STACK_CACHE_TTL = 600
+
+# The router's hash ring, so operators see the same user to cell mapping.
+sys.path.append(str(Path(__file__).parent.parent / 'routing-container'))
+import hashring
+
+# Rollout waves are planned like the pipeline does. cell_lib only creates
+# the pipeline's AWS clients when its CellClient is used.
+sys.path.append(str(Path(__file__).parent.parent / 'cells_for_codepipeline'))
+from cell_lib import plan_waves, scan_items
+
+
+class StackCache:
+    """Outputs of CloudFormation stacks, loaded with one DescribeStacks call
+    per stack and process, and optionally kept in a JSON file together with
+    the stack id and last update time they were read at."""
+
+    def __init__(self, path=None, ttl=STACK_CACHE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.refresh = False
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def _read(self):
+        if not self.path or not self.ttl:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        if not self.path or not self.ttl:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+    def get(self, stackname, describe):
+        """Outputs of stackname, calling describe(stackname) if neither this
+        process nor the file has them."""
+        with self.lock:
+            if stackname in self.stacks:
+                return self.stacks[stackname]['outputs']
+            entry = None if self.refresh else self._read().get(stackname)
+        if entry is None or entry['fetched'] + self.ttl <= self.clock():
+            stack = describe(stackname)
+            entry = {
+                'stackId': stack['StackId'],
+                'lastUpdated': str(stack.get('LastUpdatedTime', stack.get('CreationTime'))),
+                'fetched': self.clock(),
+                'outputs': {o['OutputKey']: o['OutputValue'] for o in stack.get('Outputs', [])},
+            }
+            with self.lock:
+                now = self.clock()
+                entries = {k: v for k, v in self._read().items() if v['fetched'] + self.ttl > now}
+                entries[stackname] = entry
+                self._write(entries)
+        with self.lock:
+            self.stacks[stackname] = entry
+        return entry['outputs']
+
+    def forget(self, *stacknames):
+        """Drops stacks that are being deployed or deleted."""
+        with self.lock:
+            entries = self._read()
+            for name in stacknames:
+                self.stacks.pop(name, None)
+                entries.pop(name, None)
+            self._write(entries)
+
+    def clear(self):
+        with self.lock:
+            self.stacks = {}
+
+
+stack_cache = StackCache(
+    os.environ.get('stackCache', str(Path.home() / '.cellular' / 'stack-outputs.json')),
+    float(os.environ.get('stackCacheTtl', STACK_CACHE_TTL)))
+
+
+def init_clients(session=None):
+    """Creates the boto3 clients, from session if given (e.g. one served by
+    the stand-in in source/standin)."""
+    global cloudformation, dynamodb, stepfunction, s3, ecs, ec2, aws_lambda, synthetics, secretsmanager
+    session = session or boto3
+    cloudformation = session.client('cloudformation')
+    dynamodb = session.resource('dynamodb')
+    stepfunction = session.client('stepfunctions')
+    s3 = session.client('s3')
+    ecs = session.client('ecs')
+    ec2 = session.client('ec2')
+    aws_lambda = session.client('lambda')
+    synthetics = session.client('synthetics')
+    secretsmanager = session.client('secretsmanager')
+    stack_cache.clear()
+
+
+init_clients()
 
 
 def run_cmd(cmd, dir=''):
@@ -39,28 +146,50 @@ def run_cmd(cmd, dir=''):
         sys.exit(1)
 
 
+def describe_stack(stackname):
+    return cloudformation.describe_stacks(StackName=stackname)['Stacks'][0]
+
+
+def get_cf_outputs(stackname):
+    return stack_cache.get(stackname, describe_stack)
+
+
 def get_cf_output(stackname, key):
-    response = cloudformation.describe_stacks(StackName=stackname)
-    outputs = response["Stacks"][0]["Outputs"]
-    for output in outputs:
-        if output["OutputKey"] == key:
-            return output["OutputValue"]
-    raise Exception(
-        '"{}" does not exist for stack "{}"'.format(key, stackname))
+    outputs = get_cf_outputs(stackname)
+    if key not in outputs:
+        raise Exception(
+            '"{}" does not exist for stack "{}"'.format(key, stackname))
+    return outputs[key]
 
 
 def recreate_containers(stack_name):
+    outputs = get_cf_outputs(stack_name)
     ecs.update_service(
-        cluster=get_cf_output(stack_name, 'clusterName'),
-        service=get_cf_output(stack_name, 'serviceName'),
+        cluster=outputs['clusterName'],
+        service=outputs['serviceName'],
         forceNewDeployment=True
     )
 
 
-def get_cells():
+def recreate_cells(cells, parallel=None):
+    """Restarts the containers of cells in parallel."""
+    return fleet.run(cells, lambda c: recreate_containers(c['stackName']),
+                     name=lambda c: c['cell_id'], parallel=parallel or fleet_parallelism)
+
+
+def destroy_cells(cells, parallel=None):
+    return fleet.run(cells, lambda c: destroy_stack(c['stackName']),
+                     name=lambda c: c['cell_id'], parallel=parallel or fleet_parallelism)
+
+
+def iter_cells(attributes=None):
     cells_table = dynamodb.Table(
         get_cf_output('Cellular-Router', 'cellsTable'))
-    return cells_table.scan()['Items']
+    return scan_items(cells_table, attributes)
+
+
+def get_cells(attributes=None):
+    return list(iter_cells(attributes))
 
 
 def build_repo(repo, dir):
@@ -114,7 +243,20 @@ def delete_cell(cell_id):
     cells_table.delete_item(Key={'cell_id': cell_id})
     stack_name = item['Item']['stackName']
     print('Requesting deletion of stack "{}"'.format(stack_name))
-    cloudformation.delete_stack(StackName=stack_name)
+    destroy_stack(stack_name)
+
+
+def update_cell(cell_id, **attributes):
+    """Sets attributes, e.g. the placement weight or drain flag, on a cell item."""
+    cells_table = dynamodb.Table(
+        get_cf_output('Cellular-Router', 'cellsTable'))
+    cells_table.update_item(
+        Key={'cell_id': cell_id},
+        UpdateExpression='SET ' + ', '.join('#{0} = :{0}'.format(k) for k in attributes),
+        ConditionExpression='attribute_exists(cell_id)',
+        ExpressionAttributeNames={'#' + k: k for k in attributes},
+        ExpressionAttributeValues={':' + k: v for k, v in attributes.items()},
+    )
 
 
 def generate_template(upload=True):
@@ -127,18 +269,13 @@ def generate_template(upload=True):
             s3.upload_file(str(p), bucket, p.name)
 
 
-def tagnodelete():
-    res = aws_lambda.list_functions()
-    for f in res['Functions']:
-        name = f['FunctionName']
-        if name.startswith('cwsyn-cell-canary-'):
-            print('Tagging function "{}"'.format(name))
-            aws_lambda.tag_resource(
-                Resource=f['FunctionArn'],
-                Tags={
-                    "auto-delete": "no"
-                }
-            )
+def tagnodelete(parallel=None):
+    functions = [f for page in aws_lambda.get_paginator('list_functions').paginate()
+                 for f in page['Functions'] if f['FunctionName'].startswith('cwsyn-cell-canary-')]
+    return fleet.run(
+        functions,
+        lambda f: aws_lambda.tag_resource(Resource=f['FunctionArn'], Tags={"auto-delete": "no"}),
+        name=lambda f: f['FunctionName'], parallel=parallel or fleet_parallelism)
 
 
 def invoke_lambda():
@@ -150,22 +287,31 @@ def invoke_lambda():
     print(json.load(r['Payload']))
 
 
-def start_stop_canaries(action):
-    res = synthetics.describe_canaries()
-    for c in res['Canaries']:
-        name = c['Name']
-        if name.startswith('cell-canary-'):
-            if action == 'start':
-                print('Starting canary "{}"'.format(name))
-                synthetics.start_canary(Name=name)
-            elif action == 'stop':
-                print('Stopping canary "{}"'.format(name))
-                synthetics.stop_canary(Name=name)
-            else:
-                raise Exception('Unknown action "{}"'.format(action))
+def start_stop_canaries(action, parallel=None):
+    if action == 'start':
+        call = synthetics.start_canary
+    elif action == 'stop':
+        call = synthetics.stop_canary
+    else:
+        raise Exception('Unknown action "{}"'.format(action))
+    names = []
+    kwargs = {}
+    while True:
+        res = synthetics.describe_canaries(**kwargs)
+        names += [c['Name'] for c in res['Canaries'] if c['Name'].startswith('cell-canary-')]
+        if not res.get('NextToken'):
+            break
+        kwargs = {'NextToken': res['NextToken']}
+    return fleet.run(names, lambda name: call(Name=name), parallel=parallel or fleet_parallelism)
+
+
+def deploy_stack(stack_name, args=''):
+    stack_cache.forget(stack_name)
+    run_cmd('cdk deploy {} {}'.format(stack_name, args).strip(), 'cdk')
 
 
 def destroy_stack(stack_name):
+    stack_cache.forget(stack_name)
     cloudformation.delete_stack(StackName=stack_name)
 
 
@@ -178,11 +324,130 @@ def get_user(username):
     return None
 
 
-def get_users():
+def get_users(attributes=None, segments=1):
+    """Yields all users; see scan_items."""
     users_table = dynamodb.Table(
         get_cf_output('Cellular-Router', 'usersTable'))
-    users = users_table.scan()
-    return users
+    return scan_items(users_table, attributes, segments)
+
+def get_cell_table(cell_id):
+    return dynamodb.Table(get_cf_output('Cellular-Cell-' + cell_id, 'ddbTableName'))
+
+
+def get_migration(wcu=100, drain=migrate.DRAIN_SECONDS, checkpoint=None, parallel=None):
+    return migrate.Migration(
+        dynamodb, get_cell_table,
+        dynamodb.Table(get_cf_output('Cellular-Router', 'usersTable')),
+        dynamodb.Table(get_cf_output('Cellular-Router', 'cellsTable')),
+        migrate.WriteBudget(wcu), migrate.Checkpoint(checkpoint), drain,
+        parallel or fleet_parallelism,
+        blobs=migrate.CellBlobs(s3, lambda cell_id: get_cf_outputs('Cellular-Cell-' + cell_id).get('blobBucketName')))
+
+
+def migrate_user(username, target, **kwargs):
+    """Moves a user and its items to the target cell; kwargs are those of
+    get_migration."""
+    user = get_user(username)
+    if user is None:
+        raise Exception('User "{}" does not exist'.format(username))
+    source = get_user_cell(user)
+    if source == target:
+        raise Exception('User "{}" is already in cell "{}"'.format(username, target))
+    return get_migration(**kwargs).run([(username, source, target)])
+
+
+def plan_rebalance(cells=(), evacuate=(), segments=1):
+    """Plans moves that spread the users over the given cells (default:
+    the cells on the hash ring) by cell weight. Cells being drained take no
+    users; users of the evacuated cells all move."""
+    items = {c['cell_id']: c for c in get_cells()}
+    ring = get_hash_ring()
+    cells = set(cells or hashring.ring_members(items.values())) | set(evacuate)
+    weights = {c: float(items[c].get('weight', 1)) for c in cells
+               if c not in evacuate and not items[c].get('drain')}
+
+    def users():
+        for u in get_users(['username', 'cell'], segments):
+            cell = get_user_cell(u, ring)
+            if cell in cells:
+                yield u['username'], cell
+    counts = dict.fromkeys(cells, 0)
+    for _, cell in users():
+        counts[cell] += 1
+    return migrate.plan_rebalance(counts, weights, users())
+
+
+def hash_vnodes():
+    """Points per cell on the router's hash ring: the hashVnodes it is
+    deployed with."""
+    return int(get_cf_outputs('Cellular-Router').get('hashVnodes', hashring.DEFAULT_VNODES))
+
+
+def get_hash_ring(add=(), remove=(), vnodes=None):
+    """Builds the router's hash ring from the cells table, optionally with
+    cells added or removed."""
+    members = set(hashring.ring_members(get_cells()))
+    members = (members | set(add)) - set(remove)
+    return hashring.HashRing(members, vnodes or hash_vnodes())
+
+
+def plan_ring_change(cell_id, join=True, segments=1):
+    """Moves of the users without a pinned cell whose ring cell changes when
+    cell_id joins (or leaves) the hash ring."""
+    items = {c['cell_id']: c for c in get_cells()}
+    if items.get(cell_id, {}).get('stage') != 'prod':
+        raise Exception('"{}" is not a prod cell'.format(cell_id))
+    ring = get_hash_ring()
+    if join:
+        if cell_id in ring.cell_ids or not ring.cell_ids:
+            return []
+        changed = get_hash_ring(add=[cell_id])
+    else:
+        if cell_id not in ring.cell_ids:
+            return []
+        if ring.cell_ids == [cell_id]:
+            raise Exception('"{}" is the last cell on the hash ring'.format(cell_id))
+        changed = get_hash_ring(remove=[cell_id])
+    users = (u['username'] for u in get_users(['username', 'cell'], segments) if 'cell' not in u)
+    return hashring.migration_report(users, ring, changed)
+
+
+def change_ring(cell_id, moves, join=True, **kwargs):
+    """Moves the users planned by plan_ring_change, which pins them to their
+    new cell, then adds cell_id to the hash ring or removes it. The ring is
+    left as it is if a user could not be moved. kwargs are those of
+    get_migration; returns the results of Migration.run."""
+    moved, drained = get_migration(**kwargs).run(moves)
+    if moved.ok:
+        update_cell(cell_id, ring=join)
+    return moved, drained
+
+
+def get_user_cell(user, ring=None):
+    if 'cell' in user:
+        return user['cell']
+    return (ring or get_hash_ring()).lookup(user['username'])
+
+
+def rotate_token_key(path, keep=2):
+    """Adds a new current key to the token key file (see
+    routing-container/tokens.py) and keeps the `keep` newest keys. Only
+    remove a key once the tokens signed with it have expired."""
+    data = {'current': None, 'keys': {}}
+    if os.path.exists(path):
+        with open(path) as f:
+            data = json.load(f)
+    kid = 'k{}'.format(int(time.time()))
+    data['keys'][kid] = base64.b64encode(secrets.token_bytes(32)).decode()
+    data['current'] = kid
+    for old in sorted(data['keys'])[:-keep]:
+        del data['keys'][old]
+    tmp = path + '.tmp'
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+    return kid
+
 
 def allow_ingress(ip):
     prefixListID = get_cf_output('Cellular-Repos', 'inboundPrefixListId')
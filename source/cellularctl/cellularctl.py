@@ -1,22 +1,44 @@
 import os
+import sys
 import fire
 import yaml
 import cellular
 import requests
+from decimal import Decimal
 from datetime import datetime
 
 cdkRequireApproval = 'broadening'
 if 'cdkRequireApproval' in os.environ:
     cdkRequireApproval = os.environ['cdkRequireApproval']
 
+
+def report(result):
+    """Prints the summary of a fleet action and fails if any item failed."""
+    print(result.summary())
+    if not result.ok:
+        sys.exit(1)
+
+
+def change_ring(name, join, wcu, drain, checkpoint, parallel, segments, dryrun):
+    """cell join and cell leave."""
+    moves = cellular.plan_ring_change(name, join, segments)
+    print('{} users to move'.format(len(moves)))
+    if dryrun:
+        for username, source, target in moves:
+            print('{}: {} -> {}'.format(username, source, target))
+        return
+    for result in cellular.change_ring(name, moves, join, wcu=wcu, drain=drain, checkpoint=checkpoint,
+                                       parallel=parallel):
+        report(result)
+
 # The following classes build the CLI actions. Each class and function in a
 # class corresponds to an action.
 
 
 class Cell(object):
     def list(self):
-        cells = cellular.get_cells()
-        print(yaml.dump(cells))
+        for cell in cellular.iter_cells():
+            print(yaml.dump([cell]), end='')
 
     def create(self, name, stage='prod'):
         """Calls the stepfunction to create a new cell"""
@@ -35,29 +57,83 @@ class Cell(object):
     def delete(self, name):
         cellular.delete_cell(name)
 
-    def update(self, *cells):
-        """Calls the stepfunction to update multiple cells"""
+    def setweight(self, name, weight):
+        """Sets the relative capacity of a cell used by weighted and
+        load-aware placement of new users (default 1)."""
+        cellular.update_cell(name, weight=Decimal(str(weight)))
+
+    def drain(self, name):
+        """Stops assigning new users to a cell. Existing users stay."""
+        cellular.update_cell(name, drain=True)
+
+    def undrain(self, name):
+        cellular.update_cell(name, drain=False)
+
+    def update(self, *cells, firstwave=0, wavesize=0, wavepercent=0, concurrency=0, bake=0):
+        """Calls the stepfunction to update multiple cells. With --firstwave,
+        --wavesize or --wavepercent the cells are updated in waves, one after
+        the other. --concurrency limits how many cells of a wave update at
+        once. --bake waits this many seconds after each wave and stops the
+        rollout unless the canaries of the wave pass."""
         if len(cells) == 0:
             print('No cells to update')
             return
         arn = cellular.get_cf_output('Cellular-Router', 'updatecellsfunction')
         bucket = cellular.get_cf_output(
             'Cellular-Router', 'bucketRegionalDomainName')
+        waves = cellular.plan_waves(cells, firstwave, wavesize, wavepercent)
+        for i, wave in enumerate(waves):
+            print('Wave {}: {}'.format(i + 1, ', '.join(wave)))
         cellular.start_sfn(arn, {
-            # 'cellIds': [{'cellId': 'cell1'}, {'cellId': 'cell2'}],
-            'cellIds': list(cells),
+            'plan': {'waves': waves, 'waveConcurrency': concurrency, 'bakeSeconds': bake},
             'templateUrl': 'https://{}/template_cell.yaml'.format(bucket),
         }, name='update-cells-{}'.format(datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
 
-    def build(self, deploy=False):
+    def build(self, deploy=False, parallel=None):
         """Builds the cell container and pushed it to the repo. Deploy restarts
-        containers in all cells, thereby pulling the lasted image from ECR. """
+        containers in all cells, thereby pulling the lasted image from ECR.
+        --parallel sets how many cells restart at once (fleetParallelism)."""
         repo = cellular.get_cf_output('Cellular-Repos', 'repoCellUri')
         cellular.build_repo(repo, 'cell-container')
         if deploy:
-            for cell in cellular.get_cells():
-                cellular.recreate_containers(cell['stackName'])
-                print('Restarting container for ' + cell['cell_id'])
+            self.restart(parallel=parallel)
+
+    def restart(self, *cells, parallel=None):
+        """Restarts the containers of the given cells, or of all cells."""
+        targets = [c for c in cellular.get_cells() if not cells or c['cell_id'] in cells]
+        report(cellular.recreate_cells(targets, parallel))
+
+    def rebalance(self, *cells, evacuate=(), wcu=100, drain=cellular.migrate.DRAIN_SECONDS,
+                  checkpoint=None, parallel=None, segments=1, dryrun=False):
+        """Moves users between the given cells (default: all cells on the
+        hash ring) so that each has users in proportion to its weight.
+        Draining cells take no users, --evacuate cells lose all of theirs.
+        Writes are limited to --wcu write capacity units per second. With
+        --checkpoint FILE an interrupted rebalance resumes when run again
+        with the same file. See `user migrate` for --drain."""
+        evacuate = [evacuate] if isinstance(evacuate, str) else list(evacuate)
+        moves = cellular.plan_rebalance(cells, evacuate, segments)
+        print('{} users to move'.format(len(moves)))
+        if dryrun:
+            for username, source, target in moves:
+                print('{}: {} -> {}'.format(username, source, target))
+            return
+        migration = cellular.get_migration(wcu, drain, checkpoint, parallel)
+        for result in migration.run(moves):
+            report(result)
+
+    def join(self, name, wcu=100, drain=cellular.migrate.DRAIN_SECONDS, checkpoint=None, parallel=None,
+             segments=1, dryrun=False):
+        """Adds a cell to the hash ring (routingMode=hash). The users that
+        will map to it are moved there first, as by `cell rebalance`, so
+        none of them is routed to a cell without its items."""
+        change_ring(name, True, wcu, drain, checkpoint, parallel, segments, dryrun)
+
+    def leave(self, name, wcu=100, drain=cellular.migrate.DRAIN_SECONDS, checkpoint=None, parallel=None,
+              segments=1, dryrun=False):
+        """Removes a cell from the hash ring. Its users without a pinned
+        cell are first moved to the cells they will map to."""
+        change_ring(name, False, wcu, drain, checkpoint, parallel, segments, dryrun)
 
     def runlocal(self):
         """Run the cell container in a locally (using docker run).
@@ -74,10 +150,10 @@ class Cell(object):
         """Deploy the Sandbox cell directly via the cdk CLI (Use only for updates).
         Doesn't interact with DDB table and doesn't supply parameters. """
         imageuri = cellular.get_cf_output('Cellular-Repos', 'repoCellUri')
-        cellular.run_cmd('cdk deploy Cellular-Cell-sandbox ' +
-                         '--require-approval {} '.format(cdkRequireApproval) +
-                         '--parameters cellid=sandbox ' +
-                         '--parameters imageuri='+imageuri, 'cdk')
+        cellular.deploy_stack('Cellular-Cell-sandbox',
+                              '--require-approval {} '.format(cdkRequireApproval) +
+                              '--parameters cellid=sandbox ' +
+                              '--parameters imageuri='+imageuri)
 
 
 class Router(object):
@@ -100,9 +176,9 @@ class Router(object):
 
     def deploy(self):
         imageuri = cellular.get_cf_output('Cellular-Repos', 'repoRoutingUri')
-        cellular.run_cmd('cdk deploy Cellular-Router '
-                         '--require-approval {} '.format(cdkRequireApproval) +
-                         '--parameters imageuri={}'.format(imageuri), 'cdk')
+        cellular.deploy_stack('Cellular-Router',
+                              '--require-approval {} '.format(cdkRequireApproval) +
+                              '--parameters imageuri={}'.format(imageuri))
 
     def getdnsname(self):
         print(cellular.get_cf_output('Cellular-Router', 'dnsName'))
@@ -125,14 +201,13 @@ class Setup:
             Cell().create('cell1')
             Cell().create('cell2')
 
-    def destroy(self):
-        for c in cellular.get_cells():
-            cellular.destroy_stack(c['stackName'])
+    def destroy(self, parallel=None):
+        report(cellular.destroy_cells(cellular.get_cells(), parallel))
         cellular.destroy_stack('Cellular-Router')
         cellular.destroy_stack('Cellular-Repos')
 
-    def tagnodelete(self):
-        cellular.tagnodelete()
+    def tagnodelete(self, parallel=None):
+        report(cellular.tagnodelete(parallel))
 
     def allowingress(self, ip='myip'):
         """Add an IP v4 address to the prefix list to allow inbound traffic.
@@ -144,16 +219,16 @@ class Setup:
 
 class Repos:
     def deploy(self):
-        cellular.run_cmd('cdk deploy Cellular-Repos '
-                         '--require-approval {} '.format(cdkRequireApproval), 'cdk')
+        cellular.deploy_stack('Cellular-Repos',
+                              '--require-approval {}'.format(cdkRequireApproval))
 
 
 class Canary:
-    def startall(self):
-        cellular.start_stop_canaries('start')
+    def startall(self, parallel=None):
+        report(cellular.start_stop_canaries('start', parallel))
 
-    def stopall(self):
-        cellular.start_stop_canaries('stop')
+    def stopall(self, parallel=None):
+        report(cellular.start_stop_canaries('stop', parallel))
 
     def check(self, *cells):
         arn = cellular.get_cf_output(
@@ -178,18 +253,63 @@ class User:
             'User "{}" does not exist'.format(username)
         print(user)
 
-    def list(self):
-        for u in cellular.get_users()['Items']:
+    def list(self, segments=1):
+        """Prints all usernames as they are read. --segments reads the table
+        with a parallel scan."""
+        for u in cellular.get_users(['username'], segments):
             print(u['username'])
 
     def cell(self, username):
         user = cellular.get_user(username)
         if user is None:
             'User "{}" does not exist'.format(username)
-        print(user['cell'])
+        print(cellular.get_user_cell(user))
+
+    def migrate(self, username, cell, wcu=100, drain=cellular.migrate.DRAIN_SECONDS, checkpoint=None):
+        """Moves a user and its items to another cell: copies the items,
+        pins the user to the cell and, --drain seconds later, deletes the
+        items from the old cell. --drain must be at least as long as
+        clients can keep their login for the old cell: the router's
+        tokenTtl (or clientCacheTtl without tokens) plus its userCacheTtl.
+        The default covers the default settings."""
+        for result in cellular.migrate_user(username, cell, wcu=wcu, drain=drain, checkpoint=checkpoint):
+            report(result)
+
+    def movereport(self, add=(), remove=(), vnodes=None, segments=1):
+        """Lists the users that would move to another cell if cells were
+        added to or removed from the hash ring (routingMode=hash). Users
+        pinned to a cell in the users table don't move. --vnodes defaults
+        to the router's hashVnodes."""
+        add = [add] if isinstance(add, str) else list(add)
+        remove = [remove] if isinstance(remove, str) else list(remove)
+        ring = cellular.get_hash_ring(vnodes=vnodes)
+        changed = cellular.get_hash_ring(add, remove, vnodes)
+        hashed = 0
+        moved = 0
+        for u in cellular.get_users(['username', 'cell'], segments):
+            if 'cell' in u:
+                continue
+            hashed += 1
+            for username, old, new in cellular.hashring.migration_report([u['username']], ring, changed):
+                moved += 1
+                print('{}: {} -> {}'.format(username, old, new))
+        print('{} of {} hashed users would move'.format(moved, hashed))
+
+
+class Token:
+    def rotate(self, keyfile, keep=2):
+        """Adds a new signing key for login tokens to the key file used by
+        the router and the cells (tokenKeyFile) and keeps the newest `keep`
+        keys."""
+        print('New current key: ' + cellular.rotate_token_key(keyfile, keep))
 
 
 class Main:
+    def __init__(self, refresh=False):
+        """--refresh reads stack outputs from CloudFormation instead of the
+        stack cache (stackCache, stackCacheTtl)."""
+        cellular.stack_cache.refresh = refresh
+
     def cell(self):
         return Cell
 
@@ -211,6 +331,9 @@ class Main:
     def canary(self):
         return Canary
 
+    def token(self):
+        return Token
+
 
 if __name__ == '__main__':
     fire.Fire(Main)
@@ -0,0 +1,112 @@
+"""Runs an action for many cells (or stacks, canaries, ...) in parallel.
+
+At most `parallel` actions run at once. When an AWS API throttles, the
+action is retried after a jittered exponential backoff and the number of
+concurrent actions is halved; it grows back by one for every `parallel`
+successful actions (additive increase, multiplicative decrease).
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+THROTTLE_CODES = {'Throttling', 'ThrottlingException', 'TooManyRequestsException',
+                  'RequestLimitExceeded', 'ProvisionedThroughputExceededException',
+                  'SlowDown'}
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.5
+MAX_DELAY = 20
+
+
+def is_throttle(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+
+class AdaptiveLimit:
+    """Concurrency limit between 1 and maximum, halved on throttling."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def success(self):
+        with self.cond:
+            self.limit = min(self.maximum, self.limit + 1 / self.maximum)
+            self.cond.notify_all()
+
+    def throttled(self):
+        with self.cond:
+            self.limit = max(1.0, self.limit / 2)
+
+
+class Result:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = {}
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def summary(self):
+        lines = ['{} of {} succeeded, {} failed, {} throttled attempts'.format(
+            self.total - len(self.failed), self.total, len(self.failed), self.throttles)]
+        for name, error in sorted(self.failed.items()):
+            lines.append('  {}: {}'.format(name, error))
+        return '\n'.join(lines)
+
+
+def run(items, action, name=str, parallel=10, out=print, sleep=time.sleep):
+    """Calls action(item) for every item with at most `parallel` calls in
+    flight. Prints one progress line per item and returns a Result."""
+    items = list(items)
+    result = Result(len(items))
+    limit = AdaptiveLimit(max(1, parallel))
+
+    def attempt(item):
+        start = time.monotonic()
+        for n in range(MAX_ATTEMPTS):
+            try:
+                with limit:
+                    action(item)
+                limit.success()
+                return 'ok', None, start
+            except Exception as e:
+                if not is_throttle(e) or n == MAX_ATTEMPTS - 1:
+                    return 'failed', e, start
+                limit.throttled()
+                with result.lock:
+                    result.throttles += 1
+                sleep(random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** n)))
+
+    def task(item):
+        status, error, start = attempt(item)
+        with result.lock:
+            result.done += 1
+            if error is not None:
+                result.failed[name(item)] = error
+            out('[{}/{}] {}: {} ({:.1f}s){}'.format(
+                result.done, result.total, name(item), status, time.monotonic() - start,
+                '' if error is None else ' ' + str(error)))
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        list(executor.map(task, items))
+    return result
@@ -0,0 +1,347 @@
+"""Moves users, with their items, from one cell to another.
+
+A user is moved in steps, each recorded in an optional checkpoint file so
+that an interrupted rebalance can be resumed by running it again:
+
+1. copy: the user's items are copied from the source cell's table to the
+   target cell's table in batches of 25, a few batches at a time.
+2. switch: one transaction pins the user to the target cell in the users
+   table, if the user is still in the source cell, and moves one from the
+   source cell's userCount to the target's.
+3. drain: once routers have dropped the cached user and clients have
+   logged in again (`drain` seconds after the switch), items the user
+   created in the source cell since the copy are copied as well, without
+   overwriting items in the target, and the user's items are deleted from
+   the source cell.
+
+Values offloaded to the cell's object store (see
+source/cell-container/blobs.py) are copied to the target cell's bucket,
+under the same ref, before the items that point to them, and deleted from
+the source cell's bucket with the items.
+
+Changes to existing items made in the source cell after the copy are not
+carried over. Clients keep using their login for the source cell until it
+expires, so the drain must not start before then: items deleted earlier
+read as missing, and writes to the source cell are lost. The default,
+DRAIN_SECONDS, covers the router's default tokenTtl and userCacheTtl;
+raise it if those are longer.
+
+All writes spend a WriteBudget shared by all users, which limits the write
+capacity units used per second in the cell tables.
+"""
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from boto3.dynamodb.conditions import Attr, Key
+import fleet
+
+BATCH_SIZE = 25
+# Batches written at once for one user.
+BATCHES_IN_FLIGHT = 4
+MAX_ATTEMPTS = 8
+# Seconds from the switch to the drain: the router's tokenTtl (3600, which
+# also caps the clients' login cache), its userCacheTtl (30) and a margin.
+DRAIN_SECONDS = 3600 + 30 + 30
+
+
+class WriteBudget:
+    """Token bucket of write capacity units, refilled at wcu per second with
+    at most one second of burst. spend blocks until the units are
+    available; spending more than is available is paid back by later
+    callers waiting longer."""
+
+    def __init__(self, wcu, clock=time.monotonic, sleep=time.sleep):
+        self.wcu = float(wcu)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.wcu
+        self.last = clock()
+        self.spent = 0
+        self.lock = threading.Lock()
+
+    def spend(self, units):
+        if units <= 0:
+            return
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.wcu, self.tokens + (now - self.last) * self.wcu)
+            self.last = now
+            self.tokens -= units
+            self.spent += units
+            wait = -self.tokens / self.wcu if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+
+
+def write_units(item):
+    """Write capacity units of an item: one per started KB."""
+    size = sum(len(k) + len(str(v)) for k, v in item.items())
+    return max(1, math.ceil(size / 1024))
+
+
+class Checkpoint:
+    """Steps done per move (user, source and target cell), appended to a
+    JSON lines file. Without a path the steps are only kept in memory. A
+    file can be reused by later runs: moving a user again, e.g. back to its
+    old cell, is a new move."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.moves = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.moves[entry['user'], entry['source'], entry['target']] = entry
+
+    def step(self, username, source, target):
+        entry = self.moves.get((username, source, target))
+        return entry['step'] if entry else None
+
+    def pending(self, step):
+        return [e for e in self.moves.values() if e['step'] == step]
+
+    def record(self, username, source, target, step):
+        entry = {'user': username, 'source': source, 'target': target, 'step': step,
+                 'time': time.time()}
+        with self.lock:
+            self.moves[username, source, target] = entry
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+
+class CellBlobs:
+    """Objects of offloaded values; buckets maps a cell id to the name of
+    the cell's bucket."""
+
+    def __init__(self, s3, buckets):
+        self.s3 = s3
+        self.buckets = buckets
+
+    def bucket(self, cell_id):
+        bucket = self.buckets(cell_id)
+        if not bucket:
+            raise Exception('Cell "{}" has no blob bucket'.format(cell_id))
+        return bucket
+
+    def copy(self, source, target, ref):
+        self.s3.copy({'Bucket': self.bucket(source), 'Key': ref}, self.bucket(target), ref)
+
+    def delete(self, cell_id, ref):
+        self.s3.delete_object(Bucket=self.bucket(cell_id), Key=ref)
+
+
+class Migration:
+    """tables maps a cell id to the boto3 Table of the cell. users_table
+    and cells_table are the router's tables. blobs is a CellBlobs, needed
+    if users have offloaded values."""
+
+    def __init__(self, dynamodb, tables, users_table, cells_table, budget,
+                 checkpoint=None, drain=DRAIN_SECONDS, parallel=4, out=print, sleep=time.sleep, blobs=None):
+        self.dynamodb = dynamodb
+        self.tables = tables
+        self.users_table = users_table
+        self.cells_table = cells_table
+        self.budget = budget
+        self.checkpoint = checkpoint or Checkpoint()
+        self.drain_seconds = drain
+        self.parallel = parallel
+        self.out = out
+        self.sleep = sleep
+        self.blobs = blobs
+
+    # Reads and writes of one user's items
+
+    def items(self, cell_id, username, attributes=None):
+        kwargs = {'KeyConditionExpression': Key('username').eq(username)}
+        if attributes:
+            names = {'#a{}'.format(i): a for i, a in enumerate(attributes)}
+            kwargs['ProjectionExpression'] = ', '.join(names)
+            kwargs['ExpressionAttributeNames'] = names
+        table = self.tables(cell_id)
+        while True:
+            res = table.query(**kwargs)
+            yield from res['Items']
+            if 'LastEvaluatedKey' not in res:
+                return
+            kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+    def write_batch(self, table, requests):
+        """BatchWriteItem with retries of unprocessed items. Pays for the
+        estimated units first and for the rest once consumed is known."""
+        estimate = sum(write_units(r['PutRequest']['Item']) if 'PutRequest' in r else 1
+                       for r in requests)
+        self.budget.spend(estimate)
+        paid = estimate
+        for attempt in range(MAX_ATTEMPTS):
+            res = self.dynamodb.batch_write_item(RequestItems={table.name: requests},
+                                                 ReturnConsumedCapacity='TOTAL')
+            consumed = sum(c.get('CapacityUnits', 0) for c in res.get('ConsumedCapacity', []))
+            self.budget.spend(consumed - paid)
+            paid = 0
+            requests = res.get('UnprocessedItems', {}).get(table.name)
+            if not requests:
+                return
+            self.sleep(random.uniform(0, min(fleet.MAX_DELAY, fleet.BASE_DELAY * 2 ** attempt)))
+        raise Exception('{} items left unprocessed in {}'.format(len(requests), table.name))
+
+    def write_all(self, table, requests):
+        """Writes requests in batches, a few batches at a time."""
+        with ThreadPoolExecutor(max_workers=BATCHES_IN_FLIGHT) as executor:
+            pending = set()
+            batch = []
+            for request in requests:
+                batch.append(request)
+                if len(batch) == BATCH_SIZE:
+                    pending.add(executor.submit(self.write_batch, table, batch))
+                    batch = []
+                if len(pending) >= BATCHES_IN_FLIGHT:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            if batch:
+                pending.add(executor.submit(self.write_batch, table, batch))
+            for future in pending:
+                future.result()
+
+    def with_blob(self, item, source, target):
+        """Copies the object of an offloaded value to the target cell."""
+        if 'blob' in item:
+            if self.blobs is None:
+                raise Exception('Item "{}" has an offloaded value and no blob buckets are set'.format(item['key']))
+            self.blobs.copy(source, target, item['blob']['ref'])
+        return item
+
+    # Steps
+
+    def copy(self, username, source, target):
+        target_table = self.tables(target)
+        self.write_all(target_table, ({'PutRequest': {'Item': self.with_blob(item, source, target)}}
+                                      for item in self.items(source, username)))
+
+    def switch(self, username, source, target):
+        client = self.dynamodb.meta.client
+        try:
+            client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': self.users_table.name,
+                    'Key': {'username': username},
+                    'UpdateExpression': 'SET #c = :target',
+                    'ConditionExpression': 'attribute_exists(username) AND '
+                                           '(#c = :source OR attribute_not_exists(#c))',
+                    'ExpressionAttributeNames': {'#c': 'cell'},
+                    'ExpressionAttributeValues': {':source': source, ':target': target},
+                }},
+                {'Update': {
+                    'TableName': self.cells_table.name,
+                    'Key': {'cell_id': source},
+                    'UpdateExpression': 'ADD userCount :minus',
+                    'ExpressionAttributeValues': {':minus': -1},
+                }},
+                {'Update': {
+                    'TableName': self.cells_table.name,
+                    'Key': {'cell_id': target},
+                    'UpdateExpression': 'ADD userCount :plus',
+                    'ExpressionAttributeValues': {':plus': 1},
+                }},
+            ])
+        except client.exceptions.TransactionCanceledException:
+            # Done before the checkpoint was written, or the user moved.
+            user = self.users_table.get_item(Key={'username': username}).get('Item', {})
+            if user.get('cell') != target:
+                raise
+
+    def drain(self, username, source, target):
+        target_table = self.tables(target)
+        present = {i['key'] for i in self.items(target, username, ['key'])}
+        for item in self.items(source, username):
+            if item['key'] in present:
+                continue
+            self.budget.spend(write_units(item))
+            try:
+                target_table.put_item(Item=self.with_blob(item, source, target),
+                                      ConditionExpression=Attr('key').not_exists())
+            except target_table.meta.client.exceptions.ConditionalCheckFailedException:
+                if 'blob' in item:
+                    self.blobs.delete(target, item['blob']['ref'])
+        refs = []
+
+        def delete_request(item):
+            if 'blob' in item:
+                refs.append(item['blob']['ref'])
+            return {'DeleteRequest': {'Key': {'username': username, 'key': item['key']}}}
+        self.write_all(self.tables(source), (delete_request(i)
+                                             for i in self.items(source, username, ['username', 'key', 'blob'])))
+        for ref in refs:
+            self.blobs.delete(source, ref)
+
+    # Moves
+
+    def move(self, move):
+        username, source, target = move
+        if self.checkpoint.step(username, source, target) not in ('switched', 'drained'):
+            self.copy(username, source, target)
+            self.checkpoint.record(username, source, target, 'copied')
+            self.switch(username, source, target)
+            self.checkpoint.record(username, source, target, 'switched')
+
+    def run(self, moves):
+        """Moves users given as (username, source, target), including the
+        users a previous run left switched but not drained. Returns the
+        fleet.Result of the copy and switch steps and the one of the drain
+        step."""
+        moves = [m for m in moves if self.checkpoint.step(*m) != 'drained']
+        moved = fleet.run(moves, self.move, name=lambda m: m[0], parallel=self.parallel, out=self.out)
+        switched = self.checkpoint.pending('switched')
+        if switched:
+            latest = max(e['time'] for e in switched)
+            wait_seconds = latest + self.drain_seconds - time.time()
+            if wait_seconds > 0:
+                self.out('Waiting {:.0f}s before draining {} users'.format(wait_seconds, len(switched)))
+                self.sleep(wait_seconds)
+
+        def drain(entry):
+            self.drain(entry['user'], entry['source'], entry['target'])
+            self.checkpoint.record(entry['user'], entry['source'], entry['target'], 'drained')
+        drained = fleet.run(switched, drain, name=lambda e: e['user'], parallel=self.parallel, out=self.out)
+        return moved, drained
+
+
+def plan_rebalance(counts, weights, users):
+    """Moves that bring the number of users per cell in line with the
+    weights. counts maps cell ids to their number of users, weights maps
+    the cells that can take users to their weight; users of cells without
+    a weight are all moved. Takes the users to move
+    from users, an iterable of (username, cell) pairs, and stops reading it
+    once all moves are planned."""
+    total = sum(counts.values())
+    weight_sum = sum(weights.values())
+    share = {c: total * weights.get(c, 0) / weight_sum if weight_sum else 0 for c in counts}
+    surplus = {c: int(counts[c] - share[c]) for c in counts if counts[c] - share[c] >= 1}
+    deficit = {c: int(share[c] - counts.get(c, 0)) for c in weights
+               if share.get(c, 0) - counts.get(c, 0) >= 1}
+    moves = []
+    room = sorted(deficit.items())
+    if not room:
+        return moves
+    for username, cell in users:
+        if not room or not any(surplus.values()):
+            break
+        if surplus.get(cell, 0) <= 0:
+            continue
+        target, free = room[0]
+        moves.append((username, cell, target))
+        surplus[cell] -= 1
+        room[0] = (target, free - 1)
+        if free - 1 <= 0:
+            room.pop(0)
+    return moves
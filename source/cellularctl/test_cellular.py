@@ -0,0 +1,126 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['stackCacheTtl'] = '0'
+
+import cellular
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+
+class TestCellular(unittest.TestCase):
+    """cellularctl's table operations against the stand-in."""
+
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'cell1': 'cell1.local', 'cell2': 'cell2.local'})
+        cellular.init_clients(standin.session(self.backend))
+
+    def test_cells(self):
+        self.assertEqual(sorted(c['cell_id'] for c in cellular.get_cells()), ['cell1', 'cell2'])
+
+    def test_update_cell(self):
+        cellular.update_cell('cell1', weight=2, drain=True)
+        cell = {c['cell_id']: c for c in cellular.get_cells()}['cell1']
+        self.assertEqual((cell['weight'], cell['drain']), (2, True))
+        with self.assertRaises(cellular.dynamodb.meta.client.exceptions.ConditionalCheckFailedException):
+            cellular.update_cell('nope', weight=1)
+
+    def test_user_cell(self):
+        users = cellular.dynamodb.Table('Cellular-Routing-Users')
+        users.put_item(Item={'username': 'pinned', 'cell': 'cell2'})
+        users.put_item(Item={'username': 'hashed'})
+        self.assertEqual(cellular.get_user_cell(cellular.get_user('pinned')), 'cell2')
+        self.assertIn(cellular.get_user_cell(cellular.get_user('hashed')), ('cell1', 'cell2'))
+        self.assertIsNone(cellular.get_user('nobody'))
+
+    def test_scans(self):
+        users = cellular.dynamodb.Table('Cellular-Routing-Users')
+        with users.batch_writer() as w:
+            for i in range(50):
+                w.put_item(Item={'username': 'user{}'.format(i), 'cell': 'cell1', 'name': 'x'})
+        for segments in (1, 3):
+            items = list(cellular.scan_items(users, ['username', 'name'], segments, page_size=7))
+            self.assertEqual(len(items), 50)
+            self.assertEqual(items[0].keys(), {'username', 'name'})
+        self.assertEqual(len(list(cellular.get_users(['username'], segments=4))), 50)
+
+    def test_scan_stopped_early(self):
+        users = cellular.dynamodb.Table('Cellular-Routing-Users')
+        with users.batch_writer() as w:
+            for i in range(400):
+                w.put_item(Item={'username': 'user{}'.format(i)})
+        items = cellular.scan_items(users, segments=4, page_size=1)
+        self.assertIn('username', next(items))
+        items.close()
+        # The readers stop once their next page can't be handed over.
+        time.sleep(0.5)
+        scans = self.backend.stats()['requests']['Scan']
+        self.assertLess(scans, 50)
+        time.sleep(0.2)
+        self.assertEqual(self.backend.stats()['requests']['Scan'], scans)
+
+    def test_no_pipeline_clients(self):
+        import cell_lib
+        self.assertEqual(cell_lib.dynamodb.cache_info().currsize + cell_lib.stepfunction.cache_info().currsize, 0)
+
+    def test_cf_outputs(self):
+        outputs = cellular.get_cf_outputs('Cellular-Cell-cell1')
+        self.assertEqual(outputs['dnsName'], 'cell1.local')
+        with self.assertRaises(Exception):
+            cellular.get_cf_output('Cellular-Cell-cell1', 'nope')
+
+    def test_destroy_cells(self):
+        result = cellular.destroy_cells(cellular.get_cells(), parallel=2)
+        self.assertTrue(result.ok)
+        self.assertEqual(sorted(self.backend.cloudformation.stacks), ['Cellular-Router'])
+
+
+class TestStackCache(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'cell1': 'cell1.local'})
+        cellular.init_clients(standin.session(self.backend))
+        self.path = os.path.join(tempfile.mkdtemp(), 'stacks.json')
+        self.now = [1000.0]
+
+    def cache(self):
+        return cellular.StackCache(self.path, ttl=60, clock=lambda: self.now[0])
+
+    def describes(self):
+        return self.backend.stats()['requests'].get('DescribeStacks', 0)
+
+    def test_one_describe_per_stack(self):
+        cellular.get_cf_output('Cellular-Router', 'cellsTable')
+        cellular.get_cf_output('Cellular-Router', 'usersTable')
+        cellular.get_cells()
+        self.assertEqual(self.describes(), 1)
+
+    def test_file_shared_between_processes(self):
+        self.cache().get('Cellular-Router', cellular.describe_stack)
+        outputs = self.cache().get('Cellular-Router', cellular.describe_stack)
+        self.assertEqual(outputs['cellsTable'], 'Cellular-Routing-Cells')
+        self.assertEqual(self.describes(), 1)
+        self.now[0] += 61
+        self.cache().get('Cellular-Router', cellular.describe_stack)
+        self.assertEqual(self.describes(), 2)
+
+    def test_refresh_and_forget(self):
+        self.cache().get('Cellular-Router', cellular.describe_stack)
+        cache = self.cache()
+        cache.refresh = True
+        cache.get('Cellular-Router', cellular.describe_stack)
+        self.assertEqual(self.describes(), 2)
+        cache.forget('Cellular-Router')
+        self.cache().get('Cellular-Router', cellular.describe_stack)
+        self.assertEqual(self.describes(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
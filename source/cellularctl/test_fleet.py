@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+from botocore.exceptions import ClientError
+import fleet
+
+
+def throttle_error():
+    return ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'UpdateService')
+
+
+class TestRun(unittest.TestCase):
+    def test_concurrency_bound(self):
+        active, peak, lock = [0], [0], threading.Lock()
+
+        def action(item):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+        lines = []
+        result = fleet.run(range(20), action, parallel=4, out=lines.append)
+        self.assertTrue(result.ok)
+        self.assertLessEqual(peak[0], 4)
+        self.assertGreater(peak[0], 1)
+        self.assertEqual(len(lines), 20)
+        self.assertTrue(lines[-1].startswith('[20/20]'))
+
+    def test_failures_are_summarised(self):
+        def action(item):
+            if item == 'cell2':
+                raise Exception('stack does not exist')
+        result = fleet.run(['cell1', 'cell2', 'cell3'], action, out=lambda line: None)
+        self.assertFalse(result.ok)
+        self.assertEqual(list(result.failed), ['cell2'])
+        self.assertIn('2 of 3 succeeded, 1 failed', result.summary())
+        self.assertIn('cell2: stack does not exist', result.summary())
+
+    def test_throttles_are_retried(self):
+        calls = {}
+
+        def action(item):
+            calls[item] = calls.get(item, 0) + 1
+            if calls[item] <= 2:
+                raise throttle_error()
+        result = fleet.run(['cell1', 'cell2'], action, out=lambda line: None, sleep=lambda s: None)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.throttles, 4)
+        self.assertEqual(calls, {'cell1': 3, 'cell2': 3})
+
+    def test_gives_up_after_max_attempts(self):
+        def action(item):
+            raise throttle_error()
+        result = fleet.run(['cell1'], action, out=lambda line: None, sleep=lambda s: None)
+        self.assertEqual(result.throttles, fleet.MAX_ATTEMPTS - 1)
+        self.assertIn('cell1', result.failed)
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+    def test_aimd(self):
+        limit = fleet.AdaptiveLimit(8)
+        limit.throttled()
+        limit.throttled()
+        self.assertEqual(limit.limit, 2)
+        for _ in range(8):
+            limit.success()
+        self.assertEqual(limit.limit, 3)
+        for _ in range(10):
+            limit.throttled()
+        self.assertEqual(limit.limit, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import io
+import os
+import sys
+import contextlib
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['stackCacheTtl'] = '0'
+
+import cellular
+import migrate
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+
+class TestWriteBudget(unittest.TestCase):
+    def test_rate(self):
+        now, slept = [0.0], []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+        budget = migrate.WriteBudget(10, clock=lambda: now[0], sleep=sleep)
+        for _ in range(30):
+            budget.spend(1)
+        # One second of burst, then 10 units per second.
+        self.assertAlmostEqual(now[0], 2.0)
+        self.assertEqual(budget.spent, 30)
+
+
+class TestPlan(unittest.TestCase):
+    def test_by_weight(self):
+        users = [('u{}'.format(i), 'cell1') for i in range(8)] + [('v{}'.format(i), 'cell2') for i in range(4)]
+        moves = migrate.plan_rebalance({'cell1': 8, 'cell2': 4, 'cell3': 0},
+                                       {'cell1': 1, 'cell2': 1, 'cell3': 1}, iter(users))
+        self.assertEqual(moves, [('u0', 'cell1', 'cell3'), ('u1', 'cell1', 'cell3'),
+                                 ('u2', 'cell1', 'cell3'), ('u3', 'cell1', 'cell3')])
+
+    def test_evacuate(self):
+        moves = migrate.plan_rebalance({'cell1': 2, 'cell2': 0}, {'cell2': 1},
+                                       [('a', 'cell1'), ('b', 'cell1')])
+        self.assertEqual([m[2] for m in moves], ['cell2', 'cell2'])
+
+    def test_balanced(self):
+        self.assertEqual(migrate.plan_rebalance({'cell1': 3, 'cell2': 3}, {'cell1': 1, 'cell2': 1}, []), [])
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'cell1': 'cell1.local', 'cell2': 'cell2.local'})
+        cellular.init_clients(standin.session(self.backend))
+        self.users = cellular.dynamodb.Table('Cellular-Routing-Users')
+        self.users.put_item(Item={'username': 'alice', 'cell': 'cell1'})
+        with cellular.get_cell_table('cell1').batch_writer() as w:
+            for i in range(60):
+                w.put_item(Item={'username': 'alice', 'key': 'k{}'.format(i), 'value': 'v'})
+            w.put_item(Item={'username': 'bob', 'key': 'k', 'value': 'v'})
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.jsonl')
+
+    def count(self, cell, username):
+        return len(list(cellular.get_migration().items(cell, username)))
+
+    def test_migrate_user(self):
+        lines = []
+        migration = cellular.get_migration(wcu=1000, drain=0, checkpoint=self.checkpoint)
+        migration.out = lines.append
+        moved, drained = migration.run([('alice', 'cell1', 'cell2')])
+        self.assertTrue(moved.ok and drained.ok)
+        self.assertEqual(self.count('cell2', 'alice'), 60)
+        self.assertEqual(self.count('cell1', 'alice'), 0)
+        self.assertEqual(self.count('cell1', 'bob'), 1)
+        self.assertEqual(cellular.get_user('alice')['cell'], 'cell2')
+        cells = {c['cell_id']: c for c in cellular.get_cells()}
+        self.assertEqual((cells['cell1']['userCount'], cells['cell2']['userCount']), (-1, 1))
+        self.assertGreaterEqual(migration.budget.spent, 120)
+
+    def test_resume_drains_switched_users(self):
+        migration = cellular.get_migration(drain=0, checkpoint=self.checkpoint)
+        migration.out = lambda line: None
+        migration.copy('alice', 'cell1', 'cell2')
+        migration.switch('alice', 'cell1', 'cell2')
+        migration.checkpoint.record('alice', 'cell1', 'cell2', 'switched')
+        # New item in the old cell from a client that had not logged in again.
+        cellular.get_cell_table('cell1').put_item(Item={'username': 'alice', 'key': 'late'})
+
+        resumed = cellular.get_migration(drain=0, checkpoint=self.checkpoint)
+        resumed.out = lambda line: None
+        resumed.run([])
+        self.assertEqual(self.count('cell2', 'alice'), 61)
+        self.assertEqual(self.count('cell1', 'alice'), 0)
+        self.assertEqual(resumed.checkpoint.step('alice', 'cell1', 'cell2'), 'drained')
+        self.assertEqual(resumed.run([('alice', 'cell1', 'cell2')])[0].total, 0)
+
+    def test_checkpoint_reused_for_another_move(self):
+        migration = cellular.get_migration(drain=0, checkpoint=self.checkpoint)
+        migration.out = lambda line: None
+        migration.run([('alice', 'cell1', 'cell2')])
+        # A later rebalance with the same file moves her back.
+        back = cellular.get_migration(drain=0, checkpoint=self.checkpoint)
+        back.out = lambda line: None
+        moved, drained = back.run([('alice', 'cell2', 'cell1')])
+        self.assertEqual((moved.total, drained.total), (1, 1))
+        self.assertEqual(cellular.get_user('alice')['cell'], 'cell1')
+        self.assertEqual((self.count('cell1', 'alice'), self.count('cell2', 'alice')), (60, 0))
+
+    def test_offloaded_values(self):
+        class FakeS3:
+            def __init__(self):
+                self.objects = {('b1', 'r1'): b'data', ('b1', 'r2'): b'late'}
+
+            def copy(self, source, bucket, key):
+                self.objects[bucket, key] = self.objects[source['Bucket'], source['Key']]
+
+            def delete_object(self, Bucket, Key):
+                del self.objects[Bucket, Key]
+
+        s3 = FakeS3()
+        table = cellular.get_cell_table('cell1')
+        table.put_item(Item={'username': 'alice', 'key': 'big', 'blob': {'ref': 'r1', 'size': 4}})
+        migration = cellular.get_migration(drain=0, checkpoint=self.checkpoint)
+        migration.blobs = migrate.CellBlobs(s3, {'cell1': 'b1', 'cell2': 'b2'}.get)
+        migration.out = lambda line: None
+        migration.move(('alice', 'cell1', 'cell2'))
+        self.assertEqual(s3.objects[('b2', 'r1')], b'data')
+        table.put_item(Item={'username': 'alice', 'key': 'late', 'blob': {'ref': 'r2', 'size': 4}})
+        migration.run([])
+        self.assertEqual(s3.objects, {('b2', 'r1'): b'data', ('b2', 'r2'): b'late'})
+        item = cellular.get_cell_table('cell2').get_item(Key={'username': 'alice', 'key': 'late'})['Item']
+        self.assertEqual(item['blob']['ref'], 'r2')
+
+        # Without buckets the copy fails rather than leave dangling refs.
+        migration.blobs = None
+        with self.assertRaises(Exception):
+            migration.copy('alice', 'cell2', 'cell1')
+
+    def test_switch_only_from_source(self):
+        migration = cellular.get_migration()
+        with self.assertRaises(Exception):
+            migration.switch('alice', 'cell2', 'cell3')
+        self.assertEqual(cellular.get_user('alice')['cell'], 'cell1')
+        # Already switched, e.g. before a crash.
+        migration.switch('alice', 'cell2', 'cell1')
+
+    def test_default_drain_outlasts_logins(self):
+        # tokenTtl and userCacheTtl of the router, clientCacheTtl of clients.
+        self.assertGreaterEqual(cellular.get_migration().drain_seconds, max(3600, 300) + 30)
+
+    def test_rebalance_plan(self):
+        for i in range(4):
+            self.users.put_item(Item={'username': 'pinned{}'.format(i), 'cell': 'cell1'})
+        moves = cellular.plan_rebalance()
+        self.assertEqual(len(moves), 2)
+        self.assertEqual({(m[1], m[2]) for m in moves}, {('cell1', 'cell2')})
+
+
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'cell1': 'cell1.local', 'cell2': 'cell2.local', 'cell3': 'cell3.local'})
+        cellular.init_clients(standin.session(self.backend))
+        cellular.update_cell('cell3', ring=False)
+        ring = cellular.get_hash_ring()
+        users = cellular.dynamodb.Table('Cellular-Routing-Users')
+        for i in range(40):
+            username = 'user{}'.format(i)
+            users.put_item(Item={'username': username})
+            cellular.get_cell_table(ring.lookup(username)).put_item(Item={'username': username, 'key': 'k'})
+
+    def assert_items_in_user_cells(self):
+        for u in cellular.get_users():
+            item = cellular.get_cell_table(cellular.get_user_cell(u)).get_item(
+                Key={'username': u['username'], 'key': 'k'})
+            self.assertIn('Item', item, u['username'])
+
+    def test_vnodes_of_router(self):
+        self.assertEqual(len(cellular.get_hash_ring()), 2 * 100)
+        outputs = dict(cellular.get_cf_outputs('Cellular-Router'), hashVnodes='8')
+        self.backend.cloudformation.put_stack('Cellular-Router', outputs)
+        cellular.init_clients(standin.session(self.backend))
+        self.assertEqual(len(cellular.get_hash_ring()), 2 * 8)
+
+    def test_join_and_leave(self):
+        moves = cellular.plan_ring_change('cell3')
+        self.assertTrue(moves)
+        self.assertEqual({m[2] for m in moves}, {'cell3'})
+        with contextlib.redirect_stdout(io.StringIO()):
+            moved, drained = cellular.change_ring('cell3', moves, wcu=1000, drain=0)
+        self.assertTrue(moved.ok and drained.ok)
+        self.assertEqual(cellular.get_hash_ring().cell_ids, ['cell1', 'cell2', 'cell3'])
+        self.assert_items_in_user_cells()
+        self.assertEqual(cellular.plan_ring_change('cell3'), [])
+
+        moves = cellular.plan_ring_change('cell1', join=False)
+        self.assertEqual({m[1] for m in moves}, {'cell1'})
+        with contextlib.redirect_stdout(io.StringIO()):
+            cellular.change_ring('cell1', moves, join=False, wcu=1000, drain=0)
+        self.assertEqual(cellular.get_hash_ring().cell_ids, ['cell2', 'cell3'])
+        self.assert_items_in_user_cells()
+        with self.assertRaises(Exception):
+            cellular.plan_ring_change('nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
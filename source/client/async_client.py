@@ -0,0 +1,163 @@
+import asyncio
+import random
+import time
+import httpx
+from client_lib import stale_login, IDEMPOTENT
+
+# Statuses worth another attempt: throttled or the cell/load balancer is
+# briefly unavailable.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Of those, the ones that say the request was not processed, so any route
+# can be sent again.
+NOT_PROCESSED_STATUS = {429, 503}
+
+
+def not_sent(e):
+    """True if an httpx error happened before the request was sent."""
+    return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+class AsyncClient:
+    """asyncio version of client_lib.Client for driving many concurrent
+    operations from one process.
+
+    concurrency bounds the requests in flight (and the pooled connections),
+    retries is the number of extra attempts after a connection error or a
+    retryable status, with full-jitter backoff between base_delay and
+    max_delay. deadline is the time budget in seconds for one operation,
+    retries included; each attempt is further limited to timeout. Clients
+    for many users can share one pool by passing http and semaphore from
+    another AsyncClient.
+
+        async with AsyncClient(router, 'user1') as c:
+            await c.login()
+            await asyncio.gather(*[c.put(str(i), 'v') for i in range(10000)])
+    """
+
+    def __init__(self, router, username, concurrency=64, retries=3, timeout=5, deadline=15,
+                 base_delay=0.05, max_delay=2, transport=None, http=None, semaphore=None):
+        self.router = router
+        self.username = username
+        self.dnsNameCell = None
+        self.token = None
+        self.retries = retries
+        self.timeout = timeout
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.semaphore = semaphore or asyncio.Semaphore(concurrency)
+        self.owns_http = http is None
+        self.http = http or httpx.AsyncClient(
+            transport=transport,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency))
+        self._login = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        if self.owns_http:
+            await self.http.aclose()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def post(self, url, data, headers=None, deadline=None, idempotent=True):
+        """POSTs with retries until the deadline (a time.monotonic() value).
+        Raises TimeoutError once the deadline has passed. Unless idempotent,
+        the request is only sent again if it was certainly not processed:
+        the connection failed or the answer was 429 or 503."""
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('Deadline exceeded for ' + url)
+            try:
+                # httpx timeouts apply per connect/read/write; wait_for bounds
+                # the whole attempt.
+                async with self.semaphore:
+                    r = await asyncio.wait_for(self.http.post(url, json=data, headers=headers),
+                                               min(self.timeout, remaining))
+                if r.status_code not in RETRY_STATUS or attempt >= self.retries or \
+                        not (idempotent or r.status_code in NOT_PROCESSED_STATUS):
+                    return r
+            except asyncio.TimeoutError:
+                if attempt >= self.retries or deadline <= time.monotonic() or not idempotent:
+                    raise TimeoutError('Deadline exceeded for ' + url)
+            except httpx.TransportError as e:
+                if attempt >= self.retries or not (idempotent or not_sent(e)):
+                    raise
+            await asyncio.sleep(min(self.backoff(attempt), max(0, deadline - time.monotonic())))
+            attempt += 1
+
+    async def request(self, uri, data=None):
+        r = await self.post('http://' + self.router + uri, data, idempotent=uri in IDEMPOTENT)
+        r.raise_for_status()
+        return r
+
+    async def post_cell(self, uri, data, deadline):
+        return await self.post('http://' + self.dnsNameCell + uri, data, deadline=deadline,
+                               headers={'Authorization': 'Bearer ' + (self.token or self.username)},
+                               idempotent=uri in IDEMPOTENT)
+
+    async def request_cell(self, uri, data=None):
+        if not self.dnsNameCell:
+            raise Exception('Not logged in.')
+        deadline = time.monotonic() + self.deadline
+        seen = self.token, self.dnsNameCell
+        try:
+            r = await self.post_cell(uri, data, deadline)
+            retry = self.router is not None and stale_login(uri, r)
+        except httpx.TransportError as e:
+            if self.router is None or not (uri in IDEMPOTENT or not_sent(e)):
+                raise
+            retry = True
+        if retry:
+            await self.relogin(seen)
+            r = await self.post_cell(uri, data, deadline)
+        r.raise_for_status()
+        return r
+
+    async def relogin(self, seen):
+        # Concurrent requests that fail with the same login share one
+        # /login call instead of each asking the router.
+        if (self.token, self.dnsNameCell) != seen:
+            return
+        if self._login is None or self._login.done():
+            self._login = asyncio.ensure_future(self.login())
+        await asyncio.shield(self._login)
+
+    async def register(self):
+        await self.request('/register', {'username': self.username})
+
+    async def login(self):
+        r = await self.request('/login', {
+            'username': self.username,
+        })
+        j = r.json()
+        self.dnsNameCell = j['dns_name_cell']
+        self.token = j.get('token')
+
+    async def put(self, key, value):
+        await self.request_cell('/put', data={'key': key, 'value': value})
+
+    async def get(self, key):
+        try:
+            res = await self.request_cell('/get', data={'key': key})
+        except httpx.HTTPStatusError as e:
+            # 404 is a normal case here - return an error
+            if e.response.status_code == 404:
+                raise KeyError(key)
+            raise
+        return res.json()['value']
+
+    async def delete(self, key):
+        await self.request_cell('/delete', data={'key': key})
+
+    async def validate(self):
+        return (await self.request_cell('/validate')).json()
@@ -0,0 +1,294 @@
+"""Load generator for the router and the cells (`clientctl bench`).
+
+Workloads:
+
+- register: every operation registers a new user.
+- login: logs in users registered during setup.
+- kv: get/put mix over `keys` keys per user, with read_ratio reads and a
+  uniform or zipf key distribution.
+
+In closed-loop mode `concurrency` workers each send the next request as soon
+as the previous one completes. In open-loop mode requests arrive at `rate`
+per second (Poisson arrivals) regardless of how fast the service answers,
+and latency is measured from the scheduled arrival, so queueing delay is
+not hidden (coordinated omission).
+
+Latencies are kept per endpoint and per cell in log-linear histograms.
+"""
+import asyncio
+import bisect
+import random
+import time
+import uuid
+import httpx
+from async_client import AsyncClient
+
+# Values below 2 ** PRECISION_BITS microseconds are kept exactly, larger
+# ones with a relative error below 2 ** -(PRECISION_BITS - 1) (about 1.6%).
+PRECISION_BITS = 7
+
+
+class Histogram:
+    """Latency histogram in the style of HdrHistogram: fixed relative
+    precision over any range, constant memory per bucket, mergeable."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(us):
+        shift = max(0, us.bit_length() - PRECISION_BITS)
+        return shift, us >> shift
+
+    @staticmethod
+    def highest(bucket):
+        # Highest value that falls in the bucket, as HdrHistogram reports.
+        shift, sub = bucket
+        return ((sub + 1) << shift) - 1
+
+    def record(self, seconds):
+        us = max(0, int(seconds * 1e6))
+        b = self.bucket(us)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.count += 1
+        self.total += us
+        self.max = max(self.max, us)
+
+    def merge(self, other):
+        for b, n in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Returns the p-th percentile in microseconds."""
+        if not self.count:
+            return 0
+        rank = max(1, int(p / 100 * self.count + 0.5))
+        seen = 0
+        for b in sorted(self.counts, key=self.highest):
+            seen += self.counts[b]
+            if seen >= rank:
+                return min(self.highest(b), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+
+
+class Zipf:
+    """Draws 0..n-1 with probability proportional to 1 / (i + 1) ** s."""
+
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0
+        for i in range(n):
+            total += 1 / (i + 1) ** s
+            self.cumulative.append(total)
+
+    def __call__(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+class Results:
+    def __init__(self):
+        self.endpoints = {}
+        self.cells = {}
+        self.errors = {}
+        self.dropped = 0
+        self.elapsed = 0
+
+    def record(self, endpoint, cell, seconds, error=None):
+        if error is not None:
+            key = '{} {}'.format(endpoint, error)
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return
+        self.endpoints.setdefault(endpoint, Histogram()).record(seconds)
+        self.cells.setdefault(cell, Histogram()).record(seconds)
+
+    def report(self):
+        def table(histograms):
+            return {k: dict(h.summary(), throughput=h.count / self.elapsed if self.elapsed else 0)
+                    for k, h in sorted(histograms.items())}
+        return {
+            'elapsed': self.elapsed,
+            'endpoints': table(self.endpoints),
+            'cells': table(self.cells),
+            'errors': self.errors,
+            'dropped': self.dropped,
+        }
+
+
+def format_report(report):
+    lines = []
+    for title in ('endpoints', 'cells'):
+        lines.append('{:<40} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            title, 'count', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms'))
+        for name, s in report[title].items():
+            lines.append('{:<40} {:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                name, s['count'], s['throughput'], s['p50'] / 1000, s['p99'] / 1000,
+                s['p999'] / 1000, s['max'] / 1000))
+        lines.append('')
+    for name, n in sorted(report['errors'].items()):
+        lines.append('errors {}: {}'.format(name, n))
+    if report['dropped']:
+        lines.append('dropped (open loop backlog full): {}'.format(report['dropped']))
+    return '\n'.join(lines)
+
+
+class Bench:
+    def __init__(self, router, workload='kv', users=10, keys=1000, read_ratio=0.9,
+                 distribution='uniform', zipf_s=1.1, value_size=100, preload=True,
+                 concurrency=16, rate=None, duration=10, max_backlog=10000, seed=None,
+                 transport=None):
+        if workload not in ('register', 'login', 'kv'):
+            raise ValueError('Unknown workload "{}"'.format(workload))
+        if distribution not in ('uniform', 'zipf'):
+            raise ValueError('Unknown distribution "{}"'.format(distribution))
+        self.router = router
+        self.workload = workload
+        self.users = users
+        self.keys = keys
+        self.read_ratio = read_ratio
+        self.preload = preload
+        self.value = 'x' * value_size
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.max_backlog = max_backlog
+        self.rng = random.Random(seed)
+        self.choose_key = (Zipf(keys, zipf_s, self.rng) if distribution == 'zipf'
+                           else lambda: self.rng.randrange(keys))
+        self.transport = transport
+        self.run_id = uuid.uuid4().hex[:8]
+        self.registered = 0
+
+    def client(self, username):
+        return AsyncClient(self.router, username, http=self.http, semaphore=self.semaphore)
+
+    async def setup(self):
+        self.clients = [self.client('bench-{}-{}'.format(self.run_id, i)) for i in range(self.users)]
+        if self.workload == 'register':
+            return
+        await asyncio.gather(*[c.register() for c in self.clients])
+        await asyncio.gather(*[c.login() for c in self.clients])
+        if self.workload == 'kv' and self.preload:
+            items = [{'key': str(k), 'value': self.value} for k in range(self.keys)]
+            await asyncio.gather(*[c.request_cell('/batch/put', {'items': items[i:i + 1000]})
+                                   for c in self.clients for i in range(0, len(items), 1000)])
+
+    async def operation(self):
+        """Runs one operation. Returns the endpoint and the cell (or router)
+        it went to."""
+        if self.workload == 'register':
+            self.registered += 1
+            c = self.client('bench-{}-r{}'.format(self.run_id, self.registered))
+            await c.register()
+            return '/register', 'router'
+        c = self.rng.choice(self.clients)
+        if self.workload == 'login':
+            await c.login()
+            return '/login', 'router'
+        key = str(self.choose_key())
+        if self.rng.random() < self.read_ratio:
+            try:
+                await c.get(key)
+            except KeyError:
+                pass
+            return '/get', c.dnsNameCell
+        await c.put(key, self.value)
+        return '/put', c.dnsNameCell
+
+    async def timed(self, results, start):
+        try:
+            endpoint, cell = await self.operation()
+        except Exception as e:
+            results.record(self.workload, None, 0, error=type(e).__name__)
+        else:
+            results.record(endpoint, cell, time.monotonic() - start)
+
+    async def closed_loop(self, results, end):
+        async def worker():
+            while time.monotonic() < end:
+                await self.timed(results, time.monotonic())
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+    async def open_loop(self, results, end):
+        pending = set()
+        due = time.monotonic()
+        while due < end:
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(pending) >= self.max_backlog:
+                results.dropped += 1
+            else:
+                task = asyncio.ensure_future(self.timed(results, due))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            due += self.rng.expovariate(self.rate)
+        if pending:
+            await asyncio.wait(pending)
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency,
+                              max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(transport=self.transport, limits=limits) as self.http:
+            await self.setup()
+            results = Results()
+            start = time.monotonic()
+            end = start + self.duration
+            if self.rate:
+                await self.open_loop(results, end)
+            else:
+                await self.closed_loop(results, end)
+            results.elapsed = time.monotonic() - start
+        return results.report()
+
+
+def run(router, **kwargs):
+    return asyncio.run(Bench(router, **kwargs).run())
+
+
+def setup_local(cells):
+    """Creates the router and cell tables in the DynamoDB endpoint boto3 is
+    configured for (e.g. DynamoDB Local via AWS_ENDPOINT_URL_DYNAMODB) and
+    registers cells, given as {cell_id: 'host:port'}, as active prod cells."""
+    import boto3
+    dynamodb = boto3.resource('dynamodb')
+    existing = {t.name for t in dynamodb.tables.all()}
+
+    def create(name, *keys):
+        if name in existing:
+            return
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': k, 'KeyType': t} for k, t in zip(keys, ('HASH', 'RANGE'))],
+            AttributeDefinitions=[{'AttributeName': k, 'AttributeType': 'S'} for k in keys],
+            BillingMode='PAY_PER_REQUEST').wait_until_exists()
+
+    create('Cellular-Routing-Cells', 'cell_id')
+    create('Cellular-Routing-Users', 'username')
+    for cell_id, dns_name in cells.items():
+        create('Cell-' + cell_id, 'username', 'key')
+        dynamodb.Table('Cellular-Routing-Cells').put_item(Item={
+            'cell_id': cell_id,
+            'stackName': 'Cellular-Cell-' + cell_id,
+            'stackStatus': 'active',
+            'stage': 'prod',
+            'dnsName': dns_name,
+        })
@@ -1,26 +1,163 @@
+import json
+import os
+import time
 import requests
+import urllib3
+
+# Keys per /batch/* request, the cell's default maxBatchSize.
+BATCH_SIZE = 1000
+
+# Seconds a cached login (cell DNS name and token) is reused.
+LOGIN_CACHE_TTL = 300
+
+# Size of the chunks get_stream yields.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def stale_login(uri, r):
+    """True if the cell response means the cell address or token is out of
+    date: the token was rejected, or the user is no longer served there.
+    A 404 from /get for a missing key is a normal answer."""
+    if r.status_code == 401:
+        return True
+    return r.status_code == 404 and not (uri in ('/get', '/stream/get') and r.text == 'Item not found')
+
+
+# Routes of the cell and the router that can be sent again after a
+# connection error that may have happened once the request arrived: doing
+# them twice changes nothing (unless they are conditional writes).
+IDEMPOTENT = ('/get', '/put', '/delete', '/list', '/stream/get', '/stream/put', '/batch/get', '/validate',
+              '/login')
+
+
+def not_sent(e):
+    """True if a requests ConnectionError happened before the request was
+    sent: the connection could not be opened."""
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectTimeout) or \
+        isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def resendable(uri, headers, e):
+    """True if a request that failed with the ConnectionError e can be sent
+    again."""
+    conditional = headers and ('If-Match' in headers or 'If-None-Match' in headers)
+    return not_sent(e) or (uri in IDEMPOTENT and not conditional)
+
+
+def replayable(body):
+    """True if a request body can be sent again: not an iterator."""
+    return body is None or isinstance(body, (bytes, bytearray, str)) or hasattr(body, 'seek')
+
+
+class PreconditionFailed(Exception):
+    """A conditional write found another version of the item. value and
+    etag are those of the current item, None if there is none. If the
+    current value is in the cell's object store, offloaded is True and
+    value is None; read it with get_versioned."""
+
+    def __init__(self, key, value=None, etag=None, offloaded=False):
+        super().__init__('Item "{}" has another version'.format(key))
+        self.key = key
+        self.value = value
+        self.etag = etag
+        self.offloaded = offloaded
+
+
+class LoginCache:
+    """Keeps the result of /login per router and user in a JSON file so that
+    separate processes (e.g. clientctl invocations) can skip the router."""
+
+    def __init__(self, path, ttl=LOGIN_CACHE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+    def get(self, router, username):
+        entry = self._read().get(router + '|' + username)
+        if entry is None or entry['expires'] <= self.clock():
+            return None
+        return entry
+
+    def put(self, router, username, dns_name_cell, token=None, expires_in=None):
+        now = self.clock()
+        ttl = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        entries = {k: v for k, v in self._read().items() if v['expires'] > now}
+        entries[router + '|' + username] = {
+            'dnsNameCell': dns_name_cell, 'token': token, 'expires': now + ttl,
+        }
+        self._write(entries)
+
+    def remove(self, router, username):
+        entries = self._read()
+        if entries.pop(router + '|' + username, None) is not None:
+            self._write(entries)
 
 
 class Client:
-    def __init__(self, router, username):
+    def __init__(self, router, username, cache=None):
         self.router = router
         self.username = username
         self.dnsNameCell = None
+        self.token = None
+        # Optional LoginCache shared with other processes.
+        self.cache = cache
+        # Keep-alive connections to the router and the cell.
+        self.session = requests.Session()
 
     def request(self, uri, data=None):
         try:
-            r = requests.post('http://' + self.router + uri, json=data, timeout=5)
+            r = self.session.post('http://' + self.router + uri, json=data, timeout=5)
         except requests.exceptions.ConnectTimeout:
             print('Request timed out. Did you allow inbound traffic from your external IP? (See README.md)')
             exit(1)
         self.check_request_status(r)
         return r
 
-    def request_cell(self, uri, data=None):
+    def post_cell(self, uri, data, headers=None, body=None, **kwargs):
+        headers = dict(headers or {}, Authorization='Bearer ' + (self.token or self.username))
+        if body is not None:
+            kwargs['data'] = body
+        return self.session.post('http://' + self.dnsNameCell + uri, json=data, timeout=5, headers=headers,
+                                 **kwargs)
+
+    def stale_login(self, uri, r):
+        return stale_login(uri, r)
+
+    def request_cell(self, uri, data=None, headers=None, body=None, **kwargs):
+        """Posts data as JSON, or body as it is. body is only sent again
+        after a login if it is bytes or a file, which is rewound. kwargs are
+        passed to requests."""
         if not self.dnsNameCell:
             raise Exception('Not logged in.')
-        r = requests.post('http://' + self.dnsNameCell + uri, json=data, timeout=5,
-                          headers={'Authorization': 'Bearer ' + self.username})
+        start = body.tell() if hasattr(body, 'seek') else None
+        try:
+            r = self.post_cell(uri, data, headers, body, **kwargs)
+            retry = self.router is not None and self.stale_login(uri, r)
+        except requests.exceptions.ConnectionError as e:
+            if self.router is None or not replayable(body) or not resendable(uri, headers, e):
+                raise
+            retry = True
+        if retry and replayable(body):
+            # Cached or expired login: ask the router again, once.
+            self.login()
+            if start is not None:
+                body.seek(start)
+            r = self.post_cell(uri, data, headers, body, **kwargs)
         self.check_request_status(r)
         return r
 
@@ -36,11 +173,49 @@ class Client:
         })
         j = r.json()
         self.dnsNameCell = j['dns_name_cell']
+        # Only set when the router signs tokens (tokenKeyFile).
+        self.token = j.get('token')
+        if self.cache is not None:
+            self.cache.put(self.router, self.username, self.dnsNameCell, self.token,
+                           j.get('expires_in'))
 
-    def put(self, key, value):
-        self.request_cell('/put', data={'key': key, 'value': value})
+    def resume(self):
+        """Uses the cached login if there is one, otherwise logs in."""
+        entry = self.cache.get(self.router, self.username) if self.cache else None
+        if entry is None:
+            self.login()
+        else:
+            self.dnsNameCell = entry['dnsNameCell']
+            self.token = entry['token']
 
-    def get(self, key):
+    def write(self, uri, data, if_match=None, if_absent=False, key=None, **kwargs):
+        """Posts a write that only succeeds if the item has version if_match
+        (an ETag), or with if_absent if there is no item. Raises
+        PreconditionFailed otherwise."""
+        headers = dict(kwargs.pop('headers', {}))
+        if if_match:
+            headers['If-Match'] = if_match
+        if if_absent:
+            headers['If-None-Match'] = '*'
+        try:
+            return self.request_cell(uri, data, headers, **kwargs)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 412:
+                raise
+            etag = e.response.headers.get('ETag')
+            json_body = e.response.headers.get('Content-Type', '').startswith('application/json')
+            current = e.response.json() if json_body else {}
+            # The current value is only returned if it is small enough.
+            raise PreconditionFailed(key or data['key'], current.get('value'), etag,
+                                     offloaded=current.get('status') == 'offloaded')
+
+    def put(self, key, value, if_match=None, if_absent=False):
+        """Stores value. Returns the ETag of the new version."""
+        r = self.write('/put', {'key': key, 'value': value}, if_match, if_absent)
+        return r.headers.get('ETag')
+
+    def get_versioned(self, key):
+        """Returns the value and its ETag."""
         try:
           res = self.request_cell('/get', data={'key': key})
         except requests.exceptions.HTTPError as e:
@@ -50,10 +225,116 @@ class Client:
           else:
             raise e
 
-        return res.json()['value']
+        return res.json()['value'], res.headers.get('ETag')
+
+    def get(self, key):
+        return self.get_versioned(key)[0]
+
+    def put_stream(self, key, data, content_type='application/octet-stream', if_match=None, if_absent=False):
+        """Stores data, which can be bytes, a binary file or an iterable of
+        chunks, in the cell's object store without reading it into memory.
+        Returns the ETag of the new version."""
+        r = self.write('/stream/put', None, if_match, if_absent, key=key, params={'key': key}, body=data,
+                       headers={'Content-Type': content_type})
+        return r.headers.get('ETag')
+
+    def get_stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        """Returns an iterator over the value at key in chunks: the bytes
+        stored with put_stream, or the JSON encoding of a value stored with
+        put."""
+        try:
+            r = self.request_cell('/stream/get', params={'key': key}, stream=True)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                raise KeyError(key)
+            raise
+
+        def chunks():
+            with r:
+                yield from r.iter_content(chunk_size)
+        return chunks()
+
+    def delete(self, key, if_match=None):
+        self.write('/delete', {'key': key}, if_match)
+
+    def increment(self, key, by=1, if_match=None):
+        """Adds by to the number at key (0 if there is none), in one request
+        however many clients increment it at once. Returns the new number."""
+        return self.write('/increment', {'key': key, 'by': by}, if_match).json()['value']
+
+    def append(self, key, values, if_match=None):
+        """Appends values to the list at key. Returns the new list."""
+        return self.write('/append', {'key': key, 'values': list(values)}, if_match).json()['value']
+
+    def update(self, key, fn, attempts=10):
+        """Stores fn(value), where value is the current value at key (None
+        if there is none). If another client writes the key in between,
+        fn is applied again to the newer value. Returns the stored value."""
+        try:
+            value, etag = self.get_versioned(key)
+        except KeyError:
+            value, etag = None, None
+        for _ in range(attempts):
+            new = fn(value)
+            try:
+                self.put(key, new, if_match=etag, if_absent=etag is None)
+                return new
+            except PreconditionFailed as e:
+                value, etag = e.value, e.etag
+                if e.offloaded or (value is None and etag):
+                    # Not in the response; fn must not replace it unseen.
+                    try:
+                        value, etag = self.get_versioned(key)
+                    except KeyError:
+                        value, etag = None, None
+        raise Exception('Gave up updating "{}" after {} conflicts'.format(key, attempts))
+
+    def list(self, prefix='', page_size=100, keys_only=False):
+        """Yields (key, value) for the user's keys starting with prefix, in
+        key order, fetching one page at a time. With keys_only the value is
+        None."""
+        token = None
+        while True:
+            r = self.request_cell('/list', data={
+                'prefix': prefix, 'limit': page_size, 'keysOnly': keys_only, 'token': token,
+            }).json()
+            for item in r['items']:
+                yield item['key'], item.get('value')
+            token = r['token']
+            if not token:
+                return
+
+    def batch_request(self, uri, field, entries):
+        results = []
+        for i in range(0, len(entries), BATCH_SIZE):
+            r = self.request_cell(uri, data={field: entries[i:i + BATCH_SIZE]})
+            results.extend(r.json()['results'])
+        return results
+
+    def put_many(self, items):
+        """Stores a dict (or iterable of key/value pairs) in as few requests
+        as possible. Returns the keys that could not be written."""
+        items = [{'key': k, 'value': v} for k, v in dict(items).items()]
+        results = self.batch_request('/batch/put', 'items', items)
+        return [r['key'] for r in results if r['status'] != 'ok']
+
+    def get_many(self, keys):
+        """Returns a dict with the values of the keys that exist."""
+        results = self.batch_request('/batch/get', 'keys', list(dict.fromkeys(keys)))
+        failed = [r['key'] for r in results if r['status'] == 'failed']
+        if failed:
+            raise Exception('Could not read keys: {}'.format(', '.join(failed)))
+        values = {r['key']: r['value'] for r in results if r['status'] == 'ok'}
+        # Values too large to be read in a batch.
+        for r in results:
+            if r['status'] == 'offloaded':
+                values[r['key']] = self.get(r['key'])
+        return values
 
-    def delete(self, key):
-        self.request_cell('/delete', data={'key': key})
+    def delete_many(self, keys):
+        """Deletes keys. Returns the keys that could not be deleted."""
+        results = self.batch_request('/batch/delete', 'keys', list(dict.fromkeys(keys)))
+        return [r['key'] for r in results if r['status'] != 'ok']
 
     def validate(self):
         return self.request_cell('/validate')
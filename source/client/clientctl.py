@@ -1,6 +1,8 @@
+import json
 import os
 import sys
-from client_lib import Client
+import bench
+from client_lib import Client, LoginCache, LOGIN_CACHE_TTL
 import fire
 
 if not 'routerurl' in os.environ:
@@ -10,9 +12,15 @@ if not 'routerurl' in os.environ:
     sys.exit(1)
 routerurl = os.environ['routerurl']
 
+# Cell DNS names and tokens from earlier logins; set clientCacheTtl=0 to
+# log in on every command.
+cache = LoginCache(
+    os.environ.get('clientCache', os.path.join(os.path.expanduser('~'), '.cellular', 'login-cache.json')),
+    int(os.environ.get('clientCacheTtl', LOGIN_CACHE_TTL)))
+
 def login(username):
-    c = Client(routerurl, username)
-    c.login()
+    c = Client(routerurl, username, cache)
+    c.resume()
     return c
 
 class Exec:
@@ -28,10 +36,32 @@ class Exec:
         c = login(username)
         print(c.get(key))
 
+    def list(self, username, prefix=''):
+        c = login(username)
+        for key, value in c.list(prefix):
+            print('{}: {}'.format(key, value))
+
     def delete(self, username, key):
         c = login(username)
         c.delete(key)
 
+    def increment(self, username, key, by=1):
+        c = login(username)
+        print(c.increment(key, by))
+
+    def putfile(self, username, key, path, content_type='application/octet-stream'):
+        '''Uploads a file of any size as the value of key.'''
+        c = login(username)
+        with open(path, 'rb') as f:
+            c.put_stream(key, f, content_type)
+
+    def getfile(self, username, key, path):
+        '''Downloads the value of key to a file.'''
+        c = login(username)
+        with open(path, 'wb') as f:
+            for chunk in c.get_stream(key):
+                f.write(chunk)
+
     def getcell(self, username):
         c = login(username)
         print(c.validate().json()['cellid'])
@@ -44,8 +74,31 @@ class Main:
         c = Client(routerurl, username)
         c.register()
 
+    def bench(self, workload='kv', users=10, keys=1000, read_ratio=0.9, distribution='uniform',
+              zipf_s=1.1, value_size=100, preload=True, concurrency=16, rate=None, duration=10,
+              seed=None, output=None):
+        '''Runs a load test against the router and the cells and prints throughput and latency
+        percentiles per endpoint and per cell. workload is register, login or kv (get/put mix
+        with read_ratio reads, uniform or zipf keys). Without rate a closed loop of concurrency
+        workers is used; with rate, requests arrive at that rate per second (open loop).
+        output writes the full report as JSON.'''
+        report = bench.run(routerurl, workload=workload, users=users, keys=keys,
+                           read_ratio=read_ratio, distribution=distribution, zipf_s=zipf_s,
+                           value_size=value_size, preload=preload, concurrency=concurrency,
+                           rate=rate, duration=duration, seed=seed)
+        print(bench.format_report(report))
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def benchsetup(self, *cells):
+        '''Creates the tables in a local DynamoDB (AWS_ENDPOINT_URL_DYNAMODB) and registers
+        locally running cells, given as cell_id=host:port, so bench can run offline.'''
+        bench.setup_local(dict(c.split('=', 1) for c in cells))
+
     def exec(self):
-        '''Execute a command against the server. Each command first logs in to the router.
+        '''Execute a command against the server. Each command first logs in to the router,
+        unless the login is cached (clientCache, clientCacheTtl).
         Each command uses "username.apikey" from the current working directory.'''
         return Exec
 
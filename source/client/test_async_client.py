@@ -0,0 +1,110 @@
+import asyncio
+import json
+import unittest
+import httpx
+from async_client import AsyncClient
+
+
+class FakeCells:
+    """httpx transport handler: router at 'router', the user in self.cell.
+    fail holds (host, status) answers returned before the real one."""
+
+    def __init__(self):
+        self.cell = 'cell-a'
+        self.fail = []
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+
+    async def __call__(self, request):
+        host, uri = request.url.host, request.url.path
+        self.calls.append((host, uri))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if self.fail and self.fail[0][0] == host:
+            status = self.fail.pop(0)[1]
+            if status is None:
+                raise httpx.ConnectError('refused', request=request)
+            if isinstance(status, type):
+                raise status('failed', request=request)
+            return httpx.Response(status)
+        if host == 'router':
+            return httpx.Response(200, json={'dns_name_cell': self.cell, 'token': 'tok-' + self.cell})
+        if host != self.cell:
+            return httpx.Response(404, text='Not Found')
+        if request.headers['Authorization'] != 'Bearer tok-' + self.cell:
+            return httpx.Response(401, text='Unauthorized Access')
+        key = json.loads(request.content).get('key')
+        if uri == '/get':
+            if key == 'missing':
+                return httpx.Response(404, text='Item not found')
+            return httpx.Response(200, json={'value': 'v-' + key})
+        return httpx.Response(200, json={})
+
+
+class TestAsyncClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.cells = FakeCells()
+        self.client = AsyncClient('router', 'user1', concurrency=4, base_delay=0.001,
+                                  transport=httpx.MockTransport(self.cells))
+        await self.client.login()
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_get(self):
+        self.assertEqual(await self.client.get('k'), 'v-k')
+        with self.assertRaises(KeyError):
+            await self.client.get('missing')
+
+    async def test_concurrency_limit(self):
+        self.cells.delay = 0.01
+        await asyncio.gather(*[self.client.put(str(i), 'v') for i in range(20)])
+        self.assertEqual(self.cells.max_in_flight, 4)
+
+    async def test_retries_throttling_and_connection_errors(self):
+        self.cells.fail = [('cell-a', 503), ('cell-a', None), ('cell-a', 429)]
+        await self.client.put('k', 'v')
+        self.assertEqual(self.cells.calls[1:], [('cell-a', '/put')] * 4)
+
+    async def test_register_not_resent(self):
+        self.cells.fail = [('router', httpx.ReadTimeout)]
+        with self.assertRaises(httpx.ReadTimeout):
+            await self.client.register()
+        self.cells.fail = [('router', 500)]
+        with self.assertRaises(httpx.HTTPStatusError):
+            await self.client.register()
+        # Unless it was certainly not processed.
+        self.cells.fail = [('router', None), ('router', 503)]
+        await self.client.register()
+        self.assertEqual(self.cells.calls[1:], [('router', '/register')] * 5)
+
+        self.cells.fail = [('cell-a', httpx.ReadTimeout)]
+        await self.client.put('k', 'v')
+        self.assertEqual(self.cells.calls[-2:], [('cell-a', '/put')] * 2)
+
+    async def test_gives_up_after_retries(self):
+        self.cells.fail = [('cell-a', 503)] * 4
+        with self.assertRaises(httpx.HTTPStatusError):
+            await self.client.put('k', 'v')
+
+    async def test_deadline(self):
+        self.client.deadline = 0.05
+        self.cells.delay = 0.2
+        with self.assertRaises(TimeoutError):
+            await self.client.put('k', 'v')
+
+    async def test_concurrent_relogin_is_shared(self):
+        self.cells.cell = 'cell-b'
+        await asyncio.gather(*[self.client.put(str(i), 'v') for i in range(10)])
+        self.assertEqual(self.client.dnsNameCell, 'cell-b')
+        self.assertEqual(self.cells.calls.count(('router', '/login')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import random
+import unittest
+import httpx
+import bench
+from test_async_client import FakeCells
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles_within_precision(self):
+        h = bench.Histogram()
+        values = list(range(1, 100001))
+        random.Random(1).shuffle(values)
+        for us in values:
+            h.record(us / 1e6)
+        self.assertEqual(h.count, 100000)
+        for p in (50, 99, 99.9):
+            exact = p / 100 * 100000
+            self.assertLess(abs(h.percentile(p) - exact) / exact, 1 / 64)
+        self.assertEqual(h.percentile(100), 100000)
+
+    def test_small_values_exact(self):
+        h = bench.Histogram()
+        for us in (3, 5, 7, 100):
+            h.record(us / 1e6)
+        self.assertEqual(h.percentile(50), 5)
+        self.assertEqual(h.percentile(75), 7)
+
+    def test_merge(self):
+        a, b = bench.Histogram(), bench.Histogram()
+        a.record(0.001)
+        b.record(0.002)
+        a.merge(b)
+        self.assertEqual(a.count, 2)
+        self.assertEqual(a.max, 2000)
+
+
+class TestZipf(unittest.TestCase):
+    def test_skew(self):
+        z = bench.Zipf(1000, 1.1, random.Random(1))
+        draws = [z() for _ in range(10000)]
+        self.assertTrue(all(0 <= d < 1000 for d in draws))
+        self.assertGreater(draws.count(0), draws.count(999) * 50)
+
+
+class TestBench(unittest.TestCase):
+    def run_bench(self, **kwargs):
+        return bench.run('router', users=3, keys=50, duration=0.2, seed=1,
+                         transport=httpx.MockTransport(FakeCells()), **kwargs)
+
+    def test_closed_loop_kv(self):
+        report = self.run_bench(workload='kv', distribution='zipf')
+        self.assertEqual(set(report['endpoints']), {'/get', '/put'})
+        self.assertEqual(set(report['cells']), {'cell-a'})
+        self.assertEqual(report['errors'], {})
+        self.assertGreater(report['endpoints']['/get']['count'],
+                           report['endpoints']['/put']['count'])
+
+    def test_open_loop(self):
+        report = self.run_bench(workload='login', rate=200)
+        count = report['endpoints']['/login']['count']
+        self.assertTrue(10 < count < 100, count)
+        self.assertIn('/login', bench.format_report(report))
+
+    def test_register(self):
+        report = self.run_bench(workload='register', concurrency=2)
+        self.assertEqual(set(report['cells']), {'router'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import io
+import os
+import tempfile
+import unittest
+import requests
+import urllib3
+import client_lib
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, text='', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            e = requests.exceptions.HTTPError(str(self.status_code))
+            e.response = self
+            raise e
+
+
+class FakeSession:
+    """Router at 'router', cells at 'cell-a' and 'cell-b'. The user lives in
+    self.cell; anything else answers 404 like a drained or deleted cell."""
+
+    def __init__(self):
+        self.cell = 'cell-a'
+        self.down = set()
+        self.calls = []
+        self.bodies = []
+
+    def post(self, url, json=None, timeout=None, headers=None, data=None, params=None, stream=False):
+        host, uri = url[len('http://'):].split('/', 1)
+        self.calls.append((host, '/' + uri))
+        if data is not None:
+            self.bodies.append(data.read() if hasattr(data, 'read') else b''.join(data))
+        if host in self.down:
+            raise requests.exceptions.ConnectionError(host)
+        if host == 'router':
+            return FakeResponse(200, {'dns_name_cell': self.cell, 'token': 'tok-' + self.cell,
+                                      'expires_in': 60})
+        if host != self.cell:
+            return FakeResponse(404, text='Not Found')
+        if headers['Authorization'] != 'Bearer tok-' + self.cell:
+            return FakeResponse(401, text='Unauthorized Access')
+        if uri == 'get':
+            return FakeResponse(404, text='Item not found')
+        return FakeResponse(200, {})
+
+
+class TestCachedLogin(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.now = 1000.0
+        self.cache = client_lib.LoginCache(os.path.join(self.dir.name, 'c', 'cache.json'), 300,
+                                           clock=lambda: self.now)
+        self.session = FakeSession()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def client(self):
+        c = client_lib.Client('router', 'user1', self.cache)
+        c.session = self.session
+        return c
+
+    def test_resume_skips_router(self):
+        self.client().resume()
+        c = self.client()
+        c.resume()
+        self.assertEqual(c.dnsNameCell, 'cell-a')
+        self.assertEqual(c.token, 'tok-cell-a')
+        self.assertEqual([h for h, _ in self.session.calls], ['router'])
+
+    def test_ttl_capped_by_token_expiry(self):
+        self.client().resume()
+        self.now += 61
+        self.client().resume()
+        self.assertEqual([h for h, _ in self.session.calls], ['router', 'router'])
+
+    def test_relogin_when_cell_moved(self):
+        self.client().resume()
+        self.session.cell = 'cell-b'
+        c = self.client()
+        c.resume()
+        c.put('k', 'v')
+        self.assertEqual(self.session.calls[1:], [('cell-a', '/put'), ('router', '/login'),
+                                                  ('cell-b', '/put')])
+        self.assertEqual(self.cache.get('router', 'user1')['dnsNameCell'], 'cell-b')
+
+    def test_relogin_on_connection_error(self):
+        c = self.client()
+        c.resume()
+        self.session.down.add('cell-a')
+        self.session.cell = 'cell-b'
+        c.delete('k')
+        self.assertEqual(c.dnsNameCell, 'cell-b')
+
+    def test_no_resend_of_non_idempotent_routes(self):
+        c = self.client()
+        c.resume()
+        self.session.down.add('cell-a')
+        self.session.cell = 'cell-b'
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            c.increment('k')
+        self.assertEqual(self.session.calls[1:], [('cell-a', '/increment')])
+
+        # Unless the connection could not be opened.
+        refused = urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+        e = requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, '/', refused))
+        self.assertTrue(client_lib.resendable('/increment', {}, e))
+        self.assertFalse(client_lib.resendable('/put', {'If-Match': '"1"'}, requests.exceptions.ConnectionError()))
+        self.assertTrue(client_lib.resendable('/put', {}, requests.exceptions.ConnectionError()))
+
+    def test_missing_key_is_not_stale(self):
+        c = self.client()
+        c.resume()
+        with self.assertRaises(KeyError):
+            c.get('missing')
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_stream_resent_after_relogin(self):
+        self.client().resume()
+        self.session.cell = 'cell-b'
+        c = self.client()
+        c.resume()
+        c.put_stream('k', io.BytesIO(b'data'))
+        self.assertEqual(self.session.calls[1:], [('cell-a', '/stream/put'), ('router', '/login'),
+                                                  ('cell-b', '/stream/put')])
+        self.assertEqual(self.session.bodies, [b'data', b'data'])
+
+        # A generator can only be sent once.
+        self.session.cell = 'cell-a'
+        with self.assertRaises(requests.exceptions.HTTPError):
+            c.put_stream('k', (chunk for chunk in [b'da', b'ta']))
+        self.assertEqual(self.session.calls[-1], ('cell-b', '/stream/put'))
+
+    def test_no_retry_without_router(self):
+        c = client_lib.Client(None, 'user1')
+        c.session = self.session
+        c.dnsNameCell = 'cell-b'
+        with self.assertRaises(requests.exceptions.HTTPError):
+            c.put('k', 'v')
+        self.assertEqual(len(self.session.calls), 1)
+
+
+class VersionedSession:
+    """A cell with one item that another client writes before each of the
+    first `conflicts` conditional puts."""
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        self.value, self.version = None, 0
+        self.puts = 0
+
+    def etag(self):
+        return '"{}"'.format(self.version)
+
+    def post(self, url, json=None, timeout=None, headers=None):
+        if url.endswith('/get'):
+            if self.value is None:
+                return FakeResponse(404, text='Item not found')
+            return FakeResponse(200, {'value': self.value}, headers={'ETag': self.etag()})
+        self.puts += 1
+        if self.conflicts:
+            self.conflicts -= 1
+            self.value, self.version = (self.value or 0) + 100, self.version + 1
+        current = self.etag() if self.value is not None else None
+        if headers.get('If-Match', current) != current or (headers.get('If-None-Match') and current):
+            return FakeResponse(412, {'value': self.value}, headers={'ETag': current, 'Content-Type': 'application/json'})
+        self.value, self.version = json['value'], self.version + 1
+        return FakeResponse(200, text='Success', headers={'ETag': self.etag()})
+
+
+class OffloadedSession(VersionedSession):
+    """A cell whose item is in its object store: a 412 has no value."""
+
+    def post(self, url, json=None, timeout=None, headers=None):
+        r = super().post(url, json, timeout, headers)
+        if r.status_code == 412:
+            return FakeResponse(412, {'status': 'offloaded', 'size': 1 << 20},
+                                headers={'ETag': self.etag(), 'Content-Type': 'application/json'})
+        return r
+
+
+class TestUpdate(unittest.TestCase):
+    def client(self, session):
+        c = client_lib.Client(None, 'user1')
+        c.session = session
+        c.dnsNameCell = 'cell-a'
+        return c
+
+    def test_retries_with_current_value(self):
+        session = VersionedSession(conflicts=2)
+        self.assertEqual(self.client(session).update('k', lambda v: (v or 0) + 1), 201)
+        self.assertEqual((session.value, session.puts), (201, 3))
+
+    def test_gives_up(self):
+        session = VersionedSession(conflicts=5)
+        with self.assertRaises(Exception):
+            self.client(session).update('k', lambda v: (v or 0) + 1, attempts=3)
+        self.assertEqual(session.puts, 3)
+
+    def test_reads_offloaded_value(self):
+        session = OffloadedSession(conflicts=1)
+        session.value, session.version = 1, 1
+        self.assertEqual(self.client(session).update('k', lambda v: v + 1), 102)
+        self.assertEqual((session.value, session.puts), (102, 2))
+
+    def test_precondition_failed(self):
+        session = VersionedSession(conflicts=1)
+        with self.assertRaises(client_lib.PreconditionFailed) as e:
+            self.client(session).put('k', 1, if_absent=True)
+        self.assertEqual((e.exception.value, e.exception.etag), (100, '"1"'))
+
+
+if __name__ == '__main__':
+    unittest.main()
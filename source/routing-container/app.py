@@ -1,15 +1,46 @@
+import os
+import metrics
 import routing
+import tokens
 from flask import Flask, request, jsonify
 from flask_httpauth import HTTPTokenAuth
 
 app = Flask(__name__)
 auth = HTTPTokenAuth(scheme='Bearer')
 
+# Signing keys for the tokens issued at login (see tokens.py). Without
+# tokenKeyFile the token is the plain username.
+keyring = tokens.from_env()
+token_ttl = int(os.environ.get('tokenTtl', 3600))
+
 
 @auth.verify_token
 def verify_token(token):
-    # Token is the user name. For a production environment, replace this with an authorisation mechanism such as JWT
-    return token
+    if keyring is None:
+        # Token is the user name. Set tokenKeyFile to use signed tokens.
+        return token
+    payload = tokens.verify(keyring, token)
+    return payload['u'] if payload else None
+
+
+def login_result(username, cell_id, dns_name):
+    result = {'dns_name_cell': dns_name}
+    if keyring is not None:
+        result['token'] = tokens.issue(keyring, username, cell_id, token_ttl)
+        result['expires_in'] = token_ttl
+    return result
+
+
+def current_user():
+    try:
+        return auth.current_user()
+    except Exception:
+        return None
+
+
+# Latency per route, in-flight requests and sampled request logs
+# (logSampleRate, emfInterval).
+metrics.instrument_flask(app, metrics.from_env(routing.registry), current_user)
 
 
 @app.route('/')
@@ -17,6 +48,11 @@ def hello_world():
     return 'Hey, we have Flask in a Docker container!'
 
 
+@app.route('/health')
+def health():
+    return 'OK'
+
+
 @app.route('/cells')
 def cells():
     return jsonify(routing.get_cells())
@@ -41,11 +77,24 @@ def login():
     user = routing.get_user(r['username'])
     if user is None:
         return "Login failed", 401
+    cell_id = routing.get_user_cell(user)
+    return jsonify(login_result(user['username'], cell_id, routing.get_dns_name(cell_id)))
+
+
+@app.route('/stats')
+def stats():
     return jsonify({
-        'dns_name_cell': routing.get_dns_name(user['cell']),
+        'dnsCache': routing.dns_cache.stats(),
+        'cellIndex': routing.cell_index.stats(),
+        'userCache': routing.user_cache.stats(),
     })
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return routing.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route('/validate')
 @auth.login_required
 def validate():
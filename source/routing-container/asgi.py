@@ -0,0 +1,248 @@
+"""Async (ASGI) serving mode of the router.
+
+Serves the same routes with the same bearer-token auth as app.py. DynamoDB
+and CloudFormation calls are non-blocking (aioboto3) and share one
+connection pool per worker; at most maxConcurrency of them are in flight
+per worker. The cell snapshot used for placement is refreshed by a
+background task every cellIndexTtl seconds instead of on the request path.
+Caches, placement and hashing are the ones from routing.py.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+import os
+import json
+import asyncio
+import logging
+import contextlib
+import aioboto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+import metrics
+import routing
+import app as flask_app
+
+logger = logging.getLogger(__name__)
+max_concurrency = int(os.environ.get('maxConcurrency', 64))
+
+
+class AWS:
+    """aioboto3 resources of one worker. Attributes that are already set,
+    e.g. by tests or benchmarks, are not replaced on startup."""
+
+    def __init__(self):
+        self.cells_table = None
+        self.users_table = None
+        self.cloudformation = None
+        self.limit = None
+        self._stack = None
+
+    async def open(self):
+        self.limit = asyncio.Semaphore(max_concurrency)
+        if self.cells_table is not None:
+            return
+        self._stack = contextlib.AsyncExitStack()
+        session = aioboto3.Session()
+        config = Config(max_pool_connections=max_concurrency, tcp_keepalive=True)
+        dynamodb = await self._stack.enter_async_context(session.resource('dynamodb', config=config))
+        self.cloudformation = await self._stack.enter_async_context(
+            session.client('cloudformation', config=config))
+        self.cells_table = await dynamodb.Table(routing.cells_table.name)
+        self.users_table = await dynamodb.Table(routing.users_table.name)
+        metrics.instrument_client(dynamodb.meta.client, routing.registry)
+        metrics.instrument_client(self.cloudformation, routing.registry)
+
+    async def close(self):
+        if self._stack is not None:
+            await self._stack.aclose()
+            self._stack = None
+            self.cells_table = self.users_table = self.cloudformation = None
+
+    async def call(self, fn, **kwargs):
+        async with self.limit:
+            return await fn(**kwargs)
+
+
+aws = AWS()
+
+
+async def scan_all(table, **kwargs):
+    items = []
+    while True:
+        res = await aws.call(table.scan, **kwargs)
+        items.extend(res['Items'])
+        if 'LastEvaluatedKey' not in res:
+            return items
+        kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+
+async def refresh_cells():
+    routing.cell_index.update(await scan_all(aws.cells_table, **routing.CELL_INDEX_SCAN))
+
+
+async def refresh_loop(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_cells()
+        except Exception:
+            # Keep serving from the previous snapshot.
+            logger.exception('Refreshing the cell snapshot failed')
+
+
+async def get_user(username):
+    user = routing.user_cache.get(username)
+    if user is routing.NOT_FOUND:
+        return None
+    if user is not None:
+        return user
+    item = await aws.call(aws.users_table.get_item, Key={'username': username})
+    if 'Item' in item:
+        routing.user_cache.put(username, item['Item'])
+        return item['Item']
+    routing.user_cache.put(username, routing.NOT_FOUND, ttl=routing.user_cache_negative_ttl)
+    return None
+
+
+async def get_dns_name(cell_id):
+    cell = (await aws.call(aws.cells_table.get_item, Key={'cell_id': cell_id}))['Item']
+    if 'dnsName' in cell:
+        return cell['dnsName']
+    stackname = cell['stackName']
+    version = (stackname, cell.get('stackStatus'))
+    dns_name = routing.dns_cache.get(cell_id, version)
+    if dns_name is None:
+        response = await aws.call(aws.cloudformation.describe_stacks, StackName=stackname)
+        dns_name = routing.find_output(response, stackname, 'dnsName')
+        routing.dns_cache.put(cell_id, dns_name, version)
+        try:
+            await aws.call(aws.cells_table.update_item,
+                           **routing.store_dns_name_update(cell_id, stackname, dns_name))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    return dns_name
+
+
+async def create_user(username):
+    item, cell_id = routing.new_user(username)
+    await aws.call(aws.users_table.put_item, Item=item)
+    routing.user_cache.invalidate(username)
+    try:
+        await aws.call(aws.cells_table.update_item, **routing.count_user_update(cell_id))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def login_required(f):
+    """Same semantics as HTTPTokenAuth(scheme='Bearer').login_required."""
+    async def wrapper(request):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = flask_app.verify_token(token.strip() if scheme.lower() == 'bearer' else '')
+        if not user:
+            return PlainTextResponse('Unauthorized Access', 401,
+                                     headers={'WWW-Authenticate': 'Bearer realm="Authentication Required"'})
+        request.state.user = user
+        return await f(request)
+    return wrapper
+
+
+async def body(request):
+    """As request.get_json() in app.py: 415 unless the Content-Type is JSON,
+    400 if the body is missing or not valid JSON."""
+    media_type = request.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if media_type != 'application/json' and not media_type.endswith('+json'):
+        raise HTTPException(415, 'Content-Type must be application/json')
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(400, 'Invalid JSON body')
+
+
+async def hello_world(request):
+    return PlainTextResponse('Hey, we have Flask in a Docker container!')
+
+
+async def health(request):
+    return PlainTextResponse('OK')
+
+
+async def cells(request):
+    return JSONResponse(routing.get_cells())
+
+
+async def register(request):
+    username = (await body(request))['username']
+    if await get_user(username) is not None:
+        return PlainTextResponse('User already exists', 409)
+    await create_user(username)
+    return JSONResponse({
+        'status': 'Sucess',
+        'username': username
+    })
+
+
+async def login(request):
+    user = await get_user((await body(request))['username'])
+    if user is None:
+        return PlainTextResponse('Login failed', 401)
+    cell_id = routing.get_user_cell(user)
+    return JSONResponse(flask_app.login_result(user['username'], cell_id, await get_dns_name(cell_id)))
+
+
+async def stats(request):
+    return JSONResponse({
+        'dnsCache': routing.dns_cache.stats(),
+        'cellIndex': routing.cell_index.stats(),
+        'userCache': routing.user_cache.stats(),
+    })
+
+
+@login_required
+async def validate(request):
+    return JSONResponse({
+        'username': request.state.user
+    })
+
+
+async def metrics_endpoint(request):
+    return Response(routing.registry.render(), media_type='text/plain; version=0.0.4')
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await aws.open()
+    interval = routing.cell_index.ttl
+    # Only the background task refreshes the snapshot in this mode.
+    routing.cell_index.ttl = float('inf')
+    await refresh_cells()
+    task = asyncio.create_task(refresh_loop(interval))
+    try:
+        yield
+    finally:
+        task.cancel()
+        routing.cell_index.ttl = interval
+        await aws.close()
+
+
+routes = [
+    Route('/', hello_world),
+    Route('/health', health),
+    Route('/cells', cells),
+    Route('/register', register, methods=['POST']),
+    Route('/login', login, methods=['POST']),
+    Route('/stats', stats),
+    Route('/metrics', metrics_endpoint),
+    Route('/validate', validate),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[
+    Middleware(metrics.AsgiMetrics, timer=metrics.from_env(routing.registry),
+               paths=[r.path for r in routes],
+               current_user=lambda scope: scope.get('state', {}).get('user')),
+])
@@ -0,0 +1,51 @@
+"""Microbenchmarks for hashring lookups and a migration summary.
+
+Usage: python3 bench_hashring.py --cells 100 --vnodes 100 --users 100000
+"""
+import argparse
+import time
+import hashring
+
+
+def timed(fn, keys):
+    start = time.perf_counter()
+    for k in keys:
+        fn(k)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', type=int, default=100)
+    parser.add_argument('--vnodes', type=int, default=100, help='points per cell')
+    parser.add_argument('--users', type=int, default=100000)
+    args = parser.parse_args()
+
+    cells = ['cell{}'.format(i) for i in range(args.cells)]
+    users = ['user{}'.format(i) for i in range(args.users)]
+
+    start = time.perf_counter()
+    ring = hashring.HashRing(cells, args.vnodes)
+    build = time.perf_counter() - start
+    print('{} cells x {} vnodes = {} points, built in {:.1f} ms'.format(
+        args.cells, args.vnodes, len(ring), build * 1e3))
+
+    print('key_hash:        {:6.2f} us/op'.format(timed(hashring.key_hash, users)))
+    print('lookup:          {:6.2f} us/op'.format(timed(ring.lookup, users)))
+    loads = {}
+
+    def place(u):
+        cell = ring.lookup_bounded(u, loads)
+        loads[cell] = loads.get(cell, 0) + 1
+    print('lookup_bounded:  {:6.2f} us/op (max/mean load {:.3f})'.format(
+        timed(place, users), max(loads.values()) * args.cells / args.users))
+
+    added = hashring.HashRing(cells + ['new-cell'], args.vnodes)
+    removed = hashring.HashRing(cells[1:], args.vnodes)
+    for label, other in (('adding a cell', added), ('removing a cell', removed)):
+        moves = hashring.migration_report(users, ring, other)
+        print('{:<16} moves {:6.2%} of users'.format(label + ':', len(moves) / len(users)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Deterministic simulation of how evenly each placement strategy spreads
+users across cells.
+
+Each simulated router places users from its own view of the cells: the
+counts read at the last snapshot refresh plus the users it placed itself
+since then, mirroring routing.CellIndex. Load is users per unit of weight.
+
+Usage: python3 bench_placement.py --cells 10 --users 100000 --routers 4
+"""
+import argparse
+import random
+import statistics
+import placement
+
+
+def make_cells(n, rng, heterogeneous=True):
+    cells = []
+    for i in range(n):
+        cells.append({
+            'cell_id': 'cell{}'.format(i),
+            'weight': rng.choice([1, 1, 2, 4]) if heterogeneous else 1,
+            'userCount': 0,
+        })
+    return cells
+
+
+def simulate(strategy, cells, users, routers=1, refresh_every=100, seed=0):
+    rng = random.Random(seed)
+    counts = {c['cell_id']: 0 for c in cells}
+
+    def snapshot():
+        return [dict(c, userCount=counts[c['cell_id']]) for c in cells]
+
+    views = [snapshot() for _ in range(routers)]
+    for i in range(users):
+        if i % refresh_every == 0:
+            views = [snapshot() for _ in range(routers)]
+        view = views[i % routers]
+        cell = placement.place(view, strategy, rng)
+        cell['userCount'] += 1
+        counts[cell['cell_id']] += 1
+    return counts
+
+
+def spread(cells, counts):
+    loads = [counts[c['cell_id']] / placement.weight(c) for c in placement.eligible(cells)]
+    mean = statistics.mean(loads)
+    return {
+        'max/mean': max(loads) / mean,
+        'min/mean': min(loads) / mean,
+        'cv': statistics.pstdev(loads) / mean,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', type=int, default=10)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--routers', type=int, default=4)
+    parser.add_argument('--refresh-every', type=int, default=1000,
+                        help='placements between snapshot refreshes')
+    parser.add_argument('--uniform', action='store_true', help='give all cells weight 1')
+    parser.add_argument('--drain', type=int, default=1, help='number of drained cells')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cells = make_cells(args.cells, rng, heterogeneous=not args.uniform)
+    for c in cells[:args.drain]:
+        c['drain'] = True
+
+    print('{} cells ({} drained), {} users, {} routers, refresh every {} placements'.format(
+        args.cells, args.drain, args.users, args.routers, args.refresh_every))
+    print('{:<12} {:>9} {:>9} {:>7}  {}'.format('strategy', 'max/mean', 'min/mean', 'cv', 'drained users'))
+    for name, strategy in placement.STRATEGIES.items():
+        counts = simulate(strategy, cells, args.users, args.routers, args.refresh_every, args.seed)
+        s = spread(cells, counts)
+        drained = sum(counts[c['cell_id']] for c in cells if c.get('drain'))
+        print('{:<12} {:>9.3f} {:>9.3f} {:>7.3f}  {}'.format(
+            name, s['max/mean'], s['min/mean'], s['cv'], drained))
+
+
+if __name__ == '__main__':
+    main()
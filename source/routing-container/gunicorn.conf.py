@@ -0,0 +1,46 @@
+# gunicorn settings for serving the router behind the ALB:
+#   gunicorn --config gunicorn.conf.py app:app
+# Worker and thread counts can be overridden with the environment variables
+# "workers" and "threads". By default there are two workers per CPU of the
+# task, and at least two.
+import os
+import math
+
+
+def task_cpus():
+    """CPUs the container may use: its cgroup CPU quota if it has one, else
+    the CPUs it may run on. multiprocessing.cpu_count() counts the CPUs of
+    the host, e.g. 2 on a Fargate task of 0.5 vCPU."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:  # cgroup v2
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f, \
+                    open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as g:
+                quota, period = f.read().strip(), g.read().strip()
+        except OSError:
+            quota, period = 'max', None
+    if quota not in ('max', '-1'):
+        return int(quota) / int(period)
+    return len(os.sched_getaffinity(0))
+
+
+bind = '0.0.0.0:8080'
+worker_class = 'gthread'
+workers = int(os.environ.get('workers', max(2, math.ceil(task_cpus() * 2))))
+threads = int(os.environ.get('threads', 8))
+# Longer than the ALB idle timeout (60s), so the ALB closes idle connections.
+keepalive = 75
+timeout = 30
+graceful_timeout = 10
+preload_app = True
+accesslog = None
+
+# One pooled connection to AWS per thread.
+os.environ.setdefault('maxPoolConnections', str(threads))
+
+
+def post_fork(server, worker):
+    import routing
+    routing.post_fork()
@@ -0,0 +1,95 @@
+"""Consistent-hash ring mapping usernames to cells.
+
+Every cell gets `vnodes` points on a 64-bit ring and a username maps to the
+cell owning the first point at or after the username's hash. Adding or
+removing a cell only moves the users whose next point belonged to that
+cell. Weights are deliberately not used for the number of points so that
+changing a cell's weight never moves existing users; capacity is applied
+by lookup_bounded when a new user is placed instead.
+"""
+import bisect
+import hashlib
+import math
+
+# Points per cell, unless the router's hashVnodes says otherwise.
+DEFAULT_VNODES = 100
+
+
+def key_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, cell_ids, vnodes=DEFAULT_VNODES):
+        self.cell_ids = sorted(set(cell_ids))
+        self.vnodes = vnodes
+        points = sorted((key_hash('{}#{}'.format(c, i)), c)
+                        for c in self.cell_ids for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._cells = [c for _, c in points]
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def lookup(self, key):
+        if not self._hashes:
+            raise Exception('No cells on the hash ring')
+        i = bisect.bisect_left(self._hashes, key_hash(key))
+        return self._cells[i % len(self._cells)]
+
+    def walk(self, key):
+        """Yields the distinct cells in ring order starting at key."""
+        seen = set()
+        start = bisect.bisect_left(self._hashes, key_hash(key))
+        for j in range(len(self._cells)):
+            cell = self._cells[(start + j) % len(self._cells)]
+            if cell not in seen:
+                seen.add(cell)
+                yield cell
+                if len(seen) == len(self.cell_ids):
+                    return
+
+    def lookup_bounded(self, key, loads, weights=None, accepting=None, balance=1.25):
+        """Consistent hashing with bounded loads: returns the first cell in
+        ring order that accepts new users and whose load stays below
+        `balance` times its fair share once this user is added.
+
+        loads: cell_id -> current number of users
+        weights: cell_id -> relative capacity (default 1 for each cell)
+        accepting: cell_ids that may receive new users (default all)
+        """
+        accepting = set(self.cell_ids if accepting is None else accepting) & set(self.cell_ids)
+        if not accepting:
+            raise Exception('No cell available for new users')
+        weights = weights or {}
+        total_weight = sum(weights.get(c, 1) for c in accepting)
+        total = sum(loads.get(c, 0) for c in accepting) + 1
+        for cell in self.walk(key):
+            if cell not in accepting:
+                continue
+            share = weights.get(cell, 1) / total_weight
+            if loads.get(cell, 0) + 1 <= math.ceil(balance * total * share):
+                return cell
+        # Only reachable with balance <= 1; fall back to the least loaded cell.
+        return min(accepting, key=lambda c: loads.get(c, 0) / weights.get(c, 1))
+
+
+def ring_members(cells):
+    """Cells (items of the cells table) on the ring: prod cells with the
+    ring flag. A cell is only flagged once the users that map to it have
+    been copied there (`cellularctl cell join`), and stays on the ring
+    while it is updated or drained so its users don't move."""
+    return [c['cell_id'] for c in cells
+            if c.get('ring') and c.get('stage') == 'prod'
+            and c.get('stackStatus') not in ('creating', 'create_failed')]
+
+
+def migration_report(usernames, old_ring, new_ring):
+    """Returns (username, old cell, new cell) for every user that maps to a
+    different cell on new_ring."""
+    moves = []
+    for username in usernames:
+        old, new = old_ring.lookup(username), new_ring.lookup(username)
+        if old != new:
+            moves.append((username, old, new))
+    return moves
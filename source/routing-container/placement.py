@@ -0,0 +1,74 @@
+"""Placement strategies for assigning new users to cells.
+
+A strategy is a function taking the list of candidate cells (items of the
+cells table) and a random.Random instance, and returning the chosen cell.
+Cells carry optional placement attributes:
+
+- weight: relative capacity of the cell (default 1). A weight of 0 stops
+  new placements, like drain.
+- drain: if true, the cell receives no new users.
+- userCount: number of users assigned to the cell, maintained by the router.
+"""
+import random
+
+
+def weight(cell):
+    return float(cell.get('weight', 1))
+
+
+def users(cell):
+    return int(cell.get('userCount', 0))
+
+
+def load(cell):
+    return users(cell) / weight(cell)
+
+
+def eligible(cells):
+    """Returns the cells that can take new users."""
+    return [c for c in cells if not c.get('drain', False) and weight(c) > 0]
+
+
+def uniform_random(cells, rng=random):
+    return rng.choice(cells)
+
+
+def weighted(cells, rng=random):
+    return rng.choices(cells, weights=[weight(c) for c in cells])[0]
+
+
+def least_users(cells, rng=random):
+    lowest = min(load(c) for c in cells)
+    return rng.choice([c for c in cells if load(c) == lowest])
+
+
+def two_choices(cells, rng=random):
+    if len(cells) < 2:
+        return cells[0]
+    a, b = rng.sample(cells, 2)
+    if load(a) == load(b):
+        return rng.choice([a, b])
+    return a if load(a) < load(b) else b
+
+
+STRATEGIES = {
+    'random': uniform_random,
+    'weighted': weighted,
+    'least-users': least_users,
+    'two-choices': two_choices,
+}
+
+
+def get_strategy(name):
+    if name not in STRATEGIES:
+        raise ValueError('Unknown placement strategy "{}". Use one of: {}'.format(
+            name, ', '.join(STRATEGIES)))
+    return STRATEGIES[name]
+
+
+def place(cells, strategy, rng=random):
+    """Chooses a cell for a new user, skipping drained cells."""
+    candidates = eligible(cells)
+    if not candidates:
+        raise Exception('No cell available for new users')
+    return strategy(candidates, rng)
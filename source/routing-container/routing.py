@@ -1,17 +1,257 @@
 import os
+import sys
+import time
+import threading
+from collections import OrderedDict
 import boto3
-import random
+from botocore.config import Config
 from boto3.dynamodb.conditions import Attr
 import secrets
+import placement
+import hashring
+import metrics
 
-dynamodb = boto3.resource('dynamodb')
-cloudformation = boto3.client('cloudformation')
-cells_table = dynamodb.Table(os.environ.get('cellsTableName'))
-users_table = dynamodb.Table(os.environ.get('usersTableName'))
+# Size of the HTTP connection pool to AWS. gunicorn.conf.py sets it to the
+# number of threads per worker.
+max_pool_connections = int(os.environ.get('maxPoolConnections', 10))
+
+
+# Request and AWS call metrics of this process, served on /metrics.
+registry = metrics.Registry()
+
+
+def init_clients(session=None):
+    """Creates the boto3 clients of this process, from session if given
+    (e.g. one served by the stand-in in source/standin)."""
+    global dynamodb, cloudformation, cells_table, users_table
+    config = Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+    session = session or boto3.session.Session()
+    dynamodb = session.resource('dynamodb', config=config)
+    cloudformation = session.client('cloudformation', config=config)
+    cells_table = dynamodb.Table(os.environ.get('cellsTableName'))
+    users_table = dynamodb.Table(os.environ.get('usersTableName'))
+    metrics.instrument_client(dynamodb.meta.client, registry)
+    metrics.instrument_client(cloudformation, registry)
+    if 'cell_index' in globals():
+        cell_index.table = cells_table
+
+
+init_clients()
+
+
+def approx_size(obj):
+    """Approximate memory footprint of a cached key or item in bytes."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(approx_size(v) for v in obj)
+    return size
+
+
+class TTLCache:
+    """Bounded, thread-safe in-process cache with a per-entry TTL and LRU
+    eviction. Entries can carry a version; a lookup with a different version
+    drops the entry and counts as a miss. With maxbytes set, entries are also
+    evicted once their approximate footprint exceeds it."""
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, entry_version, expires, _ = entry
+            if expires <= self.clock() or entry_version != version:
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version=None, ttl=None):
+        size = approx_size(key) + approx_size(value) if self.maxbytes else 0
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, version, self.clock() + (self.ttl if ttl is None else ttl), size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._remove(key):
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[3]
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+# cell_id -> dnsName, versioned by the cell's (stackName, stackStatus) so a
+# recreated or updated stack is resolved again.
+dns_cache = TTLCache(
+    maxsize=int(os.environ.get('dnsCacheSize', 1024)),
+    ttl=float(os.environ.get('dnsCacheTtl', 300)))
+
+# username -> user item. Unknown users are cached as NOT_FOUND for a shorter
+# time, since they may register through another router task meanwhile.
+NOT_FOUND = object()
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('userCacheSize', 100000)),
+    maxbytes=int(os.environ.get('userCacheBytes', 64 * 1024 * 1024)),
+    ttl=float(os.environ.get('userCacheTtl', 30)))
+user_cache_negative_ttl = float(os.environ.get('userCacheNegativeTtl', 5))
+
+
+def scan_all(table, **kwargs):
+    """Yields all items of a scan, following LastEvaluatedKey."""
+    while True:
+        res = table.scan(**kwargs)
+        yield from res['Items']
+        if 'LastEvaluatedKey' not in res:
+            return
+        kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+
+CELL_INDEX_SCAN = {
+    'ProjectionExpression': '#id, #status, #stage, #weight, #drain, #users, #ring',
+    'ExpressionAttributeNames': {
+        '#id': 'cell_id', '#status': 'stackStatus', '#stage': 'stage',
+        '#weight': 'weight', '#drain': 'drain', '#users': 'userCount', '#ring': 'ring',
+    },
+}
+
+
+class CellIndex:
+    """In-memory snapshot of the cells table. The table is re-read with a
+    paginated scan at most every `ttl` seconds, so placing a user costs no
+    read capacity in between. `version` is bumped whenever a refresh sees a
+    different set of cells or cell states."""
+
+    def __init__(self, table, ttl=30, clock=time.monotonic):
+        self.table = table
+        self.ttl = ttl
+        self.clock = clock
+        self.version = 0
+        self.refreshes = 0
+        self._cells = []
+        self._expires = None
+        self._lock = threading.Lock()
+
+    def cells(self):
+        if self._expires is None or self._expires <= self.clock():
+            with self._lock:
+                if self._expires is None or self._expires <= self.clock():
+                    self.refresh()
+        return self._cells
+
+    def active(self, stage=None):
+        return [c for c in self.cells()
+                if c.get('stackStatus') == 'active' and (stage is None or c.get('stage') == stage)]
+
+    def record_assignment(self, cell_id):
+        """Counts a new user locally until the next refresh reads the
+        persisted userCount, so load-aware placement doesn't herd users onto
+        the same cell in between."""
+        with self._lock:
+            for c in self._cells:
+                if c['cell_id'] == cell_id:
+                    c['userCount'] = placement.users(c) + 1
+
+    def refresh(self):
+        self.update(scan_all(self.table, **CELL_INDEX_SCAN))
+
+    def update(self, cells):
+        """Replaces the snapshot with the scanned cell items."""
+        cells = sorted(cells, key=lambda c: c['cell_id'])
+        if self._state(cells) != self._state(self._cells):
+            self.version += 1
+        self._cells = cells
+        self._expires = self.clock() + self.ttl
+        self.refreshes += 1
+
+    def invalidate(self):
+        self._expires = None
+
+    @staticmethod
+    def _state(cells):
+        return [(c['cell_id'], c.get('stackStatus'), c.get('stage'), c.get('weight'), c.get('drain'),
+                 c.get('ring')) for c in cells]
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'cells': len(self._cells),
+            'refreshes': self.refreshes,
+        }
+
+
+cell_index = CellIndex(cells_table, ttl=float(os.environ.get('cellIndexTtl', 30)))
+placement_strategy = placement.get_strategy(os.environ.get('placementStrategy', 'random'))
+
+# 'assign' pins every user to a cell in the users table. 'hash' maps users
+# to cells with a consistent-hash ring and only stores a cell for users
+# that bounded-load placement moved off their ring cell.
+routing_mode = os.environ.get('routingMode', 'assign')
+hash_vnodes = int(os.environ.get('hashVnodes', hashring.DEFAULT_VNODES))
+hash_balance = float(os.environ.get('hashBalance', 1.25))
+_ring = (None, None)
+
+
+def post_fork():
+    """Called in each gunicorn worker. Clients created before the fork must
+    not be shared between processes."""
+    init_clients()
 
 
 def get_cf_output(stackname, key):
-    response = cloudformation.describe_stacks(StackName=stackname)
+    return find_output(cloudformation.describe_stacks(StackName=stackname), stackname, key)
+
+
+def find_output(response, stackname, key):
     outputs = response["Stacks"][0]["Outputs"]
     for output in outputs:
         if output["OutputKey"] == key:
@@ -21,39 +261,121 @@ def get_cf_output(stackname, key):
 
 
 def get_cells():
-    res = cells_table.scan(
-        FilterExpression=Attr('stackStatus').eq('active'),
-        ProjectionExpression='cell_id'
-    )
-    return res['Items']
+    return [{'cell_id': c['cell_id']} for c in cell_index.active()]
 
 
 def assign_cell():
-    cells = cells_table.scan(
-        FilterExpression=Attr('stackStatus').eq(
-            'active') & Attr('stage').eq('prod'),
-        ProjectionExpression='cell_id'
-    )
-    return random.choice(cells['Items'])['cell_id']
+    cell = placement.place(cell_index.active(stage='prod'), placement_strategy)
+    cell_index.record_assignment(cell['cell_id'])
+    return cell['cell_id']
+
+
+def get_ring():
+    global _ring
+    cells = cell_index.cells()
+    version, ring = _ring
+    if version != cell_index.version or ring is None:
+        ring = hashring.HashRing(hashring.ring_members(cells), hash_vnodes)
+        _ring = (cell_index.version, ring)
+    return ring
+
+
+def hash_assign_cell(username):
+    cells = cell_index.active(stage='prod')
+    accepting = [c['cell_id'] for c in placement.eligible(cells)]
+    cell_id = get_ring().lookup_bounded(
+        username,
+        loads={c['cell_id']: placement.users(c) for c in cells},
+        weights={c['cell_id']: placement.weight(c) for c in cells},
+        accepting=accepting,
+        balance=hash_balance)
+    cell_index.record_assignment(cell_id)
+    return cell_id
+
+
+def get_user_cell(user):
+    if 'cell' in user:
+        return user['cell']
+    return get_ring().lookup(user['username'])
 
 
 def get_user(username):
+    user = user_cache.get(username)
+    if user is NOT_FOUND:
+        return None
+    if user is not None:
+        return user
     item = users_table.get_item(Key={'username': username})
     if 'Item' in item:
+        user_cache.put(username, item['Item'])
         return item['Item']
+    user_cache.put(username, NOT_FOUND, ttl=user_cache_negative_ttl)
     return None
 
 
 def get_dns_name(cell_id):
-    cell = cells_table.get_item(Key={'cell_id': cell_id})
-    stackname = cell['Item']['stackName']
-    return get_cf_output(stackname, 'dnsName')
+    """Returns the cell endpoint. The create and update state machines store
+    it on the cell item; CloudFormation is only asked for cells written
+    before that, and the result is stored back on the item."""
+    cell = cells_table.get_item(Key={'cell_id': cell_id})['Item']
+    if 'dnsName' in cell:
+        return cell['dnsName']
+    stackname = cell['stackName']
+    version = (stackname, cell.get('stackStatus'))
+    dns_name = dns_cache.get(cell_id, version)
+    if dns_name is None:
+        dns_name = get_cf_output(stackname, 'dnsName')
+        dns_cache.put(cell_id, dns_name, version)
+        store_dns_name(cell_id, stackname, dns_name)
+    return dns_name
+
+
+def store_dns_name_update(cell_id, stackname, dns_name):
+    return {
+        'Key': {'cell_id': cell_id},
+        'UpdateExpression': 'SET dnsName = :d',
+        'ConditionExpression': Attr('stackName').eq(stackname) & Attr('dnsName').not_exists(),
+        'ExpressionAttributeValues': {':d': dns_name},
+    }
+
+
+def store_dns_name(cell_id, stackname, dns_name):
+    try:
+        cells_table.update_item(**store_dns_name_update(cell_id, stackname, dns_name))
+    except cells_table.meta.client.exceptions.ConditionalCheckFailedException:
+        # The cell was changed or backfilled concurrently.
+        pass
+
+
+def new_user(username):
+    """Chooses the cell of a new user. Returns the users table item and the
+    cell id."""
+    item = {'username': username}
+    if routing_mode == 'hash':
+        cell_id = hash_assign_cell(username)
+        if cell_id != get_ring().lookup(username):
+            item['cell'] = cell_id
+    else:
+        cell_id = assign_cell()
+        item['cell'] = cell_id
+    return item, cell_id
+
+
+def count_user_update(cell_id):
+    # A cell deleted since the snapshot must not come back as a bare item.
+    return {
+        'Key': {'cell_id': cell_id},
+        'UpdateExpression': 'ADD userCount :one',
+        'ConditionExpression': 'attribute_exists(cell_id)',
+        'ExpressionAttributeValues': {':one': 1},
+    }
 
 
 def create_user(username):
-    users_table.put_item(
-        Item={
-            'username': username,
-            'cell': assign_cell()
-        }
-    )
\ No newline at end of file
+    item, cell_id = new_user(username)
+    users_table.put_item(Item=item)
+    user_cache.invalidate(username)
+    try:
+        cells_table.update_item(**count_user_update(cell_id))
+    except cells_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
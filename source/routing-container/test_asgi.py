@@ -0,0 +1,79 @@
+import os
+import unittest
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('cellsTableName', 'Cellular-Routing-Cells')
+os.environ.setdefault('usersTableName', 'Cellular-Routing-Users')
+
+from starlette.testclient import TestClient
+import routing
+import asgi
+
+
+class AsyncTable:
+    def __init__(self, key, items=()):
+        self.key = key
+        self.items = {i[key]: dict(i) for i in items}
+
+    async def get_item(self, Key):
+        item = self.items.get(Key[self.key])
+        return {'Item': item} if item else {}
+
+    async def put_item(self, Item):
+        self.items[Item[self.key]] = Item
+
+    async def update_item(self, Key, **kwargs):
+        item = self.items[Key[self.key]]
+        item['userCount'] = item.get('userCount', 0) + 1
+
+    async def scan(self, **kwargs):
+        return {'Items': [dict(i) for i in self.items.values()]}
+
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        routing.user_cache.clear()
+        asgi.aws.cells_table = AsyncTable('cell_id', [
+            {'cell_id': 'cell1', 'stackStatus': 'active', 'stage': 'prod', 'dnsName': 'cell1.elb'},
+        ])
+        asgi.aws.users_table = AsyncTable('username')
+        self.client = TestClient(asgi.app)
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        asgi.aws.cells_table = asgi.aws.users_table = None
+
+    def test_register_and_login(self):
+        self.assertEqual(self.client.post('/login', json={'username': 'user1'}).status_code, 401)
+        r = self.client.post('/register', json={'username': 'user1'})
+        self.assertEqual(r.json(), {'status': 'Sucess', 'username': 'user1'})
+        self.assertEqual(self.client.post('/register', json={'username': 'user1'}).status_code, 409)
+        r = self.client.post('/login', json={'username': 'user1'})
+        self.assertEqual(r.json(), {'dns_name_cell': 'cell1.elb'})
+        self.assertEqual(asgi.aws.cells_table.items['cell1']['userCount'], 1)
+
+    def test_bad_bodies(self):
+        self.assertEqual(self.client.post('/login', content=b'').status_code, 415)
+        for content in (b'', b'{"username"'):
+            r = self.client.post('/register', content=content, headers={'Content-Type': 'application/json'})
+            self.assertEqual(r.status_code, 400)
+        r = self.client.post('/login', content=b'username=user1',
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(r.status_code, 415)
+
+    def test_cells(self):
+        self.assertEqual(self.client.get('/cells').json(), [{'cell_id': 'cell1'}])
+
+    def test_health(self):
+        r = self.client.get('/health')
+        self.assertEqual((r.status_code, r.text), (200, 'OK'))
+
+    def test_validate(self):
+        self.assertEqual(self.client.get('/validate').status_code, 401)
+        r = self.client.get('/validate', headers={'Authorization': 'Bearer user1'})
+        self.assertEqual(r.json(), {'username': 'user1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import hashring
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.users = ['user{}'.format(i) for i in range(5000)]
+        self.ring = hashring.HashRing(['cell{}'.format(i) for i in range(10)])
+
+    def test_lookup_is_stable(self):
+        other = hashring.HashRing(reversed(self.ring.cell_ids))
+        for u in self.users[:100]:
+            self.assertEqual(self.ring.lookup(u), other.lookup(u))
+
+    def test_adding_cell_moves_only_to_new_cell(self):
+        bigger = hashring.HashRing(self.ring.cell_ids + ['cell10'])
+        moves = hashring.migration_report(self.users, self.ring, bigger)
+        self.assertTrue(all(new == 'cell10' for _, _, new in moves))
+        self.assertAlmostEqual(len(moves) / len(self.users), 1 / 11, delta=0.03)
+
+    def test_removing_cell_moves_only_its_users(self):
+        smaller = hashring.HashRing(self.ring.cell_ids[1:])
+        moves = hashring.migration_report(self.users, self.ring, smaller)
+        self.assertTrue(all(old == 'cell0' for _, old, _ in moves))
+
+    def test_bounded_load(self):
+        loads = {}
+        for u in self.users:
+            cell = self.ring.lookup_bounded(u, loads, balance=1.1)
+            loads[cell] = loads.get(cell, 0) + 1
+        self.assertLessEqual(max(loads.values()), 1.1 * len(self.users) / 10 + 1)
+
+    def test_bounded_skips_non_accepting(self):
+        walk = list(self.ring.walk('user1'))
+        self.assertEqual(len(walk), 10)
+        cell = self.ring.lookup_bounded('user1', {}, accepting=walk[1:])
+        self.assertEqual(cell, walk[1])
+
+    def test_ring_members(self):
+        cells = [{'cell_id': 'a', 'stage': 'prod', 'stackStatus': 'active', 'ring': True},
+                 {'cell_id': 'b', 'stage': 'prod', 'stackStatus': 'updating', 'ring': True, 'drain': True},
+                 {'cell_id': 'new', 'stage': 'prod', 'stackStatus': 'active'},
+                 {'cell_id': 'sandbox', 'stage': 'sandbox', 'stackStatus': 'active', 'ring': True}]
+        self.assertEqual(hashring.ring_members(cells), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import random
+import unittest
+import placement
+
+
+def cells(*specs):
+    return [dict(cell_id='cell{}'.format(i), **spec) for i, spec in enumerate(specs)]
+
+
+class TestPlacement(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def test_drained_cells_are_skipped(self):
+        candidates = cells({'drain': True}, {}, {'weight': 0})
+        for name, strategy in placement.STRATEGIES.items():
+            for _ in range(20):
+                self.assertEqual(placement.place(candidates, strategy, self.rng)['cell_id'], 'cell1', name)
+
+    def test_no_cell_available(self):
+        with self.assertRaises(Exception):
+            placement.place(cells({'drain': True}), placement.uniform_random, self.rng)
+
+    def test_least_users_is_capacity_aware(self):
+        candidates = cells({'userCount': 10}, {'userCount': 15, 'weight': 2})
+        self.assertEqual(placement.least_users(candidates, self.rng)['cell_id'], 'cell1')
+
+    def test_two_choices_prefers_less_loaded(self):
+        candidates = cells({'userCount': 10}, {'userCount': 0})
+        for _ in range(20):
+            self.assertEqual(placement.two_choices(candidates, self.rng)['cell_id'], 'cell1')
+
+    def test_weighted_follows_weights(self):
+        candidates = cells({'weight': 1}, {'weight': 3})
+        picks = [placement.weighted(candidates, self.rng)['cell_id'] for _ in range(4000)]
+        self.assertAlmostEqual(picks.count('cell1') / len(picks), 0.75, delta=0.03)
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            placement.get_strategy('round-robin')
+
+
+if __name__ == '__main__':
+    unittest.main()
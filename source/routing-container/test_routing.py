@@ -0,0 +1,385 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('cellsTableName', 'Cellular-Routing-Cells')
+os.environ.setdefault('usersTableName', 'Cellular-Routing-Users')
+
+from botocore.stub import Stubber, ANY
+import routing
+import app
+
+sys.path.append(str(Path(__file__).parent.parent / 'standin'))
+import standin
+
+
+def cell_item(cell_id, stack_status='active', stack_name=None, dns_name=None):
+    item = {
+        'cell_id': {'S': cell_id},
+        'stackName': {'S': stack_name or 'Cellular-Cell-' + cell_id},
+        'stackStatus': {'S': stack_status},
+    }
+    if dns_name:
+        item['dnsName'] = {'S': dns_name}
+    return {'Item': item}
+
+
+def stack(stack_name, dns_name):
+    return {'Stacks': [{
+        'StackName': stack_name,
+        'CreationTime': '2024-01-01T00:00:00Z',
+        'StackStatus': 'CREATE_COMPLETE',
+        'Outputs': [{'OutputKey': 'dnsName', 'OutputValue': dns_name}],
+    }]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = routing.TTLCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expiry(self):
+        self.cache.put('a', 1)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_maxbytes_eviction(self):
+        cache = routing.TTLCache(maxsize=100, ttl=10, clock=self.clock, maxbytes=1000)
+        for i in range(20):
+            cache.put('user{}'.format(i), {'username': 'user{}'.format(i), 'cell': 'cell1'})
+        self.assertLessEqual(cache.stats()['bytes'], 1000)
+        self.assertGreater(cache.stats()['evictions'], 0)
+        self.assertIsNotNone(cache.get('user19'))
+        cache.clear()
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_version_mismatch(self):
+        self.cache.put('a', 1, version='v1')
+        self.assertIsNone(self.cache.get('a', version='v2'))
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+
+class TestCellIndex(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.index = routing.CellIndex(routing.cells_table, ttl=30, clock=self.clock)
+        self.ddb = Stubber(routing.dynamodb.meta.client)
+        self.ddb.activate()
+
+    def tearDown(self):
+        self.ddb.assert_no_pending_responses()
+        self.ddb.deactivate()
+
+    def expect_scan(self, pages):
+        for i, page in enumerate(pages):
+            res = {'Items': [{'cell_id': {'S': c}, 'stackStatus': {'S': status}, 'stage': {'S': stage}}
+                             for c, status, stage in page]}
+            if i < len(pages) - 1:
+                res['LastEvaluatedKey'] = {'cell_id': {'S': page[-1][0]}}
+            expected = {'TableName': 'Cellular-Routing-Cells',
+                        'ProjectionExpression': ANY, 'ExpressionAttributeNames': ANY}
+            if i > 0:
+                expected['ExclusiveStartKey'] = {'cell_id': pages[i - 1][-1][0]}
+            self.ddb.add_response('scan', res, expected)
+
+    def test_follows_pagination(self):
+        self.expect_scan([
+            [('cell1', 'active', 'prod'), ('sandbox', 'active', 'sandbox')],
+            [('cell2', 'active', 'prod'), ('cell3', 'creating', 'prod')],
+        ])
+        self.assertEqual([c['cell_id'] for c in self.index.active(stage='prod')], ['cell1', 'cell2'])
+        self.assertEqual(len(self.index.active()), 3)
+
+    def test_snapshot_reused_until_ttl(self):
+        self.expect_scan([[('cell1', 'active', 'prod')]])
+        self.index.active()
+        self.index.active()
+        self.assertEqual(self.index.stats()['refreshes'], 1)
+        self.expect_scan([[('cell1', 'active', 'prod')]])
+        self.clock.now = 30
+        self.index.active()
+        self.assertEqual(self.index.stats(), {'version': 1, 'cells': 1, 'refreshes': 2})
+
+    def test_version_bumped_on_change(self):
+        self.expect_scan([[('cell1', 'active', 'prod')]])
+        self.expect_scan([[('cell1', 'updating', 'prod')]])
+        self.index.active()
+        self.index.invalidate()
+        self.assertEqual(self.index.active(), [])
+        self.assertEqual(self.index.version, 2)
+
+
+class TestGetUser(unittest.TestCase):
+    def setUp(self):
+        self.user_cache = routing.user_cache
+        routing.user_cache = routing.TTLCache(ttl=30)
+        routing.cell_index.invalidate()
+        self.ddb = Stubber(routing.dynamodb.meta.client)
+        self.ddb.activate()
+
+    def tearDown(self):
+        routing.user_cache = self.user_cache
+        self.ddb.assert_no_pending_responses()
+        self.ddb.deactivate()
+
+    def expect_get(self, username, cell=None):
+        res = {'Item': {'username': {'S': username}, 'cell': {'S': cell}}} if cell else {}
+        self.ddb.add_response('get_item', res, {
+            'TableName': 'Cellular-Routing-Users', 'Key': {'username': username}})
+
+    def test_cached(self):
+        self.expect_get('user1', 'cell1')
+        self.assertEqual(routing.get_user('user1')['cell'], 'cell1')
+        self.assertEqual(routing.get_user('user1')['cell'], 'cell1')
+
+    def test_negative_cached_until_created(self):
+        self.expect_get('user1')
+        self.assertIsNone(routing.get_user('user1'))
+        self.assertIsNone(routing.get_user('user1'))
+        self.ddb.add_response('scan', {'Items': [
+            {'cell_id': {'S': 'cell1'}, 'stackStatus': {'S': 'active'}, 'stage': {'S': 'prod'}}]})
+        self.ddb.add_response('put_item', {})
+        self.ddb.add_response('update_item', {})
+        routing.create_user('user1')
+        self.expect_get('user1', 'cell1')
+        self.assertEqual(routing.get_user('user1')['cell'], 'cell1')
+        self.assertAlmostEqual(routing.user_cache.stats()['hitRate'], 1 / 3)
+
+
+class TestCreateUser(unittest.TestCase):
+    def setUp(self):
+        routing.cell_index.invalidate()
+        self.ddb = Stubber(routing.dynamodb.meta.client)
+        self.ddb.activate()
+
+    def tearDown(self):
+        self.ddb.assert_no_pending_responses()
+        self.ddb.deactivate()
+
+    def test_counts_user_on_cell(self):
+        self.ddb.add_response('scan', {'Items': [
+            {'cell_id': {'S': 'cell1'}, 'stackStatus': {'S': 'active'}, 'stage': {'S': 'prod'},
+             'drain': {'BOOL': True}},
+            {'cell_id': {'S': 'cell2'}, 'stackStatus': {'S': 'active'}, 'stage': {'S': 'prod'},
+             'userCount': {'N': '4'}},
+        ]})
+        self.ddb.add_response('put_item', {}, {
+            'TableName': 'Cellular-Routing-Users', 'Item': {'username': 'user1', 'cell': 'cell2'}})
+        self.ddb.add_response('update_item', {}, {
+            'TableName': 'Cellular-Routing-Cells', 'Key': {'cell_id': 'cell2'},
+            'UpdateExpression': 'ADD userCount :one', 'ConditionExpression': 'attribute_exists(cell_id)',
+            'ExpressionAttributeValues': {':one': 1}})
+        routing.create_user('user1')
+        self.assertEqual(routing.cell_index.active()[1]['userCount'], 5)
+
+
+class TestHashMode(unittest.TestCase):
+    def setUp(self):
+        routing.routing_mode = 'hash'
+        routing.cell_index.invalidate()
+        self.ddb = Stubber(routing.dynamodb.meta.client)
+        self.ddb.activate()
+        cells = [{'cell_id': {'S': 'cell{}'.format(i)}, 'stackStatus': {'S': 'active'},
+                  'stage': {'S': 'prod'}, 'ring': {'BOOL': True}} for i in range(3)]
+        # Not on the ring until it has joined.
+        cells.append({'cell_id': {'S': 'cell3'}, 'stackStatus': {'S': 'active'}, 'stage': {'S': 'prod'}})
+        self.ddb.add_response('scan', {'Items': cells})
+
+    def tearDown(self):
+        routing.routing_mode = 'assign'
+        self.ddb.assert_no_pending_responses()
+        self.ddb.deactivate()
+
+    def expect_create(self, item, cell_id):
+        self.ddb.add_response('put_item', {}, {'TableName': 'Cellular-Routing-Users', 'Item': item})
+        self.ddb.add_response('update_item', {}, {
+            'TableName': 'Cellular-Routing-Cells', 'Key': {'cell_id': cell_id},
+            'UpdateExpression': 'ADD userCount :one', 'ConditionExpression': 'attribute_exists(cell_id)',
+            'ExpressionAttributeValues': {':one': 1}})
+
+    def test_ring_cell_is_not_stored(self):
+        self.assertEqual(routing.get_ring().cell_ids, ['cell0', 'cell1', 'cell2'])
+        cell_id = routing.get_ring().lookup('user1')
+        self.expect_create({'username': 'user1'}, cell_id)
+        routing.create_user('user1')
+        self.assertEqual(routing.get_user_cell({'username': 'user1'}), cell_id)
+
+    def test_override_stored_when_ring_cell_drained(self):
+        ring = routing.get_ring()
+        cell_id = ring.lookup('user1')
+        next(c for c in routing.cell_index.cells() if c['cell_id'] == cell_id)['drain'] = True
+        other = list(ring.walk('user1'))[1]
+        self.expect_create({'username': 'user1', 'cell': other}, other)
+        routing.create_user('user1')
+        self.assertEqual(routing.get_user_cell({'username': 'user1', 'cell': other}), other)
+
+
+class TestGetDnsName(unittest.TestCase):
+    def setUp(self):
+        routing.dns_cache.clear()
+        self.ddb = Stubber(routing.dynamodb.meta.client)
+        self.cfn = Stubber(routing.cloudformation)
+        self.ddb.activate()
+        self.cfn.activate()
+
+    def tearDown(self):
+        self.ddb.assert_no_pending_responses()
+        self.cfn.assert_no_pending_responses()
+        self.ddb.deactivate()
+        self.cfn.deactivate()
+
+    def expect_cell(self, cell_id, **kwargs):
+        self.ddb.add_response('get_item', cell_item(cell_id, **kwargs),
+                              {'TableName': 'Cellular-Routing-Cells',
+                               'Key': {'cell_id': cell_id}})
+
+    def expect_stack(self, stack_name, dns_name):
+        self.cfn.add_response('describe_stacks', stack(stack_name, dns_name),
+                              {'StackName': stack_name})
+        self.ddb.add_response('update_item', {}, {
+            'TableName': 'Cellular-Routing-Cells',
+            'Key': {'cell_id': ANY},
+            'UpdateExpression': 'SET dnsName = :d',
+            'ConditionExpression': ANY,
+            'ExpressionAttributeValues': {':d': dns_name},
+        })
+
+    def test_stored_dns_name(self):
+        self.expect_cell('cell1', dns_name='cell1.elb')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1.elb')
+
+    def test_concurrent_backfill(self):
+        self.expect_cell('cell1')
+        self.cfn.add_response('describe_stacks', stack('Cellular-Cell-cell1', 'cell1.elb'),
+                              {'StackName': 'Cellular-Cell-cell1'})
+        self.ddb.add_client_error('update_item', 'ConditionalCheckFailedException')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1.elb')
+
+    def test_cached_after_first_lookup(self):
+        self.expect_cell('cell1')
+        self.expect_stack('Cellular-Cell-cell1', 'cell1.elb')
+        self.expect_cell('cell1')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1.elb')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1.elb')
+        self.assertEqual(routing.dns_cache.stats()['hits'], 1)
+
+    def test_status_change_invalidates(self):
+        self.expect_cell('cell1')
+        self.expect_stack('Cellular-Cell-cell1', 'cell1.elb')
+        self.expect_cell('cell1', stack_status='updating')
+        self.expect_stack('Cellular-Cell-cell1', 'cell1-new.elb')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1.elb')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1-new.elb')
+
+    def test_stack_name_change_invalidates(self):
+        self.expect_cell('cell1')
+        self.expect_stack('Cellular-Cell-cell1', 'cell1.elb')
+        self.expect_cell('cell1', stack_name='Cellular-Cell-cell1-v2')
+        self.expect_stack('Cellular-Cell-cell1-v2', 'cell1-v2.elb')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1.elb')
+        self.assertEqual(routing.get_dns_name('cell1'), 'cell1-v2.elb')
+
+
+class TestStandIn(unittest.TestCase):
+    """Router end to end against the in-memory DynamoDB and CloudFormation."""
+
+    def setUp(self):
+        self.backend = standin.Backend()
+        standin.seed(self.backend, {'cell1': 'cell1.local', 'cell2': 'cell2.local'})
+        routing.init_clients(standin.session(self.backend))
+        routing.cell_index.invalidate()
+        routing.user_cache.clear()
+        routing.dns_cache.clear()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        routing.init_clients()
+        routing.cell_index.invalidate()
+
+    def test_register_and_login(self):
+        for i in range(20):
+            r = self.client.post('/register', json={'username': 'user{}'.format(i)})
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.client.post('/register', json={'username': 'user0'}).status_code, 409)
+        cells = {c['cell_id']: c for c in routing.scan_all(routing.cells_table)}
+        self.assertEqual(sum(int(c.get('userCount', 0)) for c in cells.values()), 20)
+
+        for i in range(20):
+            r = self.client.post('/login', json={'username': 'user{}'.format(i)})
+            self.assertIn(r.json['dns_name_cell'], ('cell1.local', 'cell2.local'))
+        # The first login per cell asks CloudFormation and stores the name.
+        self.assertLessEqual(self.backend.stats()['requests']['DescribeStacks'], 2)
+        cells = {c['cell_id']: c for c in routing.scan_all(routing.cells_table)}
+        self.assertEqual(cells['cell1']['dnsName'], 'cell1.local')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_requests_total{method="POST",route="/login",status="200"}', text)
+        self.assertIn('aws_call_duration_seconds_count{operation="DescribeStacks",service="cloudformation"}', text)
+
+    def test_hash_mode(self):
+        routing.routing_mode = 'hash'
+        try:
+            self.assertEqual(routing.get_ring().cell_ids, ['cell1', 'cell2'])
+            r = self.client.post('/register', json={'username': 'alice'})
+            self.assertEqual(r.status_code, 200)
+            r = self.client.post('/login', json={'username': 'alice'})
+            ring_cell = routing.get_ring().lookup('alice')
+            self.assertEqual(r.json['dns_name_cell'], ring_cell + '.local')
+
+            # A cell leaving the ring changes the snapshot's version.
+            version = routing.cell_index.version
+            routing.cells_table.update_item(Key={'cell_id': 'cell2'}, UpdateExpression='SET #r = :r',
+                                            ExpressionAttributeNames={'#r': 'ring'},
+                                            ExpressionAttributeValues={':r': False})
+            routing.cell_index.invalidate()
+            self.assertEqual(routing.get_ring().cell_ids, ['cell1'])
+            self.assertGreater(routing.cell_index.version, version)
+        finally:
+            routing.routing_mode = 'assign'
+
+    def test_cell_deleted_since_snapshot(self):
+        routing.cell_index.active()
+        for cell_id in ('cell1', 'cell2'):
+            routing.cells_table.delete_item(Key={'cell_id': cell_id})
+        self.assertEqual(self.client.post('/register', json={'username': 'alice'}).status_code, 200)
+        self.assertEqual(list(routing.scan_all(routing.cells_table)), [])
+
+    def test_unknown_user(self):
+        self.assertEqual(self.client.post('/login', json={'username': 'nobody'}).status_code, 401)
+
+    def test_body_without_content_type(self):
+        # As the ASGI app and the cells answer it.
+        self.assertEqual(self.client.post('/login', data=b'{"username": "nobody"}').status_code, 415)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import json
+import base64
+import tempfile
+import unittest
+from pathlib import Path
+import tokens
+
+
+def write_keys(path, current, keys):
+    with open(path, 'w') as f:
+        json.dump({'current': current, 'keys': {
+            kid: base64.b64encode(secret).decode() for kid, secret in keys.items()}}, f)
+
+
+class TestTokens(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        write_keys(self.path, 'k1', {'k1': b'a' * 32})
+        self.keyring = tokens.KeyRing(self.path, refresh=0)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_roundtrip(self):
+        token = tokens.issue(self.keyring, 'user1', 'cell1', 60, now=1000)
+        payload = tokens.verify(self.keyring, token, 'cell1', now=1059)
+        self.assertEqual(payload, {'u': 'user1', 'c': 'cell1', 'e': 1060})
+
+    def test_expired(self):
+        token = tokens.issue(self.keyring, 'user1', 'cell1', 60, now=1000)
+        self.assertIsNone(tokens.verify(self.keyring, token, now=1060))
+
+    def test_other_cell(self):
+        token = tokens.issue(self.keyring, 'user1', 'cell1', 60)
+        self.assertIsNone(tokens.verify(self.keyring, token, 'cell2'))
+
+    def test_tampered(self):
+        token = tokens.issue(self.keyring, 'user1', 'cell1', 60)
+        version, kid, payload, signature = token.split('.')
+        forged = tokens.b64encode(json.dumps({'u': 'admin', 'c': 'cell1', 'e': 2 ** 40}).encode())
+        self.assertIsNone(tokens.verify(self.keyring, '.'.join((version, kid, forged, signature))))
+        self.assertIsNone(tokens.verify(self.keyring, 'user1'))
+        self.assertIsNone(tokens.verify(self.keyring, token[:-2] + '!!'))
+
+    def test_rotation(self):
+        old = tokens.issue(self.keyring, 'user1', 'cell1', 60)
+        write_keys(self.path, 'k2', {'k1': b'a' * 32, 'k2': b'b' * 32})
+        os.utime(self.path, (0, 1))
+        new = tokens.issue(self.keyring, 'user1', 'cell1', 60)
+        self.assertEqual(new.split('.')[1], 'k2')
+        self.assertIsNotNone(tokens.verify(self.keyring, old))
+        write_keys(self.path, 'k2', {'k2': b'b' * 32})
+        os.utime(self.path, (0, 2))
+        self.assertIsNone(tokens.verify(self.keyring, old))
+        self.assertIsNotNone(tokens.verify(self.keyring, new))
+
+
+
+class TestCellCopy(unittest.TestCase):
+    def test_identical(self):
+        # The cells verify the tokens with their own copy of this module.
+        here = Path(__file__).parent
+        self.assertEqual((here / 'tokens.py').read_text(),
+                         (here.parent / 'cell-container' / 'tokens.py').read_text())
+
+
+if __name__ == '__main__':
+    unittest.main()
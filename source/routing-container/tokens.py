@@ -0,0 +1,121 @@
+"""Compact signed routing tokens.
+
+At login the router issues a token carrying the username, the user's cell
+and an expiry, signed with HMAC-SHA256. Cells verify it locally, without a
+call to the router. Format:
+
+    v1.<key id>.<payload>.<signature>
+
+with payload and signature base64url-encoded without padding; the payload
+is the JSON object {"u": username, "c": cell id, "e": expiry (epoch s)}.
+
+Keys are read from a JSON key file, a local stand-in for a Secrets Manager
+secret:
+
+    {"current": "k2", "keys": {"k1": "<base64 secret>", "k2": "<base64 secret>"}}
+
+Tokens are signed with the current key and every listed key verifies. To
+rotate, add a new key and make it current, then remove the old key once
+the tokens signed with it have expired (cellularctl token rotate). The file
+is re-read when it changes, at most every `refresh` seconds.
+
+The router and the cell container each have a copy of this module; keep
+them identical (routing-container/test_tokens.py checks).
+"""
+import os
+import time
+import json
+import hmac
+import base64
+import hashlib
+import binascii
+import threading
+
+VERSION = 'v1'
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class KeyRing:
+    def __init__(self, path, refresh=60, clock=time.monotonic):
+        self.path = path
+        self.refresh = refresh
+        self.clock = clock
+        self._mtime = None
+        self._checked = None
+        self._current = None
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        now = self.clock()
+        if self._checked is not None and now - self._checked < self.refresh:
+            return
+        with self._lock:
+            self._checked = now
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                data = json.load(f)
+            self._keys = {kid: base64.b64decode(secret) for kid, secret in data['keys'].items()}
+            self._current = data['current']
+            self._mtime = mtime
+
+    def current(self):
+        self._load()
+        return self._current, self._keys[self._current]
+
+    def get(self, kid):
+        self._load()
+        return self._keys.get(kid)
+
+
+def sign(secret, message):
+    return hmac.new(secret, message.encode(), hashlib.sha256).digest()
+
+
+def issue(keyring, username, cell_id, ttl, now=None):
+    kid, secret = keyring.current()
+    expires = int((time.time() if now is None else now) + ttl)
+    payload = b64encode(json.dumps({'u': username, 'c': cell_id, 'e': expires},
+                                   separators=(',', ':')).encode())
+    message = '.'.join((VERSION, kid, payload))
+    return message + '.' + b64encode(sign(secret, message))
+
+
+def verify(keyring, token, cell_id=None, now=None):
+    """Returns the payload of a valid, unexpired token, or None. With
+    cell_id, the token must have been issued for that cell."""
+    parts = token.split('.')
+    if len(parts) != 4 or parts[0] != VERSION:
+        return None
+    secret = keyring.get(parts[1])
+    if secret is None:
+        return None
+    try:
+        signature = b64decode(parts[3])
+    except (binascii.Error, ValueError):
+        return None
+    if not hmac.compare_digest(sign(secret, '.'.join(parts[:3])), signature):
+        return None
+    payload = json.loads(b64decode(parts[2]))
+    if payload['e'] <= (time.time() if now is None else now):
+        return None
+    if cell_id is not None and payload['c'] != cell_id:
+        return None
+    return payload
+
+
+def from_env():
+    """The key ring configured by tokenKeyFile, or None. Without a key file
+    the bearer token is the plain username, as before signed tokens."""
+    if not os.environ.get('tokenKeyFile'):
+        return None
+    return KeyRing(os.environ['tokenKeyFile'], float(os.environ.get('tokenKeyRefresh', 60)))
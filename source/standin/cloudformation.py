@@ -0,0 +1,73 @@
+"""CloudFormation stand-in: stacks with outputs, enough for DescribeStacks,
+which is what the router and cellularctl read, and DeleteStack."""
+import datetime
+import threading
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://cloudformation.amazonaws.com/doc/2010-05-15/'
+
+
+class CloudFormationError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class CloudFormation:
+    def __init__(self):
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def put_stack(self, name, outputs, status='CREATE_COMPLETE'):
+        with self.lock:
+            self.stacks[name] = {
+                'StackName': name,
+                'StackId': 'arn:aws:cloudformation:local:000000000000:stack/{}/standin'.format(name),
+                'StackStatus': status,
+                'CreationTime': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'Outputs': dict(outputs),
+            }
+
+    def delete_stack(self, name):
+        with self.lock:
+            self.stacks.pop(name, None)
+
+    def handle(self, action, params):
+        """Runs a query protocol action. Returns the XML response body."""
+        if action == 'DeleteStack':
+            self.delete_stack(params.get('StackName'))
+            return ('<DeleteStackResponse xmlns="{}"><ResponseMetadata><RequestId>standin</RequestId>'
+                    '</ResponseMetadata></DeleteStackResponse>').format(NAMESPACE).encode()
+        if action != 'DescribeStacks':
+            raise CloudFormationError('InvalidAction', 'Unsupported action ' + action)
+        name = params.get('StackName')
+        with self.lock:
+            if name is None:
+                stacks = list(self.stacks.values())
+            else:
+                stacks = [s for s in self.stacks.values() if name in (s['StackName'], s['StackId'])]
+                if not stacks:
+                    raise CloudFormationError('ValidationError',
+                                              'Stack with id {} does not exist'.format(name))
+            members = ''.join(stack_xml(s) for s in stacks)
+        return ('<DescribeStacksResponse xmlns="{}"><DescribeStacksResult><Stacks>{}</Stacks>'
+                '</DescribeStacksResult><ResponseMetadata><RequestId>standin</RequestId>'
+                '</ResponseMetadata></DescribeStacksResponse>').format(NAMESPACE, members).encode()
+
+
+def stack_xml(stack):
+    outputs = ''.join(
+        '<member><OutputKey>{}</OutputKey><OutputValue>{}</OutputValue></member>'.format(
+            escape(k), escape(v))
+        for k, v in stack['Outputs'].items())
+    return ('<member><StackName>{}</StackName><StackId>{}</StackId><StackStatus>{}</StackStatus>'
+            '<CreationTime>{}</CreationTime><Outputs>{}</Outputs></member>').format(
+        escape(stack['StackName']), escape(stack['StackId']), stack['StackStatus'],
+        stack['CreationTime'], outputs)
+
+
+def error_xml(code, message):
+    return ('<ErrorResponse xmlns="{}"><Error><Type>Sender</Type><Code>{}</Code>'
+            '<Message>{}</Message></Error><RequestId>standin</RequestId></ErrorResponse>').format(
+        NAMESPACE, code, escape(message)).encode()
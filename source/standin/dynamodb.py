@@ -0,0 +1,482 @@
+"""In-memory DynamoDB for the stand-in. Operations take and return the
+low-level JSON request and response bodies of the DynamoDB API, so the same
+code serves boto3 in-process (see standin.install) and over HTTP.
+
+Supported: CreateTable, DeleteTable, DescribeTable, ListTables, GetItem,
+PutItem, UpdateItem, DeleteItem, Query, Scan (with segments), BatchGetItem,
+BatchWriteItem and TransactWriteItems. Secondary indexes, read transactions
+and streams are not.
+"""
+import base64
+import hashlib
+import math
+import threading
+import time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer, Binary
+import expressions
+from expressions import ValidationError
+
+# DynamoDB returns at most 1 MB per Query or Scan page.
+PAGE_BYTES = 1024 * 1024
+BATCH_WRITE_LIMIT = 25
+BATCH_GET_LIMIT = 100
+TRANSACT_LIMIT = 100
+
+
+class WireDeserializer(TypeDeserializer):
+    """Binary values are base64 encoded in the JSON bodies."""
+
+    def _deserialize_b(self, value):
+        return Binary(base64.b64decode(value))
+
+
+class WireSerializer(TypeSerializer):
+    def _serialize_b(self, value):
+        return base64.b64encode(super()._serialize_b(value)).decode()
+
+
+deserializer = WireDeserializer()
+serializer = WireSerializer()
+
+
+class DynamoDBError(Exception):
+    def __init__(self, code, message, fields=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        # Members of the error response besides the message, e.g. Item.
+        self.fields = fields or {}
+
+
+def deserialize(item):
+    return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+
+def serialize(item):
+    return {k: serializer.serialize(v) for k, v in item.items()}
+
+
+def item_size(item):
+    """Approximate DynamoDB item size: attribute names plus values."""
+    size = 0
+    for k, v in item.items():
+        size += len(k.encode()) + value_size(v)
+    return size
+
+
+def value_size(value):
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return 3 + item_size(value)
+    if isinstance(value, (list, set)):
+        return 3 + sum(value_size(v) + 1 for v in value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    return len(str(value))
+
+
+def key_value(value):
+    """Hashable, ordered form of a key attribute."""
+    return value.value if isinstance(value, Binary) else value
+
+
+def partition_hash(pk):
+    return hashlib.md5(repr(pk).encode()).digest()
+
+
+class Table:
+    def __init__(self, name, key_schema, attribute_definitions, billing_mode='PAY_PER_REQUEST'):
+        self.name = name
+        self.hash_key = next(k['AttributeName'] for k in key_schema if k['KeyType'] == 'HASH')
+        ranges = [k['AttributeName'] for k in key_schema if k['KeyType'] == 'RANGE']
+        self.range_key = ranges[0] if ranges else None
+        self.key_schema = key_schema
+        self.attribute_definitions = attribute_definitions
+        self.billing_mode = billing_mode
+        self.created = time.time()
+        # partition key -> {sort key (or None) -> item}
+        self.partitions = {}
+        self.count = 0
+        self.size = 0
+
+    def key_names(self):
+        return [self.hash_key] + ([self.range_key] if self.range_key else [])
+
+    def key_of(self, item):
+        return {k: item[k] for k in self.key_names()}
+
+    def locate(self, key):
+        if set(key) != set(self.key_names()):
+            raise DynamoDBError('ValidationException',
+                                'The provided key element does not match the schema')
+        return key_value(key[self.hash_key]), key_value(key[self.range_key]) if self.range_key else None
+
+    def get(self, key):
+        pk, sk = self.locate(key)
+        return self.partitions.get(pk, {}).get(sk)
+
+    def put(self, item):
+        for name in self.key_names():
+            if name not in item:
+                raise DynamoDBError('ValidationException',
+                                    'One or more parameter values were invalid: Missing the key {} in the item'.format(name))
+        pk, sk = self.locate(self.key_of(item))
+        partition = self.partitions.setdefault(pk, {})
+        old = partition.get(sk)
+        partition[sk] = item
+        self.count += old is None
+        self.size += item_size(item) - (item_size(old) if old else 0)
+        return old
+
+    def delete(self, key):
+        pk, sk = self.locate(key)
+        partition = self.partitions.get(pk, {})
+        old = partition.pop(sk, None)
+        if old is not None:
+            self.count -= 1
+            self.size -= item_size(old)
+            if not partition:
+                del self.partitions[pk]
+        return old
+
+    def scan_order(self, segment=None, total_segments=None):
+        """Items in scan order: by hash of the partition key, then sort key."""
+        pks = self.partitions
+        if total_segments:
+            pks = [pk for pk in pks
+                   if int.from_bytes(partition_hash(pk)[:4], 'big') % total_segments == segment]
+        for pk in sorted(pks, key=partition_hash):
+            for sk in sorted(self.partitions[pk], key=sort_order):
+                yield (partition_hash(pk), sort_order(sk)), self.partitions[pk][sk]
+
+    def describe(self):
+        return {
+            'TableName': self.name,
+            'TableStatus': 'ACTIVE',
+            'KeySchema': self.key_schema,
+            'AttributeDefinitions': self.attribute_definitions,
+            'CreationDateTime': self.created,
+            'ItemCount': self.count,
+            'TableSizeBytes': self.size,
+            'TableArn': 'arn:aws:dynamodb:local:000000000000:table/' + self.name,
+            'BillingModeSummary': {'BillingMode': self.billing_mode},
+        }
+
+
+def sort_order(sk):
+    # Sort keys of one table share a type; None for tables without one.
+    return (0, b'') if sk is None else (1, sk)
+
+
+def capacity(size, unit):
+    return max(1, math.ceil(size / unit))
+
+
+class DynamoDB:
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.RLock()
+        # Called once per item of a batch request; returning True leaves the
+        # item unprocessed, as a throttled partition would.
+        self.unprocessed = lambda: False
+
+    def handle(self, operation, request):
+        method = getattr(self, operation, None)
+        if method is None or operation.startswith('_') or not operation[0].isupper():
+            raise DynamoDBError('UnknownOperationException', 'Unsupported operation ' + operation)
+        try:
+            with self.lock:
+                return method(request)
+        except ValidationError as e:
+            raise DynamoDBError('ValidationException', str(e))
+
+    def table(self, name):
+        if name not in self.tables:
+            raise DynamoDBError('ResourceNotFoundException', 'Requested resource not found')
+        return self.tables[name]
+
+    # Tables
+
+    def CreateTable(self, r):
+        name = r['TableName']
+        if name in self.tables:
+            raise DynamoDBError('ResourceInUseException', 'Table already exists: ' + name)
+        self.tables[name] = Table(name, r['KeySchema'], r['AttributeDefinitions'],
+                                  r.get('BillingMode', 'PROVISIONED'))
+        return {'TableDescription': self.tables[name].describe()}
+
+    def DeleteTable(self, r):
+        table = self.table(r['TableName'])
+        del self.tables[table.name]
+        return {'TableDescription': table.describe()}
+
+    def DescribeTable(self, r):
+        return {'Table': self.table(r['TableName']).describe()}
+
+    def ListTables(self, r):
+        names = sorted(n for n in self.tables if n > r.get('ExclusiveStartTableName', ''))
+        limit = r.get('Limit', 100)
+        result = {'TableNames': names[:limit]}
+        if len(names) > limit:
+            result['LastEvaluatedTableName'] = names[limit - 1]
+        return result
+
+    # Items
+
+    def check(self, r, item):
+        if 'ConditionExpression' not in r:
+            return
+        condition = expressions.parse_condition(
+            r['ConditionExpression'], r.get('ExpressionAttributeNames'), values(r))
+        if not expressions.evaluate(condition, item or {}):
+            fields = {}
+            if r.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and item:
+                fields['Item'] = serialize(item)
+            raise DynamoDBError('ConditionalCheckFailedException', 'The conditional request failed', fields)
+
+    def consumed(self, r, table, units):
+        if r.get('ReturnConsumedCapacity', 'NONE') == 'NONE':
+            return {}
+        return {'ConsumedCapacity': {'TableName': table.name, 'CapacityUnits': units}}
+
+    def read_units(self, r, size):
+        units = capacity(size, 4096)
+        return units if r.get('ConsistentRead') else units / 2
+
+    def GetItem(self, r):
+        table = self.table(r['TableName'])
+        item = table.get(deserialize(r['Key']))
+        result = self.consumed(r, table, self.read_units(r, item_size(item) if item else 1))
+        if item is not None:
+            result['Item'] = serialize(projection(r, item))
+        return result
+
+    def PutItem(self, r):
+        table = self.table(r['TableName'])
+        item = deserialize(r['Item'])
+        self.check(r, table.get(table.key_of(item)) if set(table.key_names()) <= set(item) else None)
+        old = table.put(item)
+        result = self.consumed(r, table, capacity(item_size(item), 1024))
+        if r.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            result['Attributes'] = serialize(old)
+        return result
+
+    def DeleteItem(self, r):
+        table = self.table(r['TableName'])
+        key = deserialize(r['Key'])
+        old = table.get(key)
+        self.check(r, old)
+        table.delete(key)
+        result = self.consumed(r, table, capacity(item_size(old) if old else 1, 1024))
+        if r.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            result['Attributes'] = serialize(old)
+        return result
+
+    def UpdateItem(self, r):
+        table = self.table(r['TableName'])
+        key = deserialize(r['Key'])
+        old = table.get(key)
+        self.check(r, old)
+        item = expressions.copy_item(old) if old else dict(key)
+        changed = set()
+        if 'UpdateExpression' in r:
+            actions = expressions.parse_update(
+                r['UpdateExpression'], r.get('ExpressionAttributeNames'), values(r))
+            changed = expressions.apply_update(actions, item)
+            if changed & set(table.key_names()):
+                raise DynamoDBError('ValidationException',
+                                    'Cannot update attribute {}. This attribute is part of the key'
+                                    .format(sorted(changed & set(table.key_names()))[0]))
+        table.put(item)
+        result = self.consumed(r, table, capacity(item_size(item), 1024))
+        returns = r.get('ReturnValues', 'NONE')
+        if returns == 'ALL_NEW':
+            result['Attributes'] = serialize(item)
+        elif returns == 'ALL_OLD' and old:
+            result['Attributes'] = serialize(old)
+        elif returns == 'UPDATED_NEW':
+            result['Attributes'] = serialize({k: item[k] for k in changed if k in item})
+        elif returns == 'UPDATED_OLD' and old:
+            result['Attributes'] = serialize({k: old[k] for k in changed if k in old})
+        return result
+
+    # Reads of many items
+
+    def page(self, r, table, entries, start):
+        """Builds a Query or Scan response from (order, item) pairs. start is
+        the order of ExclusiveStartKey, if any."""
+        limit = r.get('Limit')
+        condition = None
+        if 'FilterExpression' in r:
+            condition = expressions.parse_condition(
+                r['FilterExpression'], r.get('ExpressionAttributeNames'), values(r))
+        items, scanned, size, last = [], 0, 0, None
+        more = False
+        for order, item in entries:
+            if start is not None and not after(order, start, r.get('ScanIndexForward', True)):
+                continue
+            if (limit is not None and scanned >= limit) or size >= PAGE_BYTES:
+                more = True
+                break
+            scanned += 1
+            size += item_size(item)
+            last = item
+            if condition is None or expressions.evaluate(condition, item):
+                items.append(item)
+        result = {'Count': len(items), 'ScannedCount': scanned}
+        if r.get('Select') != 'COUNT':
+            result['Items'] = [serialize(projection(r, i)) for i in items]
+        if more and last is not None:
+            result['LastEvaluatedKey'] = serialize(table.key_of(last))
+        result.update(self.consumed(r, table, self.read_units(r, max(size, 1))))
+        return result
+
+    def Query(self, r):
+        table = self.table(r['TableName'])
+        if 'IndexName' in r:
+            raise DynamoDBError('ValidationException', 'Secondary indexes are not supported')
+        condition = expressions.parse_condition(
+            r['KeyConditionExpression'], r.get('ExpressionAttributeNames'), values(r))
+        pk = partition_key(condition, table.hash_key)
+        partition = table.partitions.get(key_value(pk), {})
+        forward = r.get('ScanIndexForward', True)
+        entries = [(sort_order(sk), partition[sk])
+                   for sk in sorted(partition, key=sort_order, reverse=not forward)]
+        entries = [(o, i) for o, i in entries if expressions.evaluate(condition, i)]
+        start = None
+        if 'ExclusiveStartKey' in r:
+            start = sort_order(table.locate(deserialize(r['ExclusiveStartKey']))[1])
+        return self.page(r, table, entries, start)
+
+    def Scan(self, r):
+        table = self.table(r['TableName'])
+        if 'IndexName' in r:
+            raise DynamoDBError('ValidationException', 'Secondary indexes are not supported')
+        start = None
+        if 'ExclusiveStartKey' in r:
+            pk, sk = table.locate(deserialize(r['ExclusiveStartKey']))
+            start = (partition_hash(pk), sort_order(sk))
+        entries = table.scan_order(r.get('Segment'), r.get('TotalSegments'))
+        return self.page(dict(r, ScanIndexForward=True), table, entries, start)
+
+    # Batches
+
+    def BatchGetItem(self, r):
+        requests = r['RequestItems']
+        if sum(len(t['Keys']) for t in requests.values()) > BATCH_GET_LIMIT:
+            raise DynamoDBError('ValidationException',
+                                'Too many items requested for the BatchGetItem call')
+        responses, unprocessed, consumed = {}, {}, []
+        for name, spec in requests.items():
+            table = self.table(name)
+            responses[name] = []
+            size = 0
+            for key in spec['Keys']:
+                if self.unprocessed():
+                    unprocessed.setdefault(name, dict(spec, Keys=[]))['Keys'].append(key)
+                    continue
+                item = table.get(deserialize(key))
+                if item is not None:
+                    size += item_size(item)
+                    responses[name].append(serialize(projection(spec, item)))
+            consumed.append({'TableName': name, 'CapacityUnits': self.read_units(spec, max(size, 1))})
+        result = {'Responses': responses, 'UnprocessedKeys': unprocessed}
+        if r.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            result['ConsumedCapacity'] = consumed
+        return result
+
+    def BatchWriteItem(self, r):
+        requests = r['RequestItems']
+        if sum(len(w) for w in requests.values()) > BATCH_WRITE_LIMIT:
+            raise DynamoDBError('ValidationException',
+                                'Too many items requested for the BatchWriteItem call')
+        unprocessed, consumed = {}, []
+        for name, writes in requests.items():
+            table = self.table(name)
+            units = 0
+            for write in writes:
+                if self.unprocessed():
+                    unprocessed.setdefault(name, []).append(write)
+                    continue
+                if 'PutRequest' in write:
+                    item = deserialize(write['PutRequest']['Item'])
+                    table.put(item)
+                    units += capacity(item_size(item), 1024)
+                else:
+                    old = table.delete(deserialize(write['DeleteRequest']['Key']))
+                    units += capacity(item_size(old) if old else 1, 1024)
+            consumed.append({'TableName': name, 'CapacityUnits': units})
+        result = {'UnprocessedItems': unprocessed}
+        if r.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            result['ConsumedCapacity'] = consumed
+        return result
+
+    def TransactWriteItems(self, r):
+        """All conditions are checked before anything is written; the lock
+        held by handle makes the whole transaction atomic."""
+        actions = [next(iter(a.items())) for a in r['TransactItems']]
+        if len(actions) > TRANSACT_LIMIT:
+            raise DynamoDBError('ValidationException',
+                                'Member must have length less than or equal to {}'.format(TRANSACT_LIMIT))
+        reasons = []
+        for kind, request in actions:
+            table = self.table(request['TableName'])
+            if kind == 'Put':
+                current = table.get(table.key_of(deserialize(request['Item'])))
+            else:
+                current = table.get(deserialize(request['Key']))
+            try:
+                self.check(request, current)
+                reasons.append('None')
+            except DynamoDBError:
+                reasons.append('ConditionalCheckFailed')
+        if any(reason != 'None' for reason in reasons):
+            raise DynamoDBError('TransactionCanceledException',
+                                'Transaction cancelled, please refer cancellation reasons for specific '
+                                'reasons [{}]'.format(', '.join(reasons)))
+        for kind, request in actions:
+            if kind == 'Put':
+                self.PutItem(request)
+            elif kind == 'Update':
+                self.UpdateItem(request)
+            elif kind == 'Delete':
+                self.DeleteItem(request)
+        return {}
+
+
+def values(r):
+    return deserialize(r.get('ExpressionAttributeValues', {}))
+
+
+def projection(r, item):
+    if 'ProjectionExpression' not in r:
+        return item
+    paths = expressions.parse_projection(r['ProjectionExpression'], r.get('ExpressionAttributeNames'))
+    return expressions.project(item, paths)
+
+
+def after(order, start, forward):
+    return order > start if forward else order < start
+
+
+def partition_key(condition, hash_key):
+    """Finds the value of the `hash_key = :v` term of a key condition."""
+    if condition[0] == 'and':
+        for side in condition[1:]:
+            try:
+                return partition_key(side, hash_key)
+            except DynamoDBError:
+                pass
+    elif condition[0] == 'compare' and condition[1] == '=':
+        left, right = condition[2], condition[3]
+        if left == ('path', (hash_key,)) and right[0] == 'value':
+            return right[1]
+        if right == ('path', (hash_key,)) and left[0] == 'value':
+            return left[1]
+    raise DynamoDBError('ValidationException',
+                        'Query condition missed key schema element: ' + hash_key)
@@ -0,0 +1,472 @@
+"""Parser and evaluator for the DynamoDB expression language, as far as the
+stand-in needs it: condition, filter and key condition expressions, update
+expressions and projection expressions.
+
+Items and values are plain Python values as produced by boto3's
+TypeDeserializer (str, Decimal, Binary, bool, None, list, dict, set).
+"""
+import re
+from decimal import Decimal
+from boto3.dynamodb.types import Binary
+
+
+class ValidationError(Exception):
+    pass
+
+
+TOKEN = re.compile(r'''
+    \s*(?:
+      (?P<name>\#[A-Za-z0-9_]+)
+    | (?P<value>:[A-Za-z0-9_]+)
+    | (?P<index>\[\s*\d+\s*\])
+    | (?P<op><>|<=|>=|=|<|>|\(|\)|,|\.|\+|-)
+    | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+    )''', re.VERBOSE)
+
+KEYWORDS = {'AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'SET', 'REMOVE', 'ADD', 'DELETE'}
+COMPARATORS = {'=', '<>', '<', '<=', '>', '>='}
+BOOLEAN_FUNCTIONS = {'attribute_exists', 'attribute_not_exists', 'attribute_type',
+                     'begins_with', 'contains'}
+
+
+def tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = TOKEN.match(expression, pos)
+        if not m or m.end() == pos:
+            raise ValidationError('Invalid expression near "{}"'.format(expression[pos:]))
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'ident' and text.upper() in KEYWORDS:
+            kind, text = 'keyword', text.upper()
+        elif kind == 'index':
+            text = int(text.strip('[] '))
+        tokens.append((kind, text))
+        pos = m.end()
+    return tokens
+
+
+class Parser:
+    def __init__(self, expression, names=None, values=None):
+        self.tokens = tokenize(expression)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValidationError('Unexpected end of expression')
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text=None):
+        token = self.peek()
+        if token[0] == kind and (text is None or token[1] == text):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, text=None):
+        if not self.accept(kind, text):
+            raise ValidationError('Expected {} but found {}'.format(text or kind, self.peek()[1]))
+
+    def done(self):
+        if self.peek()[0] is not None:
+            raise ValidationError('Unexpected "{}"'.format(self.peek()[1]))
+
+    # Operands
+
+    def path(self):
+        segments = [self.attribute()]
+        while True:
+            if self.peek()[0] == 'index':
+                segments.append(self.next()[1])
+            elif self.accept('op', '.'):
+                segments.append(self.attribute())
+            else:
+                return ('path', tuple(segments))
+
+    def attribute(self):
+        kind, text = self.next()
+        if kind == 'name':
+            if text not in self.names:
+                raise ValidationError('Undefined attribute name ' + text)
+            return self.names[text]
+        if kind == 'ident':
+            return text
+        raise ValidationError('Expected an attribute name but found ' + str(text))
+
+    def value(self):
+        kind, text = self.next()
+        if text not in self.values:
+            raise ValidationError('Undefined attribute value ' + text)
+        return ('value', self.values[text])
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 'value':
+            return self.value()
+        if kind == 'ident' and text == 'size' and self.peek(1) == ('op', '('):
+            self.pos += 2
+            path = self.path()
+            self.expect('op', ')')
+            return ('size', path)
+        return self.path()
+
+    # Conditions
+
+    def condition(self):
+        node = self.conjunction()
+        while self.accept('keyword', 'OR'):
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.accept('keyword', 'AND'):
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.accept('keyword', 'NOT'):
+            return ('not', self.negation())
+        return self.primary()
+
+    def primary(self):
+        if self.accept('op', '('):
+            node = self.condition()
+            self.expect('op', ')')
+            return node
+        kind, text = self.peek()
+        if kind == 'ident' and text in BOOLEAN_FUNCTIONS and self.peek(1) == ('op', '('):
+            self.pos += 2
+            args = [self.operand()]
+            while self.accept('op', ','):
+                args.append(self.operand())
+            self.expect('op', ')')
+            return ('function', text, args)
+        left = self.operand()
+        if self.accept('keyword', 'BETWEEN'):
+            low = self.operand()
+            self.expect('keyword', 'AND')
+            return ('between', left, low, self.operand())
+        if self.accept('keyword', 'IN'):
+            self.expect('op', '(')
+            options = [self.operand()]
+            while self.accept('op', ','):
+                options.append(self.operand())
+            self.expect('op', ')')
+            return ('in', left, options)
+        kind, op = self.next()
+        if op not in COMPARATORS:
+            raise ValidationError('Expected a comparison but found ' + str(op))
+        return ('compare', op, left, self.operand())
+
+    # Updates
+
+    def update(self):
+        actions = []
+        while self.peek()[0] is not None:
+            kind, clause = self.next()
+            if kind != 'keyword' or clause not in ('SET', 'REMOVE', 'ADD', 'DELETE'):
+                raise ValidationError('Expected SET, REMOVE, ADD or DELETE but found ' + str(clause))
+            while True:
+                path = self.path()[1]
+                if clause == 'SET':
+                    self.expect('op', '=')
+                    actions.append(('SET', path, self.set_value()))
+                elif clause == 'REMOVE':
+                    actions.append(('REMOVE', path, None))
+                else:
+                    actions.append((clause, path, self.value()))
+                if not self.accept('op', ','):
+                    break
+        if not actions:
+            raise ValidationError('Empty update expression')
+        return actions
+
+    def set_value(self):
+        node = self.set_operand()
+        if self.peek() in (('op', '+'), ('op', '-')):
+            op = self.next()[1]
+            node = ('arith', op, node, self.set_operand())
+        return node
+
+    def set_operand(self):
+        kind, text = self.peek()
+        if kind == 'ident' and text in ('if_not_exists', 'list_append') and self.peek(1) == ('op', '('):
+            self.pos += 2
+            first = self.path() if text == 'if_not_exists' else self.set_operand()
+            self.expect('op', ',')
+            second = self.set_operand()
+            self.expect('op', ')')
+            return (text, first, second)
+        return self.operand()
+
+    def projection(self):
+        paths = [self.path()[1]]
+        while self.accept('op', ','):
+            paths.append(self.path()[1])
+        return paths
+
+
+def parse_condition(expression, names=None, values=None):
+    p = Parser(expression, names, values)
+    node = p.condition()
+    p.done()
+    return node
+
+
+def parse_update(expression, names=None, values=None):
+    p = Parser(expression, names, values)
+    actions = p.update()
+    p.done()
+    return actions
+
+
+def parse_projection(expression, names=None):
+    p = Parser(expression, names)
+    paths = p.projection()
+    p.done()
+    return paths
+
+
+# Evaluation
+
+MISSING = object()
+
+
+def get_path(item, path):
+    value = item
+    for segment in path:
+        if isinstance(segment, int):
+            if not isinstance(value, list) or segment >= len(value):
+                return MISSING
+            value = value[segment]
+        else:
+            if not isinstance(value, dict) or segment not in value:
+                return MISSING
+            value = value[segment]
+    return value
+
+
+def comparable(value):
+    """Value for ordering comparisons, or None if the type has no order."""
+    if isinstance(value, Binary):
+        return ('B', value.value)
+    if isinstance(value, (bytes, bytearray)):
+        return ('B', bytes(value))
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, Decimal)):
+        return ('N', Decimal(value))
+    if isinstance(value, str):
+        return ('S', value)
+    return None
+
+
+def type_of(value):
+    if isinstance(value, str):
+        return 'S'
+    if isinstance(value, bool):
+        return 'BOOL'
+    if isinstance(value, (int, Decimal)):
+        return 'N'
+    if isinstance(value, (Binary, bytes, bytearray)):
+        return 'B'
+    if value is None:
+        return 'NULL'
+    if isinstance(value, list):
+        return 'L'
+    if isinstance(value, dict):
+        return 'M'
+    if isinstance(value, set):
+        sample = next(iter(value))
+        return {'S': 'SS', 'N': 'NS', 'B': 'BS'}[type_of(sample)]
+    raise ValidationError('Unsupported value {!r}'.format(value))
+
+
+def operand_value(node, item):
+    kind = node[0]
+    if kind == 'value':
+        return node[1]
+    if kind == 'path':
+        return get_path(item, node[1])
+    if kind == 'size':
+        value = get_path(item, node[1][1])
+        if value is MISSING:
+            return MISSING
+        if isinstance(value, Binary):
+            return Decimal(len(value.value))
+        if isinstance(value, str):
+            return Decimal(len(value.encode()))
+        return Decimal(len(value))
+    raise ValidationError('Invalid operand')
+
+
+def compare(op, left, right):
+    if op == '=':
+        return left is not MISSING and left == right
+    if op == '<>':
+        return left is MISSING or right is MISSING or left != right
+    a, b = comparable(left) if left is not MISSING else None, comparable(right) if right is not MISSING else None
+    if a is None or b is None or a[0] != b[0]:
+        return False
+    return {'<': a < b, '<=': a <= b, '>': a > b, '>=': a >= b}[op]
+
+
+def evaluate(node, item):
+    """Evaluates a parsed condition against an item."""
+    kind = node[0]
+    if kind == 'and':
+        return evaluate(node[1], item) and evaluate(node[2], item)
+    if kind == 'or':
+        return evaluate(node[1], item) or evaluate(node[2], item)
+    if kind == 'not':
+        return not evaluate(node[1], item)
+    if kind == 'compare':
+        return compare(node[1], operand_value(node[2], item), operand_value(node[3], item))
+    if kind == 'between':
+        value = operand_value(node[1], item)
+        return (compare('>=', value, operand_value(node[2], item))
+                and compare('<=', value, operand_value(node[3], item)))
+    if kind == 'in':
+        value = operand_value(node[1], item)
+        return any(compare('=', value, operand_value(o, item)) for o in node[2])
+    if kind == 'function':
+        name, args = node[1], node[2]
+        value = operand_value(args[0], item)
+        if name == 'attribute_exists':
+            return value is not MISSING
+        if name == 'attribute_not_exists':
+            return value is MISSING
+        if value is MISSING:
+            return False
+        arg = operand_value(args[1], item)
+        if name == 'attribute_type':
+            return type_of(value) == arg
+        if name == 'begins_with':
+            a, b = comparable(value), comparable(arg)
+            return a is not None and b is not None and a[0] == b[0] and a[0] != 'N' \
+                and a[1][:len(b[1])] == b[1]
+        if name == 'contains':
+            if isinstance(value, str):
+                return isinstance(arg, str) and arg in value
+            if isinstance(value, (set, list)):
+                return arg in value
+            return False
+    raise ValidationError('Invalid condition')
+
+
+def set_path(item, path, value):
+    parent = get_path(item, path[:-1]) if len(path) > 1 else item
+    last = path[-1]
+    if isinstance(last, int):
+        if not isinstance(parent, list):
+            raise ValidationError('The document path provided in the update expression is invalid for update')
+        if last >= len(parent):
+            parent.append(value)
+        else:
+            parent[last] = value
+    else:
+        if not isinstance(parent, dict):
+            raise ValidationError('The document path provided in the update expression is invalid for update')
+        parent[last] = value
+
+
+def remove_path(item, path):
+    parent = get_path(item, path[:-1]) if len(path) > 1 else item
+    last = path[-1]
+    if isinstance(last, int) and isinstance(parent, list) and last < len(parent):
+        del parent[last]
+    elif isinstance(parent, dict):
+        parent.pop(last, None)
+
+
+def set_value(node, item):
+    kind = node[0]
+    if kind == 'if_not_exists':
+        value = get_path(item, node[1][1])
+        return set_value(node[2], item) if value is MISSING else value
+    if kind == 'list_append':
+        a, b = set_value(node[1], item), set_value(node[2], item)
+        if not isinstance(a, list) or not isinstance(b, list):
+            raise ValidationError('An operand in the update expression has an incorrect data type')
+        return a + b
+    if kind == 'arith':
+        a, b = set_value(node[2], item), set_value(node[3], item)
+        if type_of(a) != 'N' or type_of(b) != 'N':
+            raise ValidationError('An operand in the update expression has an incorrect data type')
+        return a + b if node[1] == '+' else a - b
+    value = operand_value(node, item)
+    if value is MISSING:
+        raise ValidationError('The provided expression refers to an attribute that does not exist in the item')
+    return value
+
+
+def apply_update(actions, item):
+    """Applies parsed update actions to item in place. Returns the top level
+    attribute names that were changed."""
+    # All values are computed from the item as it was before the update.
+    before = copy_item(item)
+    changed = set()
+    for action, path, operand in actions:
+        changed.add(path[0])
+        if action == 'SET':
+            set_path(item, path, set_value(operand, before))
+        elif action == 'REMOVE':
+            remove_path(item, path)
+        elif action == 'ADD':
+            value = operand[1]
+            current = get_path(item, path)
+            if current is MISSING:
+                set_path(item, path, value)
+            elif type_of(current) == 'N' and type_of(value) == 'N':
+                set_path(item, path, current + value)
+            elif isinstance(current, set) and isinstance(value, set):
+                set_path(item, path, current | value)
+            else:
+                raise ValidationError('An operand in the update expression has an incorrect data type')
+        elif action == 'DELETE':
+            current = get_path(item, path)
+            if isinstance(current, set):
+                remaining = current - operand[1]
+                if remaining:
+                    set_path(item, path, remaining)
+                else:
+                    remove_path(item, path)
+    return changed
+
+
+def project(item, paths):
+    result = {}
+    for path in paths:
+        if any(isinstance(segment, int) for segment in path):
+            # Elements of lists are returned with the whole list.
+            path = path[:1]
+        value = get_path(item, path)
+        if value is MISSING:
+            continue
+        target = result
+        for segment in path[:-1]:
+            target = target.setdefault(segment, {})
+        target[path[-1]] = value
+    return result
+
+
+def copy_item(value):
+    if isinstance(value, dict):
+        return {k: copy_item(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_item(v) for v in value]
+    if isinstance(value, set):
+        return set(value)
+    return value
@@ -0,0 +1,104 @@
+"""Memcached stand-in for the cell's read cache (readCache=memcached://...).
+
+Speaks the subset of the memcached text protocol the cache uses: get (one
+or more keys), set, add and delete, with expiry times in seconds.
+
+    python memcached.py --port 11211
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class Store:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.items = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                del self.items[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def store(self, command, key, data, exptime):
+        expires = self.clock() + exptime if exptime > 0 else None
+        with self.lock:
+            entry = self.items.get(key)
+            present = entry is not None and (entry[1] is None or entry[1] > self.clock())
+            if command == 'add' and present:
+                return False
+            self.items[key] = (data, expires)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return self.items.pop(key, None) is not None
+
+    def stats(self):
+        with self.lock:
+            return {'items': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+
+def serve(store, host='127.0.0.1', port=11211):
+    """Starts the server in a daemon thread and returns it."""
+    class Handler(socketserver.StreamRequestHandler):
+        disable_nagle_algorithm = True
+
+        def handle(self):
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                parts = line.decode().split()
+                if not parts:
+                    continue
+                command = parts[0]
+                if command == 'get':
+                    response = b''
+                    for key in parts[1:]:
+                        data = store.get(key)
+                        if data is not None:
+                            response += 'VALUE {} 0 {}\r\n'.format(key, len(data)).encode() + data + b'\r\n'
+                    self.wfile.write(response + b'END\r\n')
+                elif command in ('set', 'add') and len(parts) >= 5:
+                    data = self.rfile.read(int(parts[4]) + 2)[:-2]
+                    stored = store.store(command, parts[1], data, int(parts[3]))
+                    self.wfile.write(b'STORED\r\n' if stored else b'NOT_STORED\r\n')
+                elif command == 'delete' and len(parts) >= 2:
+                    self.wfile.write(b'DELETED\r\n' if store.delete(parts[1]) else b'NOT_FOUND\r\n')
+                else:
+                    self.wfile.write(b'ERROR\r\n')
+                self.wfile.flush()
+
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11211)
+    args = parser.parse_args()
+    server = serve(Store(), args.host, args.port)
+    print('Memcached stand-in listening on {}:{}'.format(args.host, args.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
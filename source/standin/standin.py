@@ -0,0 +1,241 @@
+"""Offline stand-in for the DynamoDB and CloudFormation APIs used by the
+router, the cells and cellularctl, with injected latency and throttling.
+
+It speaks the AWS wire protocols, so the real boto3/aioboto3 code paths run
+unchanged. Two ways to plug it in:
+
+- In-process: `session(backend)` returns a boto3 Session whose clients are
+  answered by the backend; pass it to routing.init_clients,
+  app.init_clients or cellular.init_clients.
+- Over HTTP: run this module and point the processes at it with
+  AWS_ENDPOINT_URL (or AWS_ENDPOINT_URL_DYNAMODB and
+  AWS_ENDPOINT_URL_CLOUDFORMATION), which botocore honours natively.
+
+    python standin.py --port 8000 --latency 0.003 --throttle 0.01 \\
+        --cell sandbox=localhost:8081 --router localhost:8080
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import boto3
+from botocore.awsrequest import AWSResponse
+from dynamodb import DynamoDB, DynamoDBError
+from cloudformation import CloudFormation, CloudFormationError, error_xml
+
+DYNAMODB_CONTENT_TYPE = 'application/x-amz-json-1.0'
+
+
+class Backend:
+    """DynamoDB and CloudFormation state plus fault injection.
+
+    Every request is delayed by latency plus up to jitter seconds. With
+    probability throttle a request fails with the service's throttling
+    error, and each item of a batch request is left unprocessed.
+    """
+
+    def __init__(self, latency=0, jitter=0, throttle=0, seed=None):
+        self.dynamodb = DynamoDB()
+        self.cloudformation = CloudFormation()
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.requests = {}
+        self.throttled = {}
+        self.dynamodb.unprocessed = self.throttled_now
+
+    def throttled_now(self):
+        if not self.throttle:
+            return False
+        with self.rng_lock:
+            return self.rng.random() < self.throttle
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.rng_lock:
+                extra = self.rng.uniform(0, self.jitter)
+            time.sleep(self.latency + extra)
+
+    def count(self, counter, operation):
+        with self.rng_lock:
+            counter[operation] = counter.get(operation, 0) + 1
+
+    def stats(self):
+        with self.rng_lock:
+            return {'requests': dict(self.requests), 'throttled': dict(self.throttled)}
+
+    def handle_dynamodb(self, operation, body):
+        """Returns (status, body) for a DynamoDB JSON request body."""
+        self.count(self.requests, operation)
+        self.delay()
+        if not operation.startswith('Batch') and self.throttled_now():
+            self.count(self.throttled, operation)
+            return 400, dynamodb_error('ProvisionedThroughputExceededException',
+                                       'The level of configured provisioned throughput for the table was exceeded.')
+        try:
+            result = self.dynamodb.handle(operation, json.loads(body or b'{}'))
+        except DynamoDBError as e:
+            return 400, dynamodb_error(e.code, e.message, e.fields)
+        return 200, json.dumps(result, default=str).encode()
+
+    def handle_cloudformation(self, body):
+        """Returns (status, body) for a CloudFormation query request body."""
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+        action = params.get('Action', '')
+        self.count(self.requests, action)
+        self.delay()
+        if self.throttled_now():
+            self.count(self.throttled, action)
+            return 400, error_xml('Throttling', 'Rate exceeded')
+        try:
+            return 200, self.cloudformation.handle(action, params)
+        except CloudFormationError as e:
+            return 400, error_xml(e.code, e.message)
+
+    def handle(self, headers, body):
+        """Returns (status, headers, body) for an HTTP request to either API."""
+        target = headers.get('X-Amz-Target')
+        if isinstance(target, bytes):
+            target = target.decode()
+        if target:
+            status, data = self.handle_dynamodb(target.split('.', 1)[1], body)
+            return status, {'Content-Type': DYNAMODB_CONTENT_TYPE}, data
+        status, data = self.handle_cloudformation(body)
+        return status, {'Content-Type': 'text/xml'}, data
+
+
+def dynamodb_error(code, message, fields=None):
+    return json.dumps(dict(fields or {}, **{'__type': 'com.amazonaws.dynamodb.v20120810#' + code,
+                                            'message': message}), default=str).encode()
+
+
+class RawBody:
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, **kwargs):
+        yield self.data
+
+
+def install(boto_session, backend):
+    """Answers the requests of clients created from boto_session (after this
+    call) from backend instead of AWS."""
+    def send(request, **kwargs):
+        body = request.body or b''
+        if hasattr(body, 'read'):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode()
+        status, headers, data = backend.handle(request.headers, body)
+        headers['x-amzn-RequestId'] = 'standin'
+        return AWSResponse(request.url, status, headers, RawBody(data))
+    boto_session.events.register('before-send', send)
+    return boto_session
+
+
+def session(backend, region='us-east-1'):
+    """A boto3 Session served by backend, with placeholder credentials."""
+    return install(boto3.session.Session(
+        aws_access_key_id='standin', aws_secret_access_key='standin', region_name=region), backend)
+
+
+def create_table(backend, name, *keys):
+    if name in backend.dynamodb.tables:
+        return
+    backend.dynamodb.CreateTable({
+        'TableName': name,
+        'KeySchema': [{'AttributeName': k, 'KeyType': t} for k, t in zip(keys, ('HASH', 'RANGE'))],
+        'AttributeDefinitions': [{'AttributeName': k, 'AttributeType': 'S'} for k in keys],
+        'BillingMode': 'PAY_PER_REQUEST',
+    })
+
+
+def seed(backend, cells, router_dns_name='localhost:8080'):
+    """Creates the stacks and tables of a deployment with the router and
+    active prod cells, on the hash ring, given as {cell_id: dns name}."""
+    create_table(backend, 'Cellular-Routing-Cells', 'cell_id')
+    create_table(backend, 'Cellular-Routing-Users', 'username')
+    backend.cloudformation.put_stack('Cellular-Router', {
+        'cellsTable': 'Cellular-Routing-Cells',
+        'usersTable': 'Cellular-Routing-Users',
+        'dnsName': router_dns_name,
+    })
+    for cell_id, dns_name in cells.items():
+        stack_name = 'Cellular-Cell-' + cell_id
+        create_table(backend, 'Cell-' + cell_id, 'username', 'key')
+        backend.cloudformation.put_stack(stack_name, {
+            'ddbTableName': 'Cell-' + cell_id,
+            'dnsName': dns_name,
+        })
+        backend.dynamodb.PutItem({'TableName': 'Cellular-Routing-Cells', 'Item': {
+            'cell_id': {'S': cell_id},
+            'stackName': {'S': stack_name},
+            'stackStatus': {'S': 'active'},
+            'stage': {'S': 'prod'},
+            'ring': {'BOOL': True},
+        }})
+
+
+def serve(backend, host='127.0.0.1', port=8000):
+    """Starts the HTTP server in a daemon thread and returns it."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            status, headers, data = backend.handle(self.headers, body)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('x-amzn-RequestId', 'standin')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            data = json.dumps(backend.stats()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds')
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='probability that a request (or batch item) is throttled')
+    parser.add_argument('--cell', action='append', default=[], metavar='CELL_ID=HOST:PORT',
+                        help='seed an active prod cell')
+    parser.add_argument('--router', default='localhost:8080', help='router address for the seeded stack')
+    args = parser.parse_args()
+    backend = Backend(args.latency, args.jitter, args.throttle)
+    if args.cell:
+        seed(backend, dict(c.split('=', 1) for c in args.cell), args.router)
+    server = serve(backend, args.host, args.port)
+    print('Stand-in listening on http://{}:{}/ (GET for request counts)'.format(args.host, args.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import time
+import unittest
+from decimal import Decimal
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Attr, Key
+import standin
+
+
+class StandInTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = standin.Backend(seed=1)
+        standin.seed(self.backend, {'sandbox': 'cell.local:8081'})
+        self.session = standin.session(self.backend)
+        self.dynamodb = self.session.resource('dynamodb')
+        self.table = self.dynamodb.Table('Cell-sandbox')
+
+
+class TestItems(StandInTestCase):
+    def test_put_get_delete(self):
+        self.table.put_item(Item={'username': 'u', 'key': 'k', 'value': 'v', 'n': 3})
+        item = self.table.get_item(Key={'username': 'u', 'key': 'k'})['Item']
+        self.assertEqual(item, {'username': 'u', 'key': 'k', 'value': 'v', 'n': Decimal(3)})
+        self.table.delete_item(Key={'username': 'u', 'key': 'k'})
+        self.assertNotIn('Item', self.table.get_item(Key={'username': 'u', 'key': 'k'}))
+
+    def test_binary(self):
+        data = bytes(range(256))
+        self.table.put_item(Item={'username': 'u', 'key': 'k', 'value': data})
+        item = self.table.get_item(Key={'username': 'u', 'key': 'k'})['Item']
+        self.assertEqual(item['value'].value, data)
+
+    def test_condition(self):
+        self.table.put_item(Item={'username': 'u', 'key': 'k', 'version': 1})
+        with self.assertRaises(ClientError) as e:
+            self.table.put_item(Item={'username': 'u', 'key': 'k'},
+                                ConditionExpression=Attr('key').not_exists())
+        self.assertEqual(e.exception.response['Error']['Code'], 'ConditionalCheckFailedException')
+        self.assertNotIn('Item', e.exception.response)
+        self.table.put_item(Item={'username': 'u', 'key': 'k', 'version': 2},
+                            ConditionExpression=Attr('version').eq(1) & Attr('other').not_exists())
+        with self.assertRaises(ClientError) as e:
+            self.table.delete_item(Key={'username': 'u', 'key': 'k'}, ConditionExpression=Attr('version').eq(1),
+                                   ReturnValuesOnConditionCheckFailure='ALL_OLD')
+        self.assertEqual(e.exception.response['Item']['version'], {'N': '2'})
+
+    def test_update_expressions(self):
+        key = {'username': 'u', 'key': 'k'}
+        self.table.put_item(Item=dict(key, tags=['a'], gone=True))
+        res = self.table.update_item(
+            Key=key,
+            UpdateExpression='SET #c = if_not_exists(#c, :zero) + :one, tags = list_append(tags, :t) '
+                             'REMOVE gone ADD seen :s',
+            ExpressionAttributeNames={'#c': 'count'},
+            ExpressionAttributeValues={':zero': 0, ':one': 1, ':t': ['b'], ':s': {'x'}},
+            ReturnValues='ALL_NEW')
+        self.assertEqual(res['Attributes'], dict(key, count=1, tags=['a', 'b'], seen={'x'}))
+        res = self.table.update_item(Key=key, UpdateExpression='SET #c = #c + :one',
+                                     ExpressionAttributeNames={'#c': 'count'},
+                                     ExpressionAttributeValues={':one': 1},
+                                     ReturnValues='UPDATED_OLD')
+        self.assertEqual(res['Attributes'], {'count': 1})
+
+    def test_transaction(self):
+        client = self.dynamodb.meta.client
+        self.table.put_item(Item={'username': 'u', 'key': 'k', 'n': 1})
+        update = {'Update': {'TableName': 'Cell-sandbox', 'Key': {'username': 'u', 'key': 'k'},
+                             'UpdateExpression': 'SET n = n + :one',
+                             'ExpressionAttributeValues': {':one': 1}}}
+        new = {'Put': {'TableName': 'Cell-sandbox', 'Item': {'username': 'u', 'key': 'new'},
+                       'ConditionExpression': 'attribute_not_exists(username)'}}
+        client.transact_write_items(TransactItems=[update, new])
+        with self.assertRaises(client.exceptions.TransactionCanceledException):
+            client.transact_write_items(TransactItems=[update, new])
+        self.assertEqual(self.table.get_item(Key={'username': 'u', 'key': 'k'})['Item']['n'], 2)
+
+    def test_key_cannot_be_updated(self):
+        with self.assertRaises(ClientError):
+            self.table.update_item(Key={'username': 'u', 'key': 'k'},
+                                   UpdateExpression='SET #k = :v',
+                                   ExpressionAttributeNames={'#k': 'key'},
+                                   ExpressionAttributeValues={':v': 'x'})
+
+
+class TestReads(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.table.batch_writer() as w:
+            for i in range(30):
+                w.put_item(Item={'username': 'u', 'key': 'k{:02}'.format(i), 'value': i})
+                w.put_item(Item={'username': 'other{}'.format(i), 'key': 'k', 'value': i})
+
+    def test_query_pages(self):
+        keys, kwargs = [], {}
+        while True:
+            res = self.table.query(KeyConditionExpression=Key('username').eq('u') & Key('key').begins_with('k1'),
+                                   ProjectionExpression='#k', ExpressionAttributeNames={'#k': 'key'},
+                                   Limit=4, **kwargs)
+            keys += [i['key'] for i in res['Items']]
+            if 'LastEvaluatedKey' not in res:
+                break
+            kwargs = {'ExclusiveStartKey': res['LastEvaluatedKey']}
+        self.assertEqual(keys, ['k{}'.format(i) for i in range(10, 20)])
+
+    def test_query_backwards_with_filter(self):
+        res = self.table.query(KeyConditionExpression=Key('username').eq('u') & Key('key').between('k00', 'k09'),
+                               FilterExpression=Attr('value').gte(5), ScanIndexForward=False)
+        self.assertEqual([i['value'] for i in res['Items']], [9, 8, 7, 6, 5])
+        self.assertEqual(res['ScannedCount'], 10)
+
+    def test_segmented_scan_covers_table_once(self):
+        seen = []
+        for segment in range(4):
+            kwargs = {}
+            while True:
+                res = self.table.scan(Segment=segment, TotalSegments=4, Limit=7, **kwargs)
+                seen += [(i['username'], i['key']) for i in res['Items']]
+                if 'LastEvaluatedKey' not in res:
+                    break
+                kwargs = {'ExclusiveStartKey': res['LastEvaluatedKey']}
+        self.assertEqual(len(seen), 60)
+        self.assertEqual(len(set(seen)), 60)
+
+    def test_batch_get(self):
+        res = self.dynamodb.batch_get_item(RequestItems={'Cell-sandbox': {
+            'Keys': [{'username': 'u', 'key': 'k01'}, {'username': 'u', 'key': 'missing'}],
+            'ProjectionExpression': '#v', 'ExpressionAttributeNames': {'#v': 'value'}}})
+        self.assertEqual(res['Responses']['Cell-sandbox'], [{'value': 1}])
+
+    def test_consumed_capacity(self):
+        res = self.table.scan(ReturnConsumedCapacity='TOTAL')
+        self.assertGreater(res['ConsumedCapacity']['CapacityUnits'], 0)
+
+
+class TestFaults(StandInTestCase):
+    def test_throttling(self):
+        self.backend.throttle = 1
+        table = self.session.resource('dynamodb', config=Config(
+            retries={'mode': 'standard', 'max_attempts': 1})).Table('Cell-sandbox')
+        with self.assertRaises(ClientError) as e:
+            table.put_item(Item={'username': 'u', 'key': 'k'})
+        self.assertEqual(e.exception.response['Error']['Code'], 'ProvisionedThroughputExceededException')
+        self.assertEqual(self.backend.dynamodb.tables['Cell-sandbox'].count, 0)
+        self.assertIn('PutItem', self.backend.stats()['throttled'])
+
+    def test_batch_items_left_unprocessed(self):
+        self.backend.throttle = 0.5
+        res = self.dynamodb.meta.client.batch_write_item(RequestItems={'Cell-sandbox': [
+            {'PutRequest': {'Item': {'username': 'u', 'key': str(i)}}} for i in range(25)]})
+        unprocessed = len(res['UnprocessedItems'].get('Cell-sandbox', []))
+        self.assertTrue(0 < unprocessed < 25)
+        self.assertEqual(self.backend.dynamodb.tables['Cell-sandbox'].count, 25 - unprocessed)
+
+    def test_latency(self):
+        self.backend.latency = 0.02
+        start = time.monotonic()
+        self.table.get_item(Key={'username': 'u', 'key': 'k'})
+        self.assertGreaterEqual(time.monotonic() - start, 0.02)
+
+
+class TestHttp(unittest.TestCase):
+    def test_server(self):
+        backend = standin.Backend()
+        standin.seed(backend, {'sandbox': 'cell.local:8081'})
+        server = standin.serve(backend, port=0)
+        try:
+            session = boto3.session.Session(aws_access_key_id='x', aws_secret_access_key='x',
+                                            region_name='us-east-1')
+            url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            cf = session.client('cloudformation', endpoint_url=url)
+            outputs = cf.describe_stacks(StackName='Cellular-Cell-sandbox')['Stacks'][0]['Outputs']
+            self.assertIn({'OutputKey': 'dnsName', 'OutputValue': 'cell.local:8081'}, outputs)
+            table = session.resource('dynamodb', endpoint_url=url).Table('Cellular-Routing-Cells')
+            self.assertEqual(table.get_item(Key={'cell_id': 'sandbox'})['Item']['stage'], 'prod')
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()